@@ -8,6 +8,7 @@ Ensures live ISO uses offline pacman (self-contained); copies offline pacman.con
 into airootfs/etc before mkarchiso runs.
 """
 
+import os
 import shutil
 import sys
 from pathlib import Path
@@ -15,8 +16,33 @@ from pathlib import Path
 # Add parent directory to path for utils
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from utils import Colors
+from utils import Colors, count, profile_step, run_privileged, sudo_rmtree
 from .mkarchiso import execute_mkarchiso
+from .publish import publish_isos, staging_dir
+
+
+def record_image_sizes(archiso_tmp_dir: Path) -> None:
+    """
+    Count the airootfs tree and the squashfs image mkarchiso packed it into
+    (their ratio is the compression ratio the controller reports).
+    
+    Args:
+        archiso_tmp_dir: mkarchiso work directory of the finished build
+    """
+    image = archiso_tmp_dir / 'iso' / 'arch' / 'x86_64' / 'airootfs.sfs'
+    tree = archiso_tmp_dir / 'x86_64' / 'airootfs'
+    if not image.exists() or not tree.is_dir():
+        return
+    # Apparent sizes; the few root-only directories are skipped
+    tree_bytes = 0
+    for root, _, files in os.walk(tree):
+        for name in files:
+            try:
+                tree_bytes += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    count('build/squashfs_bytes', image.stat().st_size)
+    count('build/airootfs_bytes', tree_bytes)
 
 
 def main(phase_path: Path, config: dict) -> dict:
@@ -51,8 +77,27 @@ def main(phase_path: Path, config: dict) -> dict:
     else:
         print(f"{Colors.YELLOW}WARNING: Offline pacman.conf not found at {offline_pacman}; airootfs unchanged{Colors.NC}")
     
-    # Execute mkarchiso
-    iso_files = execute_mkarchiso(work_dir, out_dir, profile_dir)
+    # Resumed build with the profile untouched: let mkarchiso skip the steps it already
+    # completed in archiso-tmp. Otherwise the profile may have changed since archiso-tmp
+    # was written, and mkarchiso's build state would make it skip work it must redo.
+    archiso_tmp_dir = work_dir / 'archiso-tmp'
+    if config.get('resume_in_place') and archiso_tmp_dir.exists():
+        print(f"{Colors.CYAN}Resuming: reusing mkarchiso work state in {archiso_tmp_dir}{Colors.NC}")
+    elif os.path.ismount(archiso_tmp_dir):
+        # tmpfs placed by the controller: empty it, keep the mount
+        run_privileged([{'op': 'rmtree', 'path': entry} for entry in archiso_tmp_dir.iterdir()], check=False)
+    elif archiso_tmp_dir.exists():
+        print(f"{Colors.BLUE}Removing stale archiso-tmp directory...{Colors.NC}")
+        sudo_rmtree(archiso_tmp_dir, check=False)
+    
+    # Execute mkarchiso into a staging directory, then publish the finished ISO
+    # atomically (a deploy of the previous ISO may be reading isoout/ right now)
+    staging = staging_dir(out_dir, config.get('variant'))
+    log_file = Path(config['log_file']) if config.get('log_file') else None
+    with profile_step('build/execute_mkarchiso'):
+        execute_mkarchiso(work_dir, staging, profile_dir, log_file)
+    record_image_sizes(archiso_tmp_dir)
+    iso_files = publish_isos(staging, out_dir)
     
     print(f"{Colors.GREEN}✓ Build phase complete{Colors.NC}")
     
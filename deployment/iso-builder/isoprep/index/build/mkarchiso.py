@@ -10,6 +10,7 @@ import subprocess
 import sys
 from datetime import datetime
 from pathlib import Path
+from typing import Optional
 
 # Add utils to path
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
@@ -17,7 +18,7 @@ sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 from utils import Colors
 
 
-def execute_mkarchiso(work_dir: Path, out_dir: Path, profile_dir: Path):
+def execute_mkarchiso(work_dir: Path, out_dir: Path, profile_dir: Path, log_file: Optional[Path] = None):
     """
     Execute mkarchiso to build the ISO.
     
@@ -25,7 +26,28 @@ def execute_mkarchiso(work_dir: Path, out_dir: Path, profile_dir: Path):
         work_dir: Work directory for mkarchiso
         out_dir: Output directory for ISO
         profile_dir: ISO profile directory
+        log_file: Write mkarchiso's output here instead of the terminal
+            (matrix builds run several at once)
     """
+    mkarchiso_cmd = [
+        'sudo', 'mkarchiso', '-v',
+        '-w', str(work_dir / 'archiso-tmp'),
+        '-o', str(out_dir),
+        str(profile_dir)
+    ]
+    if log_file is not None:
+        print(f"{Colors.BLUE}Building {profile_dir.parent.name} with mkarchiso (output in {log_file})...{Colors.NC}")
+        with open(log_file, 'w') as log:
+            result = subprocess.run(mkarchiso_cmd, stdout=log, stderr=subprocess.STDOUT)
+        if result.returncode != 0:
+            print(f"{Colors.RED}mkarchiso failed with exit code {result.returncode}; see {log_file}{Colors.NC}")
+            sys.exit(1)
+        iso_files = list(out_dir.glob("*.iso"))
+        if not iso_files:
+            print(f"{Colors.RED}ERROR: mkarchiso reported success but wrote no ISO to {out_dir}{Colors.NC}")
+            sys.exit(1)
+        return iso_files
+    
     print(f"{Colors.BLUE}=== Build Phase ==={Colors.NC}")
     print(f"{Colors.BLUE}Building ISO with mkarchiso (Requires Sudo)...{Colors.NC}")
     print()
@@ -47,12 +69,6 @@ def execute_mkarchiso(work_dir: Path, out_dir: Path, profile_dir: Path):
     # Run mkarchiso
     # Note: mkarchiso will produce I/O errors when trying to copy /sys and /proc virtual files
     # These are expected and mkarchiso handles them by creating empty files
-    mkarchiso_cmd = [
-        'sudo', 'mkarchiso', '-v',
-        '-w', str(work_dir / 'archiso-tmp'),
-        '-o', str(out_dir),
-        str(profile_dir)
-    ]
     print(f"{Colors.CYAN}EXECUTING:{Colors.NC} {' '.join(mkarchiso_cmd)}")
     print()
     result = subprocess.run(mkarchiso_cmd)
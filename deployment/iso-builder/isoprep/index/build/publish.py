@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - ISO Publishing Module
+Copyright (C) 2024 HOMESERVER LLC
+
+mkarchiso writes into a staging directory next to the ISO output directory;
+finished ISOs are then published into it by rename, so a reader (deploy, VM)
+only ever sees complete images. Publishing a new name never waits; replacing
+an ISO of the same name waits until nobody is reading isoout/ (the
+controller's isoout lock).
+"""
+
+import os
+import sys
+from contextlib import ExitStack
+from pathlib import Path
+from typing import List, Optional
+
+# Add utils to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils import Colors, sudo_move, sudo_rmtree
+
+STAGING_DIR_NAME = '.staging'
+
+# Repository top level (contains lib/controller)
+_TOP_LEVEL = Path(__file__).resolve().parents[5]
+
+
+def staging_dir(out_dir: Path, variant: Optional[str] = None) -> Path:
+    """
+    Empty staging directory for mkarchiso's output (same filesystem as out_dir).
+
+    Args:
+        out_dir: ISO output directory
+        variant: Matrix build variant (each one stages separately)
+    """
+    staging = out_dir / (f'{STAGING_DIR_NAME}-{variant}' if variant else STAGING_DIR_NAME)
+    if staging.exists():
+        sudo_rmtree(staging, check=False)
+    staging.mkdir(parents=True, exist_ok=True)
+    return staging
+
+
+def _isoout_lock():
+    """The controller's exclusive isoout lock, or a no-op outside the controller's tree."""
+    if str(_TOP_LEVEL) not in sys.path:
+        sys.path.append(str(_TOP_LEVEL))
+    try:
+        from lib.controller import locks
+    except ImportError:
+        return ExitStack()
+    return locks.hold(locks.ISOOUT, exclusive=True, purpose='publish ISO')
+
+
+def publish_isos(staging: Path, out_dir: Path) -> List[Path]:
+    """
+    Move staged ISOs into out_dir atomically.
+
+    Args:
+        staging: Directory mkarchiso wrote to
+        out_dir: ISO output directory readers use
+
+    Returns:
+        Published ISO paths
+    """
+    published = []
+    for staged in sorted(staging.glob('*.iso')):
+        target = out_dir / staged.name
+        with ExitStack() as stack:
+            if target.exists():
+                # Readers may hold the old image open by name
+                stack.enter_context(_isoout_lock())
+            try:
+                os.replace(staged, target)
+            except PermissionError:
+                sudo_move(staged, target, check=True)
+        print(f"{Colors.GREEN}✓ Published {target}{Colors.NC}")
+        published.append(target)
+    try:
+        staging.rmdir()
+    except OSError:
+        sudo_rmtree(staging, check=False)
+    return published
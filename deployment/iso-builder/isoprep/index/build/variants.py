@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Build Variants Module
+Copyright (C) 2024 HOMESERVER LLC
+
+Per-variant ISO builds for matrix builds (controller --matrix). The variants
+are the installer profiles of vmtools/index.json (VM test, developer,
+production). Every variant starts from the one assembled base profile, cloned
+by reflink or hardlink, and changes only what makes it that variant: the ISO
+name, the installer's default profile and any extra packages it lists.
+"""
+
+import json
+import re
+import shutil
+import sys
+import time
+from pathlib import Path
+
+# Add utils to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils import Colors, VariantResult, clone_tree, profile_step, sudo_rmtree
+from utils.package_utils import VARIANTS_FILE
+
+VARIANTS_DIR_NAME = 'variants'
+
+
+def load_variants(repo_root: Path) -> dict:
+    """
+    Build variants by name (the profiles of vmtools/index.json).
+
+    Args:
+        repo_root: Root of the repository (deployment/)
+
+    Returns:
+        Profile settings by variant name, in file order
+    """
+    variants_file = repo_root / VARIANTS_FILE
+    if not variants_file.exists():
+        return {}
+    with open(variants_file, 'r') as f:
+        return json.load(f).get('profiles', {})
+
+
+def _rewrite(path: Path, text: str) -> None:
+    """Replace a cloned file (a hardlink shares its data with the base profile)."""
+    path.unlink(missing_ok=True)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+def prepare_variant(base_profile: Path, variant_dir: Path, name: str, variant: dict) -> Path:
+    """
+    Clone the base profile and turn it into one variant's profile.
+
+    Args:
+        base_profile: Assembled profile (profile_assembly output)
+        variant_dir: Work directory of this variant (emptied first)
+        name: Variant name
+        variant: Variant settings from vmtools/index.json
+
+    Returns:
+        Profile directory of the variant
+    """
+    if variant_dir.exists():
+        sudo_rmtree(variant_dir, check=False)
+    profile_dir = variant_dir / 'profile'
+    clone_tree(base_profile, profile_dir)
+
+    # ISO file name: one per variant in the shared isoout/
+    profiledef = profile_dir / 'profiledef.sh'
+    text = profiledef.read_text()
+    text = re.sub(r'^iso_name="([^"]*)"', lambda m: f'iso_name="{m.group(1)}-{name}"', text, count=1, flags=re.M)
+    _rewrite(profiledef, text)
+
+    # Installer preset: the configurator picks default_profile
+    vmtools = profile_dir / 'airootfs' / 'root' / 'vmtools' / 'index.json'
+    if vmtools.exists():
+        settings = json.loads(vmtools.read_text())
+        settings['default_profile'] = name
+        _rewrite(vmtools, json.dumps(settings, indent=2) + '\n')
+
+    extra = variant.get('packages', [])
+    if extra:
+        packages = profile_dir / 'packages.x86_64'
+        text = packages.read_text() if packages.exists() else ''
+        if text and not text.endswith('\n'):
+            text += '\n'
+        _rewrite(packages, text + f'# Variant {name}\n' + ''.join(f'{p}\n' for p in extra))
+
+    # The build phase overwrites pacman.conf in place; keep the base profile's copy intact
+    pacman_conf = profile_dir / 'airootfs' / 'etc' / 'pacman.conf'
+    if pacman_conf.exists():
+        _rewrite(pacman_conf, pacman_conf.read_text())
+
+    return profile_dir
+
+
+def build_variant(phase_path: Path, config: dict, name: str, variant: dict) -> VariantResult:
+    """
+    Build one variant's ISO from the shared base profile.
+
+    Args:
+        phase_path: Path to the build phase directory
+        config: Build phase configuration of the base build (paths and flags)
+        name: Variant name
+        variant: Variant settings from vmtools/index.json
+
+    Returns:
+        VariantResult: Success, wall time, published ISOs and mkarchiso log
+    """
+    from .index import main as build_main
+
+    work_dir = Path(config['work_dir'])
+    variant_dir = work_dir / VARIANTS_DIR_NAME / name
+    start = time.monotonic()
+    log_file = None
+    try:
+        with profile_step(f'build/variant/{name}/prepare_variant'):
+            profile_dir = prepare_variant(Path(config['profile_dir']), variant_dir, name, variant)
+        log_file = variant_dir / 'mkarchiso.log'
+        with profile_step(f'build/variant/{name}'):
+            result = build_main(phase_path, {
+                **config,
+                'work_dir': variant_dir,
+                'profile_dir': profile_dir,
+                'variant': name,
+                'log_file': log_file,
+                'resume_in_place': False,
+            })
+        success, iso_files = bool(result.get('success')), result.get('iso_files', [])
+    except (OSError, shutil.Error, SystemExit) as e:
+        if not isinstance(e, SystemExit):
+            print(f"{Colors.RED}Variant {name} failed: {e}{Colors.NC}")
+        success, iso_files = False, []
+    return VariantResult(name=name, success=success, wall=time.monotonic() - start,
+                         iso_files=iso_files, log=log_file)
@@ -1,21 +1,45 @@
 #!/usr/bin/env python3
 
+import dataclasses
+import importlib
 import json
 import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
+
+from utils import (
+    Colors, PhaseCache, CACHE_DIR_NAME, BuildState, STATE_DIR_NAME, missing_outputs,
+    run_dag, sequential_dependencies, topological_order, profile_step, reset_profile, write_profile, warm,
+    BuildConfig, BuildResult, MatrixResult
+)
+
+# Phases a matrix build runs once for every variant
+MATRIX_BASE_PHASES = ['prepare', 'package_management', 'profile_assembly']
+
+# Keys of a phase's own index.json read by the orchestrator; the rest are phase settings
+PHASE_INDEX_KEYS = ('metadata', 'children', 'cache', 'outputs')
+
+
+class PhaseFailed(Exception):
+    """A phase returned success: False."""
 
-from utils import Colors
 
 class Orchestrator:
     """Main orchestrator for ISO build process."""
 
-    def __init__(self, index_path: Path):
+    def __init__(self, index_path: Path, build_config: Optional[BuildConfig] = None):
         self.index_path = index_path
+        self.build_config = build_config or BuildConfig()
         self.config_path = index_path / 'index.json'
         self.config = self._load_config()
+        self._phase_configs: Dict[str, dict] = {}
         self.paths = self._resolve_paths()
+        self.work_dir = Path(self.paths['work_dir'])
+        self.cache = self._open_cache()
+        self.state = BuildState(self.work_dir / STATE_DIR_NAME)
 
     def _load_config(self):
         """Load configuration from index.json.
@@ -40,9 +64,11 @@ class Orchestrator:
         paths_config = self.config.get('paths', {}).copy()
 
         # Set default repo_root if not provided (deployment/ so repo_root / 'iso-builder' exists)
-        if 'repo_root' not in paths_config or not paths_config['repo_root']:
+        configured = os.path.expandvars(paths_config.get('repo_root') or '')
+        if self.build_config.repo_root:
+            paths_config['repo_root'] = str(self.build_config.repo_root)
+        elif not configured or '$' in configured:
             default_repo_root = Path(__file__).parent.parent.parent.parent.resolve()
-            os.environ['ISOPREP_REPO_ROOT'] = str(default_repo_root)
             paths_config['repo_root'] = str(default_repo_root)
 
         # Expand bash-style variables first (${VAR:-default} syntax)
@@ -81,43 +107,249 @@ class Orchestrator:
         import re
         pattern = r'\$\{([^:]+):-([^}]+)\}'
 
+        # The build's own work directory wins over the environment
+        overrides = {}
+        if self.build_config.work_dir:
+            overrides['HOMERCHY_WORK_DIR'] = str(self.build_config.work_dir)
+
         def replacer(match):
             var_name = match.group(1)
             default = match.group(2)
-            return os.environ.get(var_name, default)
+            return overrides.get(var_name, os.environ.get(var_name, default))
 
         return re.sub(pattern, replacer, value)
 
+    def _open_cache(self) -> Optional[PhaseCache]:
+        """Open the phase cache in the work directory.
+
+        Returns:
+            Optional[PhaseCache]: Cache, or None if disabled in index.json
+        """
+        if not self.config.get('execution', {}).get('cache', True):
+            return None
+        return PhaseCache(self.work_dir / CACHE_DIR_NAME, self.paths, self.index_path)
+
+    def _load_phase_config(self, phase_name: str) -> dict:
+        """Load a phase's own index.json.
+
+        Args:
+            phase_name: Name of the phase
+
+        Returns:
+            dict: Phase index configuration (empty if the phase has none)
+        """
+        if phase_name not in self._phase_configs:
+            config_path = self.index_path / phase_name / 'index.json'
+            config = {}
+            if config_path.exists():
+                with open(config_path, 'r') as f:
+                    config = json.load(f)
+            self._phase_configs[phase_name] = config
+        return self._phase_configs[phase_name]
+
+    def _cache_spec(self, phase_name: str) -> Optional[dict]:
+        """Return the phase's cache declaration, or None if it must always run."""
+        if self.cache is None:
+            return None
+        return self._load_phase_config(phase_name).get('cache')
+
+    def _missing_outputs(self, phase_name: str) -> list:
+        """Return the phase's declared outputs that no longer exist."""
+        return missing_outputs(self._load_phase_config(phase_name).get('outputs', []), self.paths)
+
+    def _restore_completed(self, children: list, dependencies: dict) -> dict:
+        """Find the phases a resumed build can skip.
+
+        A phase is restored if it completed successfully, its outputs still
+        exist and none of its dependencies has to run again.
+
+        Args:
+            children: Phase names
+            dependencies: Phase dependency map
+
+        Returns:
+            dict: Restored results by phase name
+        """
+        restored = {}
+        for phase_name in topological_order(children, dependencies):
+            record = self.state.completed(phase_name)
+            if record is None:
+                print(f"{Colors.YELLOW}Resume: {phase_name} did not complete; running from here{Colors.NC}")
+                continue
+            missing = self._missing_outputs(phase_name)
+            if missing:
+                print(f"{Colors.YELLOW}Resume: {phase_name} output missing ({missing[0]}); rerunning{Colors.NC}")
+                continue
+            rerun = [dep for dep in dependencies.get(phase_name, []) if dep not in restored]
+            if rerun:
+                print(f"{Colors.YELLOW}Resume: {phase_name} depends on {', '.join(rerun)}; rerunning{Colors.NC}")
+                continue
+            print(f"{Colors.GREEN}✓ Resume: {phase_name} already complete{Colors.NC}")
+            restored[phase_name] = {**record, **self.paths, 'restored': True}
+        return restored
+
+    def _replay_all(self, children: list) -> Optional[dict]:
+        """Replay every phase if all cacheable phases hit (no-change rebuild).
+
+        Phases without a cache declaration (prepare) only do setup for the
+        phases after them, so they are skipped too when nothing will run.
+
+        Args:
+            children: Phase names in execution order
+
+        Returns:
+            Optional[dict]: Replayed results, or None if any phase must run
+        """
+        if self.build_config.full_clean:
+            return None
+        cached = {}
+        for phase_name in children:
+            spec = self._cache_spec(phase_name)
+            if spec is None:
+                continue
+            result, _ = self.cache.lookup(phase_name, spec, self._load_phase_config(phase_name).get('outputs'))
+            if result is None:
+                return None
+            cached[phase_name] = result
+
+        if not cached:
+            return None
+
+        print(f"{Colors.GREEN}✓ No inputs changed since the last build; replaying cached results{Colors.NC}")
+        results = {}
+        for phase_name in children:
+            if phase_name in cached:
+                self.cache.hits.append(phase_name)
+                print(f"{Colors.GREEN}✓ Cache hit: {phase_name} "
+                      f"({self.cache.fingerprints[phase_name][:12]}){Colors.NC}")
+                results[phase_name] = {**self.paths, **cached[phase_name], 'cached': True}
+            else:
+                print(f"{Colors.CYAN}Skipping {phase_name} (nothing to rebuild){Colors.NC}")
+                results[phase_name] = {**self.paths, 'success': True, 'skipped': True}
+            self.state.record(phase_name, results[phase_name])
+        return results
+
+    def _print_cache_report(self):
+        """Print per-phase cache hits and misses."""
+        if self.cache is None or not (self.cache.hits or self.cache.misses):
+            return
+        print(f"{Colors.BLUE}Phase cache: {len(self.cache.hits)} hit(s), "
+              f"{len(self.cache.misses)} miss(es){Colors.NC}")
+        for phase_name in self.cache.hits:
+            print(f"  {phase_name}: hit")
+        for phase_name, reason in self.cache.misses:
+            print(f"  {phase_name}: miss ({reason})")
+
     def execute(self) -> bool:
-        """Execute all build children phases.
+        """Execute all build children phases in dependency order.
+
+        Phases declared independent in "dependencies" run concurrently when
+        execution.parallel is set. Per-phase resource usage is written to
+        the build config's profile_file (if set) for the controller's build ledger.
 
         Returns:
             bool: True if all phases succeeded, False otherwise
         """
+        try:
+            return self._execute_children()
+        finally:
+            if self.build_config.profile_file:
+                write_profile(Path(self.build_config.profile_file))
+
+    def run(self) -> BuildResult:
+        """Execute the build and collect its outcome.
+
+        Returns:
+            BuildResult: Success, per-phase results and phase cache hits/misses
+        """
+        start = time.monotonic()
+        self._phase_results = {}
+        success = self.execute()
+        return BuildResult(
+            success=success,
+            phases=dict(self._phase_results),
+            cache_hits=list(self.cache.hits) if self.cache else [],
+            cache_misses=list(self.cache.misses) if self.cache else [],
+            wall=time.monotonic() - start,
+        )
+
+    def _execute_children(self) -> bool:
+        """Run (or restore/replay) every phase; see execute()."""
         children = self.config.get('children', [])
+        if self.build_config.phases is not None:
+            children = [name for name in children if name in self.build_config.phases]
         execution_config = self.config.get('execution', {})
         continue_on_error = execution_config.get('continue_on_error', False)
-        results = {}
-        success = True
-
-        for phase_name in children:
-            try:
-                phase_result = self._execute_phase(phase_name, results)
-                results[phase_name] = phase_result
-            except Exception as e:
-                print(f'{Colors.BLUE}Error in phase {phase_name}: {e}{Colors.NC}')
-                if not continue_on_error:
-                    return False
-                success = False
-
-        return success
-
-    def _execute_phase(self, phase_name: str, phase_results: dict = None) -> dict:
-        """Execute a single build phase.
+        parallel = execution_config.get('parallel', False)
+        resume = self.build_config.resume
+
+        # Without declared dependencies every phase waits for the one before it
+        dependencies = self.config.get('dependencies', sequential_dependencies(children))
+        dependencies = {name: [dep for dep in deps if dep in children]
+                        for name, deps in dependencies.items() if name in children}
+
+        # Resuming: keep every phase that completed and whose outputs survive
+        results = self._restore_completed(children, dependencies) if resume else {}
+        if not resume:
+            self.state.reset()
+        restored = set(results)
+        pending = [name for name in children if name not in restored]
+        if resume and not pending:
+            print(f"{Colors.GREEN}✓ All phases already complete; nothing to resume{Colors.NC}")
+            self._phase_results = results
+            return True
+
+        if self.cache is not None and not results:
+            replayed = self._replay_all(children)
+            if replayed is not None:
+                self._phase_results = replayed
+                self._print_cache_report()
+                return True
+
+        def run_phase(phase_name: str) -> dict:
+            self.state.clear(phase_name)
+            # A resumed phase whose inputs were all restored may continue from its own partial state
+            in_place = resume and all(dep in restored for dep in dependencies.get(phase_name, []))
+            with profile_step(phase_name) as step:
+                results[phase_name] = self._execute_phase(phase_name, results, resume_in_place=in_place)
+                step.cached = bool(results[phase_name].get('cached'))
+            # A phase returning success: False fails like one that raised (dependents are
+            # skipped, continue_on_error applies) and never counts as complete for --resume
+            if not results[phase_name].get('success'):
+                raise PhaseFailed(results[phase_name].get('error') or 'returned success: False')
+            self.state.record(phase_name, results[phase_name])
+            return results[phase_name]
+
+        def report_error(phase_name: str, error: BaseException):
+            print(f'{Colors.BLUE}Error in phase {phase_name}: {error}{Colors.NC}')
+
+        pending_dependencies = {name: [dep for dep in dependencies.get(name, []) if dep in pending]
+                                for name in pending}
+        outcome = run_dag(pending, pending_dependencies, run_phase, parallel=parallel,
+                          continue_on_error=continue_on_error,
+                          max_workers=execution_config.get('max_workers'),
+                          on_error=report_error)
+        for phase_name in outcome.skipped:
+            print(f'{Colors.YELLOW}Skipped phase {phase_name} (a dependency failed){Colors.NC}')
+        # Phases that raised or exited left no result of their own (failed results are kept)
+        for phase_name, error in outcome.errors.items():
+            if isinstance(error, PhaseFailed):
+                continue
+            results[phase_name] = {**results.get(phase_name, {}), 'success': False,
+                                   'error': f"{type(error).__name__}: {error}"}
+
+        self._phase_results = results
+        self._print_cache_report()
+        return outcome.ok
+
+    def _execute_phase(self, phase_name: str, phase_results: dict = None,
+                       resume_in_place: bool = False) -> dict:
+        """Execute a single build phase, or replay its cached result.
 
         Args:
             phase_name: Name of the phase to execute
             phase_results: Previous phase results (optional)
+            resume_in_place: Resumed build with every upstream phase restored
 
         Returns:
             dict: Phase execution results
@@ -127,8 +359,37 @@ class Orchestrator:
         if not phase_dir.exists():
             raise FileNotFoundError(f"Phase directory not found: {phase_dir}")
 
-        # Load phase config
-        phase_config = {**self.paths, **self.config.get(phase_name, {})}
+        # Load phase config: the phase's own index.json settings (e.g. prepare's "preflight"),
+        # overridden by the root index.json's block for the phase and the build's options
+        phase_settings = {key: value for key, value in self._load_phase_config(phase_name).items()
+                          if key not in PHASE_INDEX_KEYS}
+        phase_config = {**self.paths, **phase_settings, **self.build_config.phase_options(),
+                        **self.config.get(phase_name, {})}
+        # Phases with sub-steps follow the same parallel setting
+        phase_config.setdefault('parallel', self.config.get('execution', {}).get('parallel', False))
+        phase_config['resume_in_place'] = resume_in_place
+        if self.build_config.steps and phase_name in self.build_config.steps:
+            phase_config['steps'] = self.build_config.steps[phase_name]
+
+        # Replay the stored result if the phase's inputs are unchanged and its outputs still exist
+        cache_spec = self._cache_spec(phase_name)
+        if cache_spec is not None:
+            if self.build_config.full_clean:
+                self.cache.fingerprint(phase_name, cache_spec)
+                cached, reason = None, 'full clean'
+            else:
+                cached, reason = self.cache.lookup(phase_name, cache_spec,
+                                                   self._load_phase_config(phase_name).get('outputs'))
+            if cached is not None:
+                self.cache.hits.append(phase_name)
+                print(f"{Colors.GREEN}✓ Cache hit: {phase_name} ({reason}){Colors.NC}")
+                phase_config.update(cached)
+                phase_config['cached'] = True
+                return phase_config
+            self.cache.misses.append((phase_name, reason))
+            print(f"{Colors.YELLOW}Cache miss: {phase_name} ({reason}){Colors.NC}")
+            # Outputs are about to be rebuilt; never let an interrupted run match the old record
+            self.cache.invalidate(phase_name)
 
         # Import and run phase module
         import importlib.util
@@ -146,6 +407,8 @@ class Orchestrator:
 
         if hasattr(module, 'main'):
             result = module.main(phase_dir, phase_config)
+            if cache_spec is not None and result.get('success'):
+                self.cache.store(phase_name, result)
             phase_config.update(result)
             return phase_config
         else:
@@ -173,9 +436,72 @@ class Orchestrator:
                 print(f"  {phase_name}: {status}")
 
 
+def run_build(build_config: Optional[BuildConfig] = None) -> BuildResult:
+    """Run one build in this process.
+
+    Modules, warm indexes and anything else the phases keep in memory are
+    shared between phases and with the caller.
+
+    Args:
+        build_config: Build options (default: BuildConfig())
+
+    Returns:
+        BuildResult: Outcome of the build
+    """
+    reset_profile()
+    return Orchestrator(Path(__file__).parent, build_config).run()
+
+
+def run_matrix(build_config: Optional[BuildConfig] = None, variants: Optional[List[str]] = None,
+               jobs: int = 2) -> MatrixResult:
+    """Build several ISO variants from one package download and one base profile.
+
+    The base phases run once; the build phase then runs per variant (see
+    build/variants.py), up to jobs at a time, into the shared out_dir.
+
+    Args:
+        build_config: Build options (default: BuildConfig())
+        variants: Variant names (default: every profile of vmtools/index.json)
+        jobs: Variants built concurrently
+
+    Returns:
+        MatrixResult: Outcome of the base phases and of each variant
+
+    Raises:
+        ValueError: If a variant is not defined
+    """
+    start = time.monotonic()
+    reset_profile()
+    build_config = build_config or BuildConfig()
+    index_path = Path(__file__).parent
+    orchestrator = Orchestrator(index_path, dataclasses.replace(build_config, phases=MATRIX_BASE_PHASES))
+
+    sys.path.insert(0, str(index_path))
+    variants_module = importlib.import_module('build.variants')
+    available = variants_module.load_variants(Path(orchestrator.paths['repo_root']))
+    names = variants or list(available)
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ValueError(f"Unknown variant(s): {', '.join(unknown)} (defined: {', '.join(available)})")
+
+    base = orchestrator.run()
+    if not base.success:
+        return MatrixResult(base=base, wall=time.monotonic() - start)
+
+    config = {**orchestrator.paths, **build_config.phase_options(), **orchestrator.config.get('build', {})}
+    print(f"{Colors.BLUE}=== Building {len(names)} variant(s), {jobs} at a time ==={Colors.NC}")
+    with ThreadPoolExecutor(max_workers=max(1, jobs), thread_name_prefix='variant') as pool:
+        futures = [pool.submit(variants_module.build_variant, index_path / 'build', config, name, available[name])
+                   for name in names]
+        results = [future.result() for future in futures]
+    if build_config.profile_file:
+        write_profile(Path(build_config.profile_file))
+    return MatrixResult(base=base, variants=results, wall=time.monotonic() - start)
+
+
 def main():
     """Main entry point for the ISO build orchestration system."""
-    orchestrator = Orchestrator(Path(__file__).parent)
-    success = orchestrator.execute()
-    import sys
-    sys.exit(0 if success else 1)
+    result = run_build(BuildConfig.from_env())
+    # Hand the warm indexes back to a long-lived controller (controller --serve)
+    warm.dump_on_exit()
+    sys.exit(0 if result.success else 1)
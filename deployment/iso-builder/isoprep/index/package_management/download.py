@@ -3,20 +3,28 @@
 HOMESERVER Homerchy ISO Builder - Package Download Module
 Copyright (C) 2024 HOMESERVER LLC
 
-Download packages to offline mirror directory.
+Download packages to offline mirror directory (fetch.py: parallel, resumable, verified).
 """
 
-import os
-import shutil
-import subprocess
 import sys
-import time
 from pathlib import Path
 
 # Add utils to path
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-from utils import Colors, read_package_list
+from utils import CacheStore, Colors, Resolution, collect_mirror_packages, count, package_index, resolve_closure
+from utils.sync_db import read_pacman_conf, read_sync_dbs
+from .fetch import FetchError, FetchTarget, fetch_packages, sync_databases
+
+
+def _report_missing(resolution: Resolution) -> None:
+    """Print what the dependency closure could not satisfy, with what asked for it."""
+    print(f"{Colors.RED}ERROR: {len(resolution.missing)} package(s)/dependencies cannot be satisfied "
+          f"from the package databases!{Colors.NC}")
+    for dep, required_by in resolution.missing:
+        via = resolution.pulled_by.get(required_by)
+        pulled = f", pulled in by {via}" if via and via != required_by else ''
+        print(f"{Colors.RED}  {dep} (required by {required_by}{pulled}){Colors.NC}")
 
 
 def download_packages_to_offline_mirror(repo_root: Path, profile_dir: Path, offline_mirror_dir: Path):
@@ -26,133 +34,20 @@ def download_packages_to_offline_mirror(repo_root: Path, profile_dir: Path, offl
     Args:
         repo_root: Root of the repository
         profile_dir: ISO profile directory
-        offline_mirror_dir: Directory where packages will be stored
+        offline_mirror_dir: Directory where packages will be stored (the
+            offline-mirror cache in the cache store)
         
     Returns:
         List of package names
     """
     print(f"{Colors.BLUE}Collecting package lists...{Colors.NC}")
     
-    # Collect all package lists
-    all_packages = set()
-    
-    # 1. ISO base packages (packages.x86_64)
-    packages_x86_64 = profile_dir / 'packages.x86_64'
-    if packages_x86_64.exists():
-        packages = read_package_list(packages_x86_64)
-        all_packages.update(packages)
-        print(f"{Colors.GREEN}  ✓ Read {len(packages)} packages from packages.x86_64{Colors.NC}")
-    
-    # 2. Homerchy base packages (deployment-relative path only)
-    homerchy_base = repo_root / 'install' / 'homerchy-base.packages'
-    if homerchy_base.exists():
-        packages = read_package_list(homerchy_base)
-        all_packages.update(packages)
-        print(f"{Colors.GREEN}  ✓ Read {len(packages)} packages from homerchy-base.packages{Colors.NC}")
-    
-    # 3. Homerchy other packages (deployment-relative path only)
-    homerchy_other = repo_root / 'install' / 'homerchy-other.packages'
-    if homerchy_other.exists():
-        packages = read_package_list(homerchy_other)
-        all_packages.update(packages)
-        print(f"{Colors.GREEN}  ✓ Read {len(packages)} packages from homerchy-other.packages{Colors.NC}")
-    
-    # 4. Archinstall packages (deployment-relative path only; single source for mirror and on-ISO)
-    archinstall_packages = repo_root / 'iso-builder' / 'builder' / 'archinstall.packages'
-    if archinstall_packages.exists():
-        packages = read_package_list(archinstall_packages)
-        all_packages.update(packages)
-        print(f"{Colors.GREEN}  ✓ Read {len(packages)} packages from archinstall.packages{Colors.NC}")
-    
-    # 5. Essential base system packages (always needed)
-    essential_packages = ['base', 'base-devel', 'linux', 'linux-firmware', 'linux-headers', 'syslinux']
-    all_packages.update(essential_packages)
-    print(f"{Colors.GREEN}  ✓ Added {len(essential_packages)} essential base packages{Colors.NC}")
-    
-    # 6. Filter out packages not available from Arch official repos (isoprep uses default pacman; no AUR/custom/homerchy-repo at build time)
-    # These are installed later on the target (AUR helper, homerchy repo, or post-install).
-    PACKAGES_SKIP_MIRROR = frozenset({
-        # AUR-only
-        'yay', 'yay-debug', 'spotify', 'typora', 'pinta', 'python-terminaltexteffects',
-        'tobi-try', 'ttf-ia-writer', 'ufw-docker', 'wayfreeze', 'xdg-terminal-exec',
-        'yaru-icon-theme', 'tzupdate',
-        # Custom / homerchy repo (omarchy-*)
-        'omarchy-keyring', 'omarchy-chromium', 'omarchy-nvim', 'omarchy-walker',
-        # Apple / custom hardware
-        'apple-bcm-firmware', 'apple-t2-audio-config', 'asdcontrol', 'gpu-screen-recorder',
-        'limine-mkinitcpio-hook', 'limine-snapper-sync', 'linux-t2', 'linux-t2-headers',
-        'macbook12-spi-driver-dkms', 't2fanrd', 'tiny-dfr',
-    })
-    all_packages_filtered = {p for p in all_packages if p not in PACKAGES_SKIP_MIRROR and not p.startswith('omarchy-')}
-    skipped = all_packages - all_packages_filtered
+    # Collect all package lists (minus packages not in the Arch repos)
+    package_list, skipped = collect_mirror_packages(repo_root, verbose=True)
     if skipped:
         print(f"{Colors.YELLOW}  Skipping {len(skipped)} packages not in Arch repos (AUR/custom/homerchy-repo): {', '.join(sorted(skipped)[:8])}{' ...' if len(skipped) > 8 else ''}{Colors.NC}")
-    package_list = sorted(all_packages_filtered)
     print(f"{Colors.BLUE}Total unique packages to download: {len(package_list)}{Colors.NC}")
     
-    # Restore cache from temp location if it exists (from cache_db_only cleanup)
-    work_dir = Path(os.environ.get('HOMERCHY_WORK_DIR', profile_dir.parent))
-    temp_cache_dir = Path("/mnt/work/.homerchy-cache-temp")
-    prepare_temp_cache = work_dir / 'offline-mirror-cache-temp'
-    
-    # Check if cache needs to be restored from temp locations
-    # Priority: system temp > prepare temp > normal location
-    cache_restored = False
-    
-    # Check system temp location first (from cache_db_only cleanup)
-    if temp_cache_dir.exists() and any(temp_cache_dir.glob('*.pkg.tar.*')):
-        temp_pkg_count = len(list(temp_cache_dir.glob('*.pkg.tar.*')))
-        normal_pkg_count = len(list(offline_mirror_dir.glob('*.pkg.tar.*'))) if offline_mirror_dir.exists() else 0
-        
-        # Restore if temp has packages and normal location has fewer or none
-        if temp_pkg_count > normal_pkg_count:
-            print(f"{Colors.BLUE}Restoring preserved cache from system temp location ({temp_pkg_count} packages)...{Colors.NC}")
-            offline_mirror_dir.parent.mkdir(parents=True, exist_ok=True)
-            # Remove existing cache directory if it exists and has fewer packages
-            if offline_mirror_dir.exists():
-                try:
-                    shutil.rmtree(offline_mirror_dir)
-                except PermissionError:
-                    subprocess.run(['sudo', 'rm', '-rf', str(offline_mirror_dir)], check=False)
-            try:
-                shutil.move(str(temp_cache_dir), str(offline_mirror_dir))
-            except PermissionError:
-                # Use sudo to move if permission denied
-                subprocess.run(['sudo', 'mv', str(temp_cache_dir), str(offline_mirror_dir)], check=True)
-            # Fix ownership of restored cache (may be owned by root if moved with sudo)
-            current_uid = os.getuid()
-            current_gid = os.getgid()
-            subprocess.run(['sudo', 'chown', '-R', f'{current_uid}:{current_gid}', str(offline_mirror_dir)], check=True)
-            print(f"{Colors.GREEN}✓ Restored preserved cache ({temp_pkg_count} packages){Colors.NC}")
-            cache_restored = True
-    
-    # Check prepare temp location (from prepare phase preservation)
-    if not cache_restored and prepare_temp_cache.exists() and any(prepare_temp_cache.glob('*.pkg.tar.*')):
-        prepare_pkg_count = len(list(prepare_temp_cache.glob('*.pkg.tar.*')))
-        normal_pkg_count = len(list(offline_mirror_dir.glob('*.pkg.tar.*'))) if offline_mirror_dir.exists() else 0
-        
-        # Restore if prepare temp has packages and normal location has fewer or none
-        if prepare_pkg_count > normal_pkg_count:
-            print(f"{Colors.BLUE}Restoring preserved cache from prepare temp location ({prepare_pkg_count} packages)...{Colors.NC}")
-            offline_mirror_dir.parent.mkdir(parents=True, exist_ok=True)
-            # Remove existing cache directory if it exists and has fewer packages
-            if offline_mirror_dir.exists():
-                try:
-                    shutil.rmtree(offline_mirror_dir)
-                except PermissionError:
-                    subprocess.run(['sudo', 'rm', '-rf', str(offline_mirror_dir)], check=False)
-            try:
-                shutil.move(str(prepare_temp_cache), str(offline_mirror_dir))
-            except PermissionError:
-                # Use sudo to move if permission denied
-                subprocess.run(['sudo', 'mv', str(prepare_temp_cache), str(offline_mirror_dir)], check=True)
-            # Fix ownership of restored cache (may be owned by root if moved with sudo)
-            current_uid = os.getuid()
-            current_gid = os.getgid()
-            subprocess.run(['sudo', 'chown', '-R', f'{current_uid}:{current_gid}', str(offline_mirror_dir)], check=True)
-            print(f"{Colors.GREEN}✓ Restored preserved cache ({prepare_pkg_count} packages){Colors.NC}")
-            cache_restored = True
-    
     # Ensure offline mirror directory exists
     offline_mirror_dir.mkdir(parents=True, exist_ok=True)
     
@@ -163,157 +58,75 @@ def download_packages_to_offline_mirror(repo_root: Path, profile_dir: Path, offl
     else:
         pacman_config_download = None  # fallback to system config
 
-    # Check for existing packages to avoid re-downloading (cache optimization)
-    print(f"{Colors.BLUE}Checking for existing packages in cache...{Colors.NC}")
-    
-    # Debug: Check all possible cache locations
-    print(f"{Colors.BLUE}  Checking cache locations:{Colors.NC}")
-    print(f"{Colors.BLUE}    Normal: {offline_mirror_dir} (exists: {offline_mirror_dir.exists()}){Colors.NC}")
-    if offline_mirror_dir.exists():
-        pkg_count = len(list(offline_mirror_dir.glob('*.pkg.tar.*')))
-        print(f"{Colors.BLUE}      Packages found: {pkg_count}{Colors.NC}")
-    print(f"{Colors.BLUE}    System temp: {temp_cache_dir} (exists: {temp_cache_dir.exists()}){Colors.NC}")
-    if temp_cache_dir.exists():
-        pkg_count = len(list(temp_cache_dir.glob('*.pkg.tar.*')))
-        print(f"{Colors.BLUE}      Packages found: {pkg_count}{Colors.NC}")
-    print(f"{Colors.BLUE}    Prepare temp: {prepare_temp_cache} (exists: {prepare_temp_cache.exists()}){Colors.NC}")
-    if prepare_temp_cache.exists():
-        pkg_count = len(list(prepare_temp_cache.glob('*.pkg.tar.*')))
-        print(f"{Colors.BLUE}      Packages found: {pkg_count}{Colors.NC}")
-    
-    existing_packages = set()
-    
-    # Also check for preserved cache in temp locations (from cache_db_only cleanup or prepare phase)
-    cache_locations = []
-    if offline_mirror_dir.exists():
-        cache_locations.append(offline_mirror_dir)
-    if temp_cache_dir.exists():
-        cache_locations.append(temp_cache_dir)
-        print(f"{Colors.BLUE}  Found preserved cache in system temp location, checking there too...{Colors.NC}")
-    if prepare_temp_cache.exists():
-        cache_locations.append(prepare_temp_cache)
-        print(f"{Colors.BLUE}  Found preserved cache in prepare temp location, checking there too...{Colors.NC}")
-    
-    if cache_locations:
-        # Get list of existing package files from all cache locations (excluding .sig files)
-        existing_files = []
-        for cache_location in cache_locations:
-            if cache_location.exists():
-                existing_files.extend([f for f in cache_location.glob('*.pkg.tar.*') if not f.name.endswith('.sig')])
-        
-        # Extract package names from existing files using repo-query (most reliable)
-        # or filename parsing (fallback)
-        existing_package_names = set()
-        if shutil.which('repo-query'):
-            for existing_file in existing_files:
-                result = subprocess.run(
-                    ['repo-query', '-f', '%n', str(existing_file)],
-                    capture_output=True,
-                    text=True
-                )
-                if result.returncode == 0 and result.stdout.strip():
-                    existing_package_names.add(result.stdout.strip())
-        else:
-            # Fallback: parse filenames (less reliable, may miss packages with dashes in version)
-            for existing_file in existing_files:
-                # Remove .pkg.tar.zst or .pkg.tar.xz extension
-                base_name = existing_file.name
-                if base_name.endswith('.pkg.tar.zst'):
-                    base_name = base_name[:-13]
-                elif base_name.endswith('.pkg.tar.xz'):
-                    base_name = base_name[:-11]
-                # Format: name-version-release-arch
-                # Split by '-'' and assume last 3 parts are version-release-arch
-                parts = base_name.split('-')
-                if len(parts) >= 4:
-                    pkg_name = '-'.join(parts[:-3])
-                    existing_package_names.add(pkg_name)
+    # Resolve the full dependency closure against what the cache already holds
+    print(f"{Colors.BLUE}Resolving dependency closure against the cache...{Colors.NC}")
+    existing_files = [f for f in offline_mirror_dir.glob('*.pkg.tar.*') if not f.name.endswith('.sig')]
+    print(f"{Colors.BLUE}  Cache: {offline_mirror_dir} ({len(existing_files)} package files){Colors.NC}")
+    
+    # Cached packages by name, from each file's .PKGINFO (package index: one stat pass when warm)
+    cached = package_index(offline_mirror_dir).names()
+    resolution = resolve_closure(package_list, [('cache', cached)])
+    delta = []
+    
+    # Count existing package files BEFORE downloading (to detect if new files are created)
+    files_before = {f.name for f in offline_mirror_dir.glob('*.pkg.tar.*')}
+    package_files_before = {name for name in files_before if not name.endswith('.sig')}
+    
+    if resolution.missing:
+        # Something is not cached: resolve again with the package databases behind the cache.
+        # Cached packages still win wherever their versions satisfy, so only the delta is fetched.
+        conf_path = Path(pacman_config_download or '/etc/pacman.conf')
+        conf = read_pacman_conf(conf_path)
+        sync_db_dir = CacheStore().path('sync-db')
+        try:
+            refreshed = [name for name, fresh in sync_databases(conf, sync_db_dir).items() if fresh]
+        except FetchError as e:
+            print(f"{Colors.RED}ERROR: Could not sync package databases: {e}{Colors.NC}")
+            sys.exit(1)
+        print(f"{Colors.GREEN}✓ Package databases {'refreshed: ' + ', '.join(refreshed) if refreshed else 'up to date'}{Colors.NC}")
         
-        # Match package names exactly (not by prefix)
-        for pkg_name in package_list:
-            if pkg_name in existing_package_names:
-                existing_packages.add(pkg_name)
-    
-    # Filter out packages that already exist
-    packages_to_download = [pkg for pkg in package_list if pkg not in existing_packages]
-    
-    if existing_packages:
-        print(f"{Colors.GREEN}✓ Found {len(existing_packages)} packages in cache (skipping download){Colors.NC}")
-    
-    # Count existing package files BEFORE running pacman (to detect if new files are created)
-    package_files_before = set()
-    if offline_mirror_dir.exists():
-        package_files_before = {f.name for f in offline_mirror_dir.glob('*.pkg.tar.*') if not f.name.endswith('.sig')}
-    
-    # Initialize temp_db_dir (may or may not be created depending on whether we download)
-    temp_db_dir = Path('/tmp/homerchy-offline-db')
-    
-    if packages_to_download:
-        print(f"{Colors.BLUE}Downloading {len(packages_to_download)} missing packages...{Colors.NC}")
+        sources = [('cache', cached)] + list(read_sync_dbs(sync_db_dir, conf.repos).items())
+        resolution = resolve_closure(package_list, sources)
+        if resolution.missing:
+            _report_missing(resolution)
+            sys.exit(1)
+        delta = [pkg for name, (source, pkg) in sorted(resolution.packages.items()) if source != 'cache']
+    
+    reused = len(resolution.packages) - len(delta)
+    print(f"{Colors.GREEN}✓ Dependency closure: {len(resolution.packages)} packages "
+          f"({len(resolution.packages) - len(resolution.required_by)} listed, "
+          f"{len(resolution.required_by)} dependencies), {reused} in cache{Colors.NC}")
+    
+    if delta:
+        total = sum(pkg.csize for pkg in delta)
+        print(f"{Colors.BLUE}Downloading {len(delta)} missing packages ({total / 1024 / 1024:.1f} MiB) "
+              f"over {min(len(delta), conf.parallel_downloads)} connections...{Colors.NC}")
+        for pkg in delta:
+            via = resolution.pulled_by[pkg.name]
+            reason = f" (pulled in by {via})" if via != pkg.name else ''
+            print(f"{Colors.BLUE}  + {pkg.repo}/{pkg.name} {pkg.version}{reason}{Colors.NC}")
         print(f"{Colors.BLUE}This may take a while depending on your connection speed...{Colors.NC}")
-
-        # Ensure cache directory exists before pacman tries to use it
-        offline_mirror_dir.mkdir(parents=True, exist_ok=True)
-
-        # Create temporary database directory for pacman
-        temp_db_dir.mkdir(parents=True, exist_ok=True)
-
-        # Clean up any existing pacman database locks from previous failed builds
-        # Clean both system database lock and custom database lock
-        import time
-        subprocess.run(['sudo', 'rm', '-f', '/var/lib/pacman/db.lck'], check=False)
-        subprocess.run(['sudo', 'rm', '-f', str(temp_db_dir / 'db.lck')], check=False)
-        time.sleep(0.5)  # Small delay to ensure lock files are fully released
-
-        # Sync and download using Arch-only config so [omarchy]/[arch-mact2] are not required.
-        sync_cmd = ['sudo', 'pacman', '-Sy', '--noconfirm', '--ask=0', '--dbpath', str(temp_db_dir)]
-        if pacman_config_download:
-            sync_cmd.extend(['--config', pacman_config_download])
-        subprocess.run(['sudo', 'rm', '-f', '/var/lib/pacman/db.lck'], check=False)
-        subprocess.run(['sudo', 'rm', '-f', str(temp_db_dir / 'db.lck')], check=False)
-        time.sleep(0.2)
-        sync_result = subprocess.run(sync_cmd, check=False, capture_output=True)
-        if sync_result.returncode != 0:
-            print(f"{Colors.YELLOW}WARNING: Database sync failed, but continuing anyway...{Colors.NC}")
-
-        pacman_cmd = ['sudo', 'pacman', '-Sw', '--noconfirm', '--ask=0', '--cachedir', str(offline_mirror_dir), '--dbpath', str(temp_db_dir)]
-        if pacman_config_download:
-            pacman_cmd.extend(['--config', pacman_config_download])
-        pacman_cmd.extend(packages_to_download)
         
-        # Clean locks one more time right before execution
-        subprocess.run(['sudo', 'rm', '-f', '/var/lib/pacman/db.lck'], check=False)
-        subprocess.run(['sudo', 'rm', '-f', str(temp_db_dir / 'db.lck')], check=False)
-        time.sleep(0.2)
-        
-        # Run pacman to download packages (requires sudo)
-        # Show output in real-time so user can see progress
-        print(f"{Colors.BLUE}Running pacman with sudo to download packages...{Colors.NC}")
-        print(f"{Colors.BLUE}This will show progress as packages are downloaded...{Colors.NC}")
-        print(f"{Colors.YELLOW}Note: You may be prompted for your sudo password{Colors.NC}")
-        print()
-        
-        result = subprocess.run(pacman_cmd, stdout=sys.stdout, stderr=subprocess.PIPE, text=True)
-        
-        if result.returncode != 0:
+        targets = [FetchTarget(pkg.filename, pkg.repo, pkg.sha256, pkg.csize) for pkg in delta]
+        try:
+            result = fetch_packages(targets, conf, offline_mirror_dir)
+        except FetchError as e:
+            print(f"{Colors.RED}ERROR: Cannot download packages: {e}{Colors.NC}")
+            sys.exit(1)
+        if result.failed:
             print()
-            print(f"{Colors.RED}ERROR: Package download failed with exit code {result.returncode}!{Colors.NC}")
-            if result.stderr:
-                print(f"{Colors.RED}Pacman stderr output:{Colors.NC}")
-                print(result.stderr)
+            print(f"{Colors.RED}ERROR: {len(result.failed)} package(s) could not be downloaded!{Colors.NC}")
+            for filename, reason in sorted(result.failed.items()):
+                print(f"{Colors.RED}  {filename}: {reason}{Colors.NC}")
+            print(f"{Colors.YELLOW}Partial downloads are kept and resume on the next build{Colors.NC}")
             sys.exit(1)
-        
-        # Clean up temporary database (may be owned by root)
-        if temp_db_dir.exists():
-            try:
-                shutil.rmtree(temp_db_dir)
-            except PermissionError:
-                # If owned by root, use sudo to remove
-                subprocess.run(['sudo', 'rm', '-rf', str(temp_db_dir)], check=False)
+        resumed = f", {result.resumed} resumed" if result.resumed else ''
+        print(f"{Colors.GREEN}✓ Fetched {len(result.fetched)} package files "
+              f"({result.bytes / 1024 / 1024:.1f} MiB in {result.wall:.1f}s{resumed}){Colors.NC}")
     else:
         print(f"{Colors.GREEN}✓ All packages already cached, skipping download{Colors.NC}")
     
-    # Check if new package files were actually created (pacman might skip if already in cache)
+    # Check if new package files were actually created (dependencies may all be cached already)
     package_files_after = set()
     if offline_mirror_dir.exists():
         package_files_after = {f.name for f in offline_mirror_dir.glob('*.pkg.tar.*') if not f.name.endswith('.sig')}
@@ -323,20 +136,12 @@ def download_packages_to_offline_mirror(repo_root: Path, profile_dir: Path, offl
     new_files_created = package_files_after - package_files_before
     packages_were_downloaded = len(new_files_created) > 0
     
+    count('package_management/packages_reused', reused)
+    count('package_management/packages_downloaded', len(new_files_created))
+    count('package_management/bytes_downloaded',
+          sum((offline_mirror_dir / name).stat().st_size for name in new_files_created))
     if packages_were_downloaded:
         print(f"{Colors.BLUE}✓ Actually downloaded {len(new_files_created)} new package files{Colors.NC}")
-    elif packages_to_download:
-        print(f"{Colors.BLUE}✓ Pacman skipped download (packages already in cache){Colors.NC}")
-    
-    # Fix ownership of downloaded packages (pacman creates them as root)
-    # Get current user and group
-    current_uid = os.getuid()
-    current_gid = os.getgid()
-    
-    # Change ownership of downloaded packages to current user
-    if offline_mirror_dir.exists():
-        print(f"{Colors.BLUE}Fixing ownership of downloaded packages...{Colors.NC}")
-        subprocess.run(['sudo', 'chown', '-R', f'{current_uid}:{current_gid}', str(offline_mirror_dir)], check=True)
     
     # Count total package files in cache (exclude .sig signature files)
     all_files = list(offline_mirror_dir.glob('*.pkg.tar.*'))
@@ -346,12 +151,4 @@ def download_packages_to_offline_mirror(repo_root: Path, profile_dir: Path, offl
     if sig_files:
         print(f"{Colors.GREEN}✓ Total {len(sig_files)} signature files in cache{Colors.NC}")
     
-    # Clean up temporary database (may be owned by root)
-    if temp_db_dir.exists():
-        try:
-            shutil.rmtree(temp_db_dir)
-        except PermissionError:
-            # If owned by root, use sudo to remove
-            subprocess.run(['sudo', 'rm', '-rf', str(temp_db_dir)], check=False)
-    
     return package_list, packages_were_downloaded
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Downloader Self-Test
+Copyright (C) 2024 HOMESERVER LLC
+
+Runs fetch.py against local HTTP servers standing in for mirrors (no network,
+no root, no keyring; signatures are off, SigLevel = Never):
+
+    - a partial download resumes with a range request and is completed
+    - a sha256 mismatch fails the package and drops the partial file, so the
+      next attempt starts over
+    - a failing mirror falls back to the next one, also for a whole batch
+      spread round-robin over both
+
+    python3 deployment/iso-builder/isoprep/index/package_management/fetch_selftest.py
+"""
+
+import hashlib
+import os
+import re
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Add utils and the phase package to path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from utils import Colors
+from utils.sync_db import PacmanConf, Repo
+from package_management.fetch import (
+    ConnectionPool, FetchError, FetchTarget, SignatureCheck, fetch_one, fetch_packages
+)
+
+PACKAGE_SIZE = 600 * 1024   # a few read chunks
+PARTIAL = 200 * 1024
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """Serves the server's root with Range support, or fails every request if broken."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('Range')))
+        if self.server.broken:
+            self._reply(503)
+            return
+        path = self.server.root / self.path.lstrip('/')
+        if not path.is_file():
+            self._reply(404)
+            return
+        data = path.read_bytes()
+        match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range') or '')
+        if not match:
+            self._reply(200, data)
+            return
+        start = int(match.group(1))
+        if start >= len(data):
+            self._reply(416, headers={'Content-Range': f'bytes */{len(data)}'})
+            return
+        self._reply(206, data[start:],
+                    {'Content-Range': f'bytes {start}-{len(data) - 1}/{len(data)}'})
+
+    def _reply(self, status: int, body: bytes = b'', headers: dict = None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mirror(root: Path, broken: bool = False) -> ThreadingHTTPServer:
+    """Serve root on a free localhost port in a background thread."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MirrorHandler)
+    server.root, server.broken, server.requests = root, broken, []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def url_of(server: ThreadingHTTPServer) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def check(condition: bool, message: str) -> None:
+    if not condition:
+        raise AssertionError(message)
+    print(f"{Colors.GREEN}✓ {message}{Colors.NC}")
+
+
+def run(scratch: Path) -> None:
+    """Run every check with mirrors and destinations below scratch."""
+    served = scratch / 'mirror'
+    served.mkdir()
+    packages = {}
+    for name in ('alpha-1.0-1-x86_64.pkg.tar.zst', 'beta-2.0-1-x86_64.pkg.tar.zst'):
+        data = os.urandom(PACKAGE_SIZE)
+        (served / name).write_bytes(data)
+        packages[name] = FetchTarget(name, 'core', hashlib.sha256(data).hexdigest(), len(data))
+    alpha = packages['alpha-1.0-1-x86_64.pkg.tar.zst']
+
+    good = start_mirror(served)
+    broken = start_mirror(served, broken=True)
+    never = SignatureCheck(['Never'])
+    pool = ConnectionPool(timeout=5)
+    try:
+        # Resume: half a download is on disk; only the rest is requested
+        dest = scratch / 'resume'
+        dest.mkdir()
+        part = dest / f'.{alpha.filename}.part'
+        part.write_bytes((served / alpha.filename).read_bytes()[:PARTIAL])
+        transferred, resumed, _ = fetch_one(pool, [f"{url_of(good)}/{alpha.filename}"], dest, alpha, never)
+        check(resumed and transferred == PACKAGE_SIZE - PARTIAL,
+              f"partial download resumed ({transferred} of {PACKAGE_SIZE} bytes transferred)")
+        check((f'/{alpha.filename}', f'bytes={PARTIAL}-') in good.requests,
+              f"mirror saw a range request from byte {PARTIAL}")
+        check((dest / alpha.filename).read_bytes() == (served / alpha.filename).read_bytes() and not part.exists(),
+              "resumed file matches the mirror and the partial file is gone")
+
+        # sha256 mismatch: a corrupt partial file is rejected and dropped
+        dest = scratch / 'mismatch'
+        dest.mkdir()
+        part = dest / f'.{alpha.filename}.part'
+        part.write_bytes(os.urandom(PARTIAL))
+        try:
+            fetch_one(pool, [f"{url_of(good)}/{alpha.filename}"], dest, alpha, never)
+            failure = ''
+        except FetchError as e:
+            failure = str(e)
+        check('sha256 mismatch' in failure and not (dest / alpha.filename).exists(),
+              f"corrupt download rejected ({failure})")
+        check(not part.exists(), "rejected partial file removed")
+        _, resumed, _ = fetch_one(pool, [f"{url_of(good)}/{alpha.filename}"], dest, alpha, never)
+        check(not resumed and (dest / alpha.filename).exists(), "next attempt downloads from the start")
+
+        wrong = FetchTarget(alpha.filename, 'core', '0' * 64, alpha.size)
+        try:
+            fetch_one(pool, [f"{url_of(good)}/{alpha.filename}"], scratch, wrong, never)
+            failure = ''
+        except FetchError as e:
+            failure = str(e)
+        check('sha256 mismatch' in failure and not (scratch / alpha.filename).exists(),
+              "file not matching the sync database's sha256 is refused")
+
+        # Mirror fallback: the broken mirror is tried first, the good one delivers
+        dest = scratch / 'fallback'
+        dest.mkdir()
+        broken.requests.clear()
+        _, _, host = fetch_one(pool, [f"{url_of(broken)}/{alpha.filename}", f"{url_of(good)}/{alpha.filename}"],
+                               dest, alpha, never)
+        check(host == f"127.0.0.1:{good.server_address[1]}" and broken.requests,
+              f"failing mirror skipped, file fetched from {host}")
+
+        dest = scratch / 'batch'
+        dest.mkdir()
+        conf = PacmanConf(arch='x86_64', parallel_downloads=2, sig_level=['Never'],
+                          repos=[Repo('core', [url_of(broken), url_of(good)])])
+        result = fetch_packages(list(packages.values()), conf, dest)
+        check(sorted(result.fetched) == sorted(packages) and not result.failed,
+              "batch spread over a failing and a working mirror completes")
+
+        conf = PacmanConf(arch='x86_64', parallel_downloads=2, sig_level=['Never'],
+                          repos=[Repo('core', [url_of(broken)])])
+        (scratch / 'batch-failed').mkdir()
+        result = fetch_packages([alpha], conf, scratch / 'batch-failed')
+        check(alpha.filename in result.failed, f"every mirror failing is reported ({result.failed.get(alpha.filename)})")
+    finally:
+        pool.close()
+        for server in (good, broken):
+            server.shutdown()
+            server.server_close()
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory(prefix='fetch-selftest-') as scratch:
+        try:
+            run(Path(scratch))
+        except (AssertionError, FetchError, OSError) as e:
+            print(f"{Colors.RED}✗ {e}{Colors.NC}", file=sys.stderr)
+            sys.exit(1)
+    print(f"{Colors.GREEN}Downloader self-test passed{Colors.NC}")
+
+
+if __name__ == '__main__':
+    main()
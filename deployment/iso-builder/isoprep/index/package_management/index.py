@@ -8,12 +8,11 @@ Package download and repository creation phase orchestrator.
 
 import sys
 from pathlib import Path
-import os
 
 # Add parent directory to path for utils
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from utils import Colors
+from utils import CacheStore, Colors, profile_step
 from .download import download_packages_to_offline_mirror
 from .repository import create_offline_repository
 
@@ -32,18 +31,27 @@ def main(phase_path: Path, config: dict) -> dict:
     
     # Get paths from parent config
     repo_root = Path(config.get('repo_root', Path(phase_path).parent.parent.parent))
-    # Use environment variable if set, otherwise fall back to config or default
-    work_dir = Path(os.environ.get('HOMERCHY_WORK_DIR', config.get('work_dir', '/mnt/work/homerchy-deployment/deployment/isoprep-work')))
+    # Work directory resolved by the orchestrator (BuildConfig.work_dir or index.json)
+    work_dir = Path(config.get('work_dir', '/mnt/work/homerchy-deployment/deployment/isoprep-work'))
     profile_dir = Path(config.get('profile_dir', work_dir / 'profile'))
     cache_dir = profile_dir / 'airootfs' / 'var' / 'cache' / 'homerchy' / 'mirror' / 'offline'
+    # Packages and the repository database live in the cache store; the profile gets a view
+    store = CacheStore()
+    mirror_dir = store.path('offline-mirror')
     
     # Download packages to offline mirror
     print(f"{Colors.BLUE}Preparing offline package mirror...{Colors.NC}")
-    package_list, packages_were_downloaded = download_packages_to_offline_mirror(repo_root, profile_dir, cache_dir)
+    with profile_step('package_management/download_packages_to_offline_mirror'):
+        package_list, packages_were_downloaded = download_packages_to_offline_mirror(repo_root, profile_dir, mirror_dir)
     
     # Create offline repository database
     # Force regeneration if new packages were downloaded
-    create_offline_repository(cache_dir, force_regenerate=packages_were_downloaded)
+    with profile_step('package_management/create_offline_repository'):
+        create_offline_repository(mirror_dir, force_regenerate=packages_were_downloaded)
+    
+    # Expose the mirror in the profile (reflink, hardlink farm or copy; nothing is moved)
+    with profile_step('package_management/expose_offline_mirror'):
+        store.expose('offline-mirror', cache_dir)
     
     print(f"{Colors.GREEN}✓ Package management phase complete{Colors.NC}")
     
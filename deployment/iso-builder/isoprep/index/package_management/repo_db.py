@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Repository Database Writer
+Copyright (C) 2024 HOMESERVER LLC
+
+Incremental replacement for `repo-add --new`. The entries of the current
+database (desc and files of every package, read back from the .files
+tarball) are kept as they are; only packages added to or removed from the
+mirror change. New packages are hashed and listed in a process pool, and
+their metadata comes from the package index (.PKGINFO, utils.package_index).
+
+Output matches repo-add's layout:
+
+    offline.db.tar.gz     <name>-<version>/desc
+    offline.files.tar.gz  <name>-<version>/desc, <name>-<version>/files
+    offline.db, offline.files                 -> the tarballs
+    omarchy.db.tar.gz, omarchy.files.tar.gz   -> the offline tarballs
+    omarchy.db, omarchy.files, homerchy.db, homerchy.files -> the omarchy tarballs
+
+    offline.db.fingerprint  name, size and mtime of every package the database
+                          was written for, and of the database tarballs
+
+Every file is written to a temporary name and renamed into place. While the
+mirror matches the fingerprint, checking the database costs one directory
+listing: no archive is opened.
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Add utils to path
+sys.path.insert(0, str(Path(__file__).parent.parent.parent))
+
+from utils import PackageInfo, is_package_file, open_package, package_index
+
+DB_NAME = 'offline'
+# Alias -> target, created in this order (pacman.conf names the repos [omarchy] and [homerchy])
+ALIASES = (
+    ('offline.db', 'offline.db.tar.gz'),
+    ('offline.files', 'offline.files.tar.gz'),
+    ('omarchy.db.tar.gz', 'offline.db.tar.gz'),
+    ('omarchy.files.tar.gz', 'offline.files.tar.gz'),
+    ('omarchy.db', 'omarchy.db.tar.gz'),
+    ('omarchy.files', 'omarchy.files.tar.gz'),
+    ('homerchy.db', 'omarchy.db.tar.gz'),
+    ('homerchy.files', 'omarchy.files.tar.gz'),
+)
+FINGERPRINT_NAME = f'{DB_NAME}.db.fingerprint'
+FINGERPRINT_VERSION = 1
+MAX_SIG_SIZE = 16384        # repo-add skips larger signature files
+HASH_CHUNK = 1024 * 1024
+
+
+@dataclass
+class RepoEntry:
+    """One package of the database: its directory name and the desc/files texts."""
+    filename: str
+    dirname: str
+    csize: int
+    desc: str
+    files: str = ''
+
+
+@dataclass
+class RepoUpdate:
+    """What an update changed (empty lists: the database was already current)."""
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    kept: int = 0
+    wall: float = 0.0
+    stale: Optional['FingerprintCheck'] = None     # why the fingerprint did not match
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.removed)
+
+
+@dataclass
+class FingerprintCheck:
+    """Mirror listing compared with the fingerprint of the database."""
+    valid: bool
+    reason: str = ''
+    added: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    changed: List[str] = field(default_factory=list)
+
+
+Listing = Dict[str, Tuple[int, int]]
+
+
+def mirror_listing(mirror_dir: Path) -> Listing:
+    """(size, mtime_ns) of every package archive in mirror_dir, by file name."""
+    listing = {}
+    with os.scandir(mirror_dir) as it:
+        for entry in it:
+            if is_package_file(entry.name):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                listing[entry.name] = (st.st_size, st.st_mtime_ns)
+    return listing
+
+
+def _stat_pair(path: Path) -> Optional[List[int]]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def check_fingerprint(mirror_dir: Path, listing: Listing) -> FingerprintCheck:
+    """
+    Compare a mirror listing with the fingerprint the database was written with.
+
+    Args:
+        mirror_dir: Directory holding the packages and the database
+        listing: mirror_listing() of it
+
+    Returns:
+        FingerprintCheck; when invalid, which packages were added, removed or changed
+    """
+    try:
+        with open(mirror_dir / FINGERPRINT_NAME, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return FingerprintCheck(False, 'no fingerprint')
+    if not isinstance(data, dict) or data.get('version') != FINGERPRINT_VERSION:
+        return FingerprintCheck(False, 'fingerprint from another version')
+    for name, recorded in data.get('databases', {}).items():
+        if _stat_pair(mirror_dir / name) != recorded:
+            return FingerprintCheck(False, f'{name} changed since it was written')
+
+    recorded = {name: tuple(pair) for name, pair in data.get('packages', {}).items()}
+    check = FingerprintCheck(
+        valid=recorded == listing,
+        added=sorted(set(listing) - set(recorded)),
+        removed=sorted(set(recorded) - set(listing)),
+        changed=sorted(name for name in set(listing) & set(recorded) if listing[name] != recorded[name]),
+    )
+    if not check.valid:
+        check.reason = 'packages changed'
+    return check
+
+
+def write_fingerprint(mirror_dir: Path, listing: Listing) -> None:
+    """Record the listing the database was just written for (and the database files' own stat)."""
+    data = {
+        'version': FINGERPRINT_VERSION,
+        'databases': {name: _stat_pair(mirror_dir / name)
+                      for name in (f'{DB_NAME}.db.tar.gz', f'{DB_NAME}.files.tar.gz')},
+        'packages': {name: list(pair) for name, pair in sorted(listing.items())},
+    }
+    path = mirror_dir / FINGERPRINT_NAME
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+
+def _fields(desc: str) -> Dict[str, List[str]]:
+    """Sections of a desc file (%KEY% followed by one value per line)."""
+    fields, key = {}, None
+    for line in desc.splitlines():
+        if line.startswith('%') and line.endswith('%') and len(line) > 2:
+            key = line[1:-1]
+            fields[key] = []
+        elif line and key:
+            fields[key].append(line)
+    return fields
+
+
+def load_entries(files_db: Path) -> Dict[str, RepoEntry]:
+    """
+    Entries of an existing .files database, by package file name.
+
+    Args:
+        files_db: offline.files.tar.gz
+
+    Returns:
+        RepoEntry by file name (empty if the database is missing or unreadable)
+    """
+    texts: Dict[str, Dict[str, str]] = {}
+    try:
+        with tarfile.open(files_db, mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile() or member.name.count('/') != 1:
+                    continue
+                dirname, name = member.name.split('/')
+                if name in ('desc', 'files'):
+                    texts.setdefault(dirname, {})[name] = \
+                        tar.extractfile(member).read().decode('utf-8', errors='replace')
+    except (OSError, EOFError, tarfile.TarError):
+        return {}
+    entries = {}
+    for dirname, parts in texts.items():
+        fields = _fields(parts.get('desc', ''))
+        filename = (fields.get('FILENAME') or [''])[0]
+        try:
+            csize = int((fields.get('CSIZE') or ['-1'])[0])
+        except ValueError:
+            csize = -1
+        if filename and 'files' in parts:
+            entries[filename] = RepoEntry(filename, dirname, csize, parts['desc'], parts['files'])
+    return entries
+
+
+def package_digest(path: str) -> Tuple[str, str, str, List[str]]:
+    """
+    Checksums, signature and file list of one package (runs in a worker process).
+
+    Args:
+        path: Package archive
+
+    Returns:
+        (md5, sha256, base64 PGP signature or '', sorted file list)
+    """
+    md5, sha256 = hashlib.md5(), hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+
+    pgpsig = ''
+    try:
+        sig = Path(path + '.sig')
+        if sig.stat().st_size <= MAX_SIG_SIZE:
+            pgpsig = base64.b64encode(sig.read_bytes()).decode('ascii')
+    except OSError:
+        pass
+
+    files = []
+    with open_package(path) as tar:
+        for member in tar:
+            name = member.name[2:] if member.name.startswith('./') else member.name
+            if not name or name.startswith('.'):
+                continue
+            files.append(name + '/' if member.isdir() else name)
+    return md5.hexdigest(), sha256.hexdigest(), pgpsig, sorted(files)
+
+
+def _section(key: str, values) -> str:
+    values = [str(v) for v in values if v not in ('', None)]
+    return f"%{key}%\n" + ''.join(f"{v}\n" for v in values) + "\n" if values else ''
+
+
+def render_desc(info: PackageInfo, md5: str, sha256: str, pgpsig: str) -> str:
+    """desc of one package, in repo-add's field order."""
+    return ''.join([
+        _section('FILENAME', [info.filename]),
+        _section('NAME', [info.name]),
+        _section('BASE', [info.base]),
+        _section('VERSION', [info.version]),
+        _section('DESC', [info.desc]),
+        _section('GROUPS', info.groups),
+        _section('CSIZE', [info.size]),
+        _section('ISIZE', [info.isize]),
+        _section('MD5SUM', [md5]),
+        _section('SHA256SUM', [sha256]),
+        _section('PGPSIG', [pgpsig]),
+        _section('URL', [info.url]),
+        _section('LICENSE', info.licenses),
+        _section('ARCH', [info.arch]),
+        _section('BUILDDATE', [info.builddate or '']),
+        _section('PACKAGER', [info.packager]),
+        _section('REPLACES', info.replaces),
+        _section('CONFLICTS', info.conflicts),
+        _section('PROVIDES', info.provides),
+        _section('DEPENDS', info.depends),
+        _section('OPTDEPENDS', info.optdepends),
+        _section('MAKEDEPENDS', info.makedepends),
+        _section('CHECKDEPENDS', info.checkdepends),
+    ])
+
+
+def _write_tarball(path: Path, entries: List[RepoEntry], with_files: bool) -> None:
+    """Write a gzip'd database tarball atomically."""
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    now = int(time.time())
+    try:
+        with tarfile.open(tmp, mode='w:gz', compresslevel=6, format=tarfile.GNU_FORMAT) as tar:
+            for entry in sorted(entries, key=lambda e: e.dirname):
+                info = tarfile.TarInfo(entry.dirname)
+                info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0o755, now
+                tar.addfile(info)
+                members = [('desc', entry.desc)] + ([('files', entry.files)] if with_files else [])
+                for name, text in members:
+                    data = text.encode('utf-8')
+                    info = tarfile.TarInfo(f'{entry.dirname}/{name}')
+                    info.size, info.mode, info.mtime = len(data), 0o644, now
+                    tar.addfile(info, io.BytesIO(data))
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _place_alias(path: Path, target: str) -> None:
+    """Point path at target (a symlink, or a copy where symlinks are unsupported), atomically."""
+    try:
+        if path.is_symlink() and os.readlink(path) == target:
+            return
+    except OSError:
+        pass
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        os.symlink(target, tmp)
+    except OSError:
+        shutil.copy2(path.parent / target, tmp)
+    os.replace(tmp, path)
+
+
+def update_repository(mirror_dir: Path, jobs: Optional[int] = None) -> RepoUpdate:
+    """
+    Bring the offline repository database in line with the packages in mirror_dir.
+
+    If the mirror still matches the fingerprint of the database, nothing is
+    read. Otherwise packages whose file is still present with the same size
+    keep their entries; new ones are hashed and listed in a process pool, and
+    entries of vanished packages are dropped. If a package has several files
+    in the mirror, the one with the highest version is listed.
+
+    Args:
+        mirror_dir: Directory holding the packages and the database
+        jobs: Worker processes (default: CPU count)
+
+    Returns:
+        RepoUpdate with the added and removed file names
+
+    Raises:
+        OSError: If the database cannot be written
+    """
+    start = time.monotonic()
+    db_path = mirror_dir / f'{DB_NAME}.db.tar.gz'
+    files_path = mirror_dir / f'{DB_NAME}.files.tar.gz'
+
+    listing = mirror_listing(mirror_dir)
+    check = check_fingerprint(mirror_dir, listing)
+    if check.valid:
+        for alias, target in ALIASES:
+            _place_alias(mirror_dir / alias, target)
+        return RepoUpdate(kept=len(listing), wall=time.monotonic() - start)
+
+    current = {info.filename: info for info in package_index(mirror_dir).names().values()}
+    existing = load_entries(files_path) if db_path.exists() else {}
+
+    update = RepoUpdate(stale=check)
+    entries: Dict[str, RepoEntry] = {}
+    for filename, entry in existing.items():
+        info = current.get(filename)
+        if info is not None and info.size == entry.csize:
+            entries[filename] = entry
+        else:
+            update.removed.append(filename)
+    update.removed.sort()
+    update.added = sorted(filename for filename in current if filename not in entries)
+    update.kept = len(entries)
+
+    if update.added:
+        paths = [str(mirror_dir / filename) for filename in update.added]
+        workers = max(1, min(len(paths), jobs or os.cpu_count() or 1))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for filename, (md5, sha256, pgpsig, files) in zip(update.added, pool.map(package_digest, paths)):
+                info = current[filename]
+                entries[filename] = RepoEntry(
+                    filename=filename,
+                    dirname=f'{info.name}-{info.version}',
+                    csize=info.size,
+                    desc=render_desc(info, md5, sha256, pgpsig),
+                    files='%FILES%\n' + ''.join(f'{name}\n' for name in files),
+                )
+
+    if update.changed or not (db_path.exists() and files_path.exists()):
+        _write_tarball(db_path, list(entries.values()), with_files=False)
+        _write_tarball(files_path, list(entries.values()), with_files=True)
+    write_fingerprint(mirror_dir, listing)
+    for alias, target in ALIASES:
+        _place_alias(mirror_dir / alias, target)
+    update.wall = time.monotonic() - start
+    return update
@@ -6,14 +6,16 @@ Copyright (C) 2024 HOMESERVER LLC
 ISO profile assembly phase orchestrator.
 """
 
-import subprocess
 import sys
 from pathlib import Path
 
 # Add parent directory to path for utils
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
-from utils import Colors
+from utils import (
+    CacheStore, Colors, profile_step, run_dag, sudo_mkdir, sudo_rmtree, sudo_symlink, sudo_unlink,
+    with_dependents
+)
 from .releng import copy_releng_config, cleanup_reflector
 from .overlays import apply_custom_overlays, adjust_vm_boot_timeout
 from .source_injection import inject_repository_source, inject_vm_profile, customize_package_list, fix_permissions_targets
@@ -40,22 +42,22 @@ def create_system_mirror_symlink(profile_dir: Path, cache_dir: Path):
     # Create parent directories with sudo (requires root permissions)
     system_mirror_parent = system_mirror_dir.parent
     print(f"{Colors.BLUE}Creating system mirror directory structure with sudo...{Colors.NC}")
-    subprocess.run(['sudo', 'mkdir', '-p', str(system_mirror_parent)], check=True)
+    sudo_mkdir(system_mirror_parent, check=True)
     
     # Remove existing symlink or directory if it exists
     if system_mirror_dir.exists() or system_mirror_dir.is_symlink():
         print(f"{Colors.BLUE}Removing existing symlink/directory...{Colors.NC}")
         if system_mirror_dir.is_symlink():
-            subprocess.run(['sudo', 'rm', '-f', str(system_mirror_dir)], check=False)
+            sudo_unlink(system_mirror_dir, check=False)
         else:
             # If it's a directory, we need sudo to remove it
-            subprocess.run(['sudo', 'rm', '-rf', str(system_mirror_dir)], check=False)
+            sudo_rmtree(system_mirror_dir, check=False)
     
     # Create symlink from system location to profile directory
     # Use absolute path for the symlink target
     cache_dir_absolute = cache_dir.resolve()
     print(f"{Colors.BLUE}Creating symlink with sudo: {system_mirror_dir} -> {cache_dir_absolute}{Colors.NC}")
-    subprocess.run(['sudo', 'ln', '-sf', str(cache_dir_absolute), str(system_mirror_dir)], check=True)
+    sudo_symlink(cache_dir_absolute, system_mirror_dir, check=True)
     print(f"{Colors.GREEN}✓ Created symlink{Colors.NC}")
 
 
@@ -74,55 +76,81 @@ def main(phase_path: Path, config: dict) -> dict:
     
     # Get paths from parent config
     repo_root = Path(config.get('repo_root', Path(phase_path).parent.parent.parent))
-    # Use environment variable if set, otherwise fall back to config or default
-    import os
-    work_dir = Path(os.environ.get('HOMERCHY_WORK_DIR', config.get('work_dir', '/mnt/work/homerchy-deployment/deployment/isoprep-work')))
+    # Work directory resolved by the orchestrator (BuildConfig.work_dir or index.json)
+    work_dir = Path(config.get('work_dir', '/mnt/work/homerchy-deployment/deployment/isoprep-work'))
     profile_dir = Path(config.get('profile_dir', work_dir / "profile"))
     
     print(f"{Colors.BLUE}Assembling ISO profile...{Colors.NC}")
     
-    # 1. Copy base Releng onmachine/config
-    copy_releng_config(repo_root, profile_dir)
-    
-    # 2. Cleanup unwanted Releng onmachine/src/defaults
-    cleanup_reflector(profile_dir)
-    
-    # 3. Apply Homerchy Custom Overlays
-    apply_custom_overlays(repo_root, profile_dir)
-    
-    # 3a. Detect VM environment and adjust boot timeout
-    adjust_vm_boot_timeout(profile_dir)
-    
-    # 3b. Ensure mirrorlist exists
-    create_mirrorlist(profile_dir)
-    
-    # 3c. Configure pacman.conf for build
-    configure_pacman_for_build(repo_root, profile_dir)
-    
-    # Ensure airootfs/etc/pacman.conf uses online repos
-    ensure_airootfs_pacman_online(profile_dir)
-    
-    # 4. Inject Current Repository Source
-    inject_repository_source(repo_root, profile_dir)
-    
-    # 4b. Inject VM profile settings
-    inject_vm_profile(repo_root, profile_dir)
-    
-    # 5. Customize Package List
-    customize_package_list(profile_dir)
-    
-    # 5b. Fix Permissions Targets
-    fix_permissions_targets(repo_root, profile_dir)
-    
-    # 7b. CRITICAL: Ensure airootfs/etc/pacman.conf uses online repos (do this LAST, after all overlays)
-    ensure_airootfs_pacman_online(profile_dir)
+    steps = {
+        # 1. Copy base Releng onmachine/config
+        'copy_releng_config': lambda: copy_releng_config(repo_root, profile_dir),
+        # 2. Cleanup unwanted Releng onmachine/src/defaults
+        'cleanup_reflector': lambda: cleanup_reflector(profile_dir),
+        # 3. Apply Homerchy Custom Overlays
+        'apply_custom_overlays': lambda: apply_custom_overlays(repo_root, profile_dir),
+        # 3a. Detect VM environment and adjust boot timeout
+        'adjust_vm_boot_timeout': lambda: adjust_vm_boot_timeout(profile_dir),
+        # 3b. Ensure mirrorlist exists
+        'create_mirrorlist': lambda: create_mirrorlist(profile_dir),
+        # 3c. Configure pacman.conf for build
+        'configure_pacman_for_build': lambda: configure_pacman_for_build(repo_root, profile_dir),
+        # 4. Inject Current Repository Source
+        'inject_repository_source': lambda: inject_repository_source(repo_root, profile_dir),
+        # 4b. Inject VM profile settings
+        'inject_vm_profile': lambda: inject_vm_profile(repo_root, profile_dir),
+        # 5. Customize Package List
+        'customize_package_list': lambda: customize_package_list(profile_dir),
+        # 5b. Fix Permissions Targets
+        'fix_permissions_targets': lambda: fix_permissions_targets(repo_root, profile_dir),
+        # 7b. CRITICAL: Ensure airootfs/etc/pacman.conf uses online repos (do this LAST, after all overlays)
+        'ensure_airootfs_pacman_online': lambda: ensure_airootfs_pacman_online(profile_dir),
+        # 8. Create symlink so mkarchiso can find the offline mirror during build
+        #    (to the cache store, which does not depend on package_management's view)
+        'create_system_mirror_symlink': lambda: create_system_mirror_symlink(
+            profile_dir, CacheStore().path('offline-mirror')),
+        # Final verification: Ensure syslinux is in packages.x86_64
+        'verify_syslinux_in_packages': lambda: verify_syslinux_in_packages(profile_dir),
+    }
     
-    # 8. Create symlink so mkarchiso can find the offline mirror during build
-    cache_dir = profile_dir / 'airootfs' / 'var' / 'cache' / 'homerchy' / 'mirror' / 'offline'
-    create_system_mirror_symlink(profile_dir, cache_dir)
+    # Everything lands on top of the releng base; the source copy (the long step)
+    # only writes airootfs/root/homerchy and overlaps the rest of the assembly.
+    dependencies = {
+        'cleanup_reflector': ['copy_releng_config'],
+        'apply_custom_overlays': ['copy_releng_config'],
+        'adjust_vm_boot_timeout': ['apply_custom_overlays'],
+        'create_mirrorlist': ['apply_custom_overlays'],
+        'configure_pacman_for_build': ['copy_releng_config'],
+        'inject_repository_source': ['copy_releng_config'],
+        'inject_vm_profile': ['copy_releng_config'],
+        'customize_package_list': ['copy_releng_config'],
+        'fix_permissions_targets': ['copy_releng_config'],
+        'ensure_airootfs_pacman_online': [
+            'configure_pacman_for_build', 'cleanup_reflector', 'apply_custom_overlays',
+            'create_mirrorlist', 'inject_repository_source', 'inject_vm_profile',
+            'fix_permissions_targets',
+        ],
+        'create_system_mirror_symlink': [],
+        'verify_syslinux_in_packages': ['customize_package_list'],
+    }
     
-    # Final verification: Ensure syslinux is in packages.x86_64
-    verify_syslinux_in_packages(profile_dir)
+    # Incremental rebuild (controller --watch): only the steps a source edit affects,
+    # and the steps after them, run on top of the profile the last build assembled
+    order = list(steps)
+    if config.get('steps'):
+        order = with_dependents(order, dependencies, config['steps'])
+        dependencies = {name: [dep for dep in dependencies.get(name, []) if dep in order] for name in order}
+        print(f"{Colors.CYAN}Rerunning {', '.join(order)}{Colors.NC}")
+    
+    def run_step(name: str):
+        with profile_step(f'profile_assembly/{name}'):
+            return steps[name]()
+    
+    outcome = run_dag(order, dependencies, run_step, parallel=config.get('parallel', False))
+    if not outcome.ok:
+        for name, error in outcome.errors.items():
+            print(f"{Colors.RED}ERROR: Profile assembly step {name} failed: {error}{Colors.NC}")
+        sys.exit(1)
     
     # CRITICAL: Ensure mirrorlist exists in archiso-tmp before mkarchiso runs
     # archiso-tmp is always removed, so no need to copy mirrorlist there
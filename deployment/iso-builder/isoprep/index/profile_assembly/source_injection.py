@@ -6,6 +6,7 @@ Copyright (C) 2024 HOMESERVER LLC
 Inject current repository source into ISO profile.
 """
 
+import os
 import shutil
 from pathlib import Path
 
@@ -13,10 +14,10 @@ from pathlib import Path
 import sys
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-from utils import Colors, guaranteed_copytree
+from utils import Colors, count, guaranteed_copytree, warm
 
 
-def _remove_orphaned_files(src_dir: Path, dst_dir: Path, ignore=None):
+def _remove_orphaned_files(src_dir: Path, dst_dir: Path, ignore=None, recurse: bool = True):
     """
     Remove files from destination that no longer exist in source.
     This prevents accumulation of orphaned files when files are deleted or renamed in source.
@@ -27,6 +28,7 @@ def _remove_orphaned_files(src_dir: Path, dst_dir: Path, ignore=None):
         src_dir: Source directory path
         dst_dir: Destination directory path
         ignore: Optional ignore function (returns list/set of ignored names)
+        recurse: Whether to descend into directories present on both sides
     """
     import os
     
@@ -63,7 +65,7 @@ def _remove_orphaned_files(src_dir: Path, dst_dir: Path, ignore=None):
                     # Skip files we can't remove (permissions, etc.)
                     # This is non-fatal - worst case is some orphaned files remain
                     pass
-            elif item.is_dir() and not item.is_symlink():
+            elif recurse and item.is_dir() and not item.is_symlink():
                 # Item exists in both - recursively clean subdirectories
                 src_subdir = src_dir / item.name
                 if src_subdir.exists():
@@ -82,6 +84,10 @@ def inject_repository_source(repo_root: Path, profile_dir: Path):
     Also removes orphaned files from destination that no longer exist in source
     to prevent file count growth between builds.
     
+    Under a long-lived controller (utils.warm), a top-level directory that was
+    injected by an earlier build and has not changed since (the server watches
+    the source tree) is left in place instead of being copied again.
+    
     Args:
         repo_root: Root of the repository
         profile_dir: ISO profile directory
@@ -94,6 +100,8 @@ def inject_repository_source(repo_root: Path, profile_dir: Path):
     # Copy excluding build artifacts and .git
     exclude_patterns = ['deployment/isoprep-work', '.git']
     ignore_fn = shutil.ignore_patterns('.git')
+    injected = warm.index('source')
+    reused = []
     
     for item in repo_root.iterdir():
         if item.name in ['isoprep', '.git', '.build-swap']:
@@ -107,6 +115,13 @@ def inject_repository_source(repo_root: Path, profile_dir: Path):
             continue
         dest = homerchy_target / item.name
         
+        # Unchanged since an earlier build injected it (changes drop the record)
+        key = os.path.realpath(item)
+        if item.is_dir() and injected.get(key) == str(dest) and dest.is_dir() and warm.watched(item):
+            reused.append(item.name)
+            continue
+        injected.pop(key, None)
+        
         # Clean up orphaned files in destination before copying
         # This prevents accumulation of deleted/renamed files
         if dest.exists() and item.is_dir():
@@ -120,7 +135,10 @@ def inject_repository_source(repo_root: Path, profile_dir: Path):
                 shutil.rmtree(dest)
             # guaranteed_copytree ensures all files are copied/updated
             # Show progress for long-running copy operations
-            guaranteed_copytree(item, dest, ignore=ignore_fn, show_progress=True)
+            count('profile_assembly/source_bytes_copied',
+                  guaranteed_copytree(item, dest, ignore=ignore_fn, show_progress=True))
+            if warm.watched(item):
+                injected[key] = str(dest)
         else:
             # For files, always copy (remove destination first to force overwrite)
             # This bypasses mtime check that was preventing changes from propagating
@@ -128,6 +146,7 @@ def inject_repository_source(repo_root: Path, profile_dir: Path):
                 dest.unlink()
             try:
                 shutil.copy2(item, dest, follow_symlinks=False)
+                count('profile_assembly/source_bytes_copied', item.lstat().st_size)
             except (OSError, PermissionError, shutil.Error) as e:
                 # Skip files that can't be accessed (permission denied, missing, broken symlinks)
                 if 'Permission denied' in str(e) or 'PermissionError' in str(type(e).__name__):
@@ -144,8 +163,11 @@ def inject_repository_source(repo_root: Path, profile_dir: Path):
             if name in ['isoprep', '.git', '.build-swap']:
                 ignored.add(name)
         return ignored
-    _remove_orphaned_files(repo_root, homerchy_target, ignore=top_level_ignore)
+    # Reused directories are unchanged, so only the top level needs checking
+    _remove_orphaned_files(repo_root, homerchy_target, ignore=top_level_ignore, recurse=not reused)
     
+    if reused:
+        print(f"{Colors.GREEN}✓ Unchanged since last injection: {', '.join(sorted(reused))}{Colors.NC}")
     print(f"{Colors.GREEN}✓ Repository source injected{Colors.NC}")
 
 
@@ -211,8 +233,9 @@ def fix_permissions_targets(repo_root: Path, profile_dir: Path):
     """
     print(f"{Colors.BLUE}Fixing permissions targets...{Colors.NC}")
     
+    # Only the parent: package_management owns (and may be moving into place) the mirror itself
     cache_dir = profile_dir / 'airootfs' / 'var' / 'cache' / 'homerchy' / 'mirror' / 'offline'
-    cache_dir.mkdir(parents=True, exist_ok=True)
+    cache_dir.parent.mkdir(parents=True, exist_ok=True)
     
     bin_dir = profile_dir / 'airootfs' / 'usr' / 'local' / 'bin'
     bin_dir.mkdir(parents=True, exist_ok=True)
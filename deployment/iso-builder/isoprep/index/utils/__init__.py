@@ -9,7 +9,24 @@ Shared utilities for the ISO build orchestrator system.
 from .colors import Colors
 from .file_operations import safe_copytree, guaranteed_copytree
 from .system_detection import check_dependencies, detect_vm_environment
-from .package_utils import read_package_list
+from .package_utils import (
+    read_package_list, query_package_name, mirror_package_names, collect_mirror_packages, variant_packages
+)
+from .package_index import PackageIndex, PackageInfo, is_package_file, open_package, package_index
+from .version import vercmp
+from .dep_resolver import Resolution, resolve_closure
+from .privileged import (
+    run_privileged, sudo_move, sudo_rmtree, sudo_unlink, sudo_mkdir, sudo_chown, sudo_symlink
+)
+from .cache_store import CacheStore, clone_tree, store_root
+from .preflight import run_preflight
+from .phase_cache import PhaseCache, CACHE_DIR_NAME, missing_outputs
+from .dag import DagResult, run_dag, sequential_dependencies, topological_order, with_dependents
+from .build_state import BuildState, STATE_DIR_NAME
+from .rebuild_plan import RebuildPlan, plan_rebuild
+from .build_config import BuildConfig, BuildResult, MatrixResult, VariantResult
+from .profiler import count, profile_step, profiled, profile_counters, profile_records, reset_profile, write_profile
+from . import warm
 
 __all__ = [
     'Colors',
@@ -18,4 +35,51 @@ __all__ = [
     'check_dependencies',
     'detect_vm_environment',
     'read_package_list',
+    'query_package_name',
+    'mirror_package_names',
+    'collect_mirror_packages',
+    'variant_packages',
+    'PackageIndex',
+    'PackageInfo',
+    'is_package_file',
+    'open_package',
+    'package_index',
+    'Resolution',
+    'resolve_closure',
+    'vercmp',
+    'run_privileged',
+    'sudo_move',
+    'sudo_rmtree',
+    'sudo_unlink',
+    'sudo_mkdir',
+    'sudo_chown',
+    'sudo_symlink',
+    'CacheStore',
+    'clone_tree',
+    'store_root',
+    'run_preflight',
+    'PhaseCache',
+    'CACHE_DIR_NAME',
+    'missing_outputs',
+    'DagResult',
+    'run_dag',
+    'sequential_dependencies',
+    'topological_order',
+    'with_dependents',
+    'BuildState',
+    'STATE_DIR_NAME',
+    'RebuildPlan',
+    'plan_rebuild',
+    'BuildConfig',
+    'BuildResult',
+    'MatrixResult',
+    'VariantResult',
+    'count',
+    'profile_step',
+    'profiled',
+    'profile_counters',
+    'profile_records',
+    'reset_profile',
+    'write_profile',
+    'warm',
 ]
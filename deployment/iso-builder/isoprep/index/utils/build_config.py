@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Build Configuration
+Copyright (C) 2024 HOMESERVER LLC
+
+Typed options of one build and its outcome, for callers that drive the
+orchestrator in-process (the controller, through index.run_build). The
+command-line entry point (build.py) still accepts the HOMERCHY_* environment
+variables and converts them once, with BuildConfig.from_env().
+"""
+
+import os
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+
+def _env_flag(name: str) -> bool:
+    return os.environ.get(name, 'false').lower() == 'true'
+
+
+@dataclass
+class BuildConfig:
+    """Options of one build."""
+    work_dir: Optional[Path] = None       # default: paths.work_dir of index.json
+    repo_root: Optional[Path] = None      # default: the deployment/ tree this file lives in
+    full_clean: bool = False              # rebuild every cache from scratch
+    cache_db_only: bool = False           # keep only the offline repository database and packages
+    resume: bool = False                  # skip phases the previous build completed
+    skip_preflight: bool = False          # do not check disk space before building
+    profile_file: Optional[Path] = None   # where to write the per-phase resource profile
+    phases: Optional[List[str]] = None    # run only these phases (default: all of index.json)
+    steps: Optional[Dict[str, List[str]]] = None  # per phase: rerun only these steps and those after them
+
+    @classmethod
+    def from_env(cls) -> 'BuildConfig':
+        """Build options from the HOMERCHY_* environment variables (command-line builds)."""
+        work_dir = os.environ.get('HOMERCHY_WORK_DIR')
+        repo_root = os.environ.get('ISOPREP_REPO_ROOT')
+        profile_file = os.environ.get('HOMERCHY_PROFILE_FILE')
+        return cls(
+            work_dir=Path(work_dir) if work_dir else None,
+            repo_root=Path(repo_root) if repo_root else None,
+            full_clean=_env_flag('HOMERCHY_FULL_CLEAN'),
+            cache_db_only=_env_flag('HOMERCHY_CACHE_DB_ONLY'),
+            resume=_env_flag('HOMERCHY_RESUME'),
+            skip_preflight=_env_flag('HOMERCHY_SKIP_PREFLIGHT'),
+            profile_file=Path(profile_file) if profile_file else None,
+        )
+
+    def phase_options(self) -> dict:
+        """The flags every phase receives in its config (paths are resolved separately)."""
+        return {key: value for key, value in asdict(self).items()
+                if key not in ('work_dir', 'repo_root', 'profile_file', 'phases', 'steps')}
+
+
+@dataclass
+class BuildResult:
+    """Outcome of one build."""
+    success: bool
+    phases: Dict[str, dict] = field(default_factory=dict)
+    cache_hits: List[str] = field(default_factory=list)
+    cache_misses: List[Tuple[str, str]] = field(default_factory=list)
+    wall: float = 0.0
+
+    @property
+    def failed(self) -> List[str]:
+        """Phases that ran and did not succeed (returned success: False, raised or exited)."""
+        return [name for name, result in self.phases.items() if not result.get('success', False)]
+
+
+@dataclass
+class VariantResult:
+    """Outcome of one variant of a matrix build."""
+    name: str
+    success: bool
+    wall: float = 0.0
+    iso_files: List[str] = field(default_factory=list)
+    log: Optional[Path] = None            # mkarchiso output of this variant
+
+
+@dataclass
+class MatrixResult:
+    """Outcome of a matrix build: the shared base phases, then every variant."""
+    base: BuildResult
+    variants: List[VariantResult] = field(default_factory=list)
+    wall: float = 0.0
+
+    @property
+    def success(self) -> bool:
+        return self.base.success and bool(self.variants) and all(v.success for v in self.variants)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Build State Utility
+Copyright (C) 2024 HOMESERVER LLC
+
+Per-phase results and completion markers in the work directory, so a failed
+build can be resumed from the first incomplete phase (controller --resume).
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+STATE_DIR_NAME = '.isoprep-state'
+
+
+class BuildState:
+    """Completion records for the phases of the current build."""
+
+    def __init__(self, state_dir: Path):
+        self.state_dir = Path(state_dir)
+
+    def _result_path(self, phase_name: str) -> Path:
+        return self.state_dir / f'{phase_name}.json'
+
+    def _marker_path(self, phase_name: str) -> Path:
+        return self.state_dir / f'{phase_name}.done'
+
+    def reset(self) -> None:
+        """Forget every phase (a fresh, non-resumed build is starting)."""
+        if not self.state_dir.exists():
+            return
+        for entry in self.state_dir.iterdir():
+            if entry.suffix in ('.json', '.done', '.tmp'):
+                try:
+                    entry.unlink()
+                except OSError:
+                    pass
+
+    def clear(self, phase_name: str) -> None:
+        """Mark a phase incomplete before it (re)runs."""
+        for path in (self._marker_path(phase_name), self._result_path(phase_name)):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def record(self, phase_name: str, result: dict) -> None:
+        """
+        Persist a successful phase's result, then its completion marker.
+
+        The marker is written last so a crash between the two leaves the
+        phase incomplete rather than complete without a result.
+
+        Args:
+            phase_name: Phase that finished
+            result: Result dict returned by the phase
+        """
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        result_path = self._result_path(phase_name)
+        tmp = result_path.with_name(result_path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(result, f, indent=2, default=str)
+        os.replace(tmp, result_path)
+        self._marker_path(phase_name).write_text(f"{time.time()}\n")
+
+    def completed(self, phase_name: str) -> Optional[dict]:
+        """Return the stored result of a phase that completed successfully, or None."""
+        if not self._marker_path(phase_name).exists():
+            return None
+        try:
+            with open(self._result_path(phase_name), 'r') as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # A failed result never counts as complete, whatever marker sits next to it
+        if not isinstance(result, dict) or not result.get('success'):
+            return None
+        return result
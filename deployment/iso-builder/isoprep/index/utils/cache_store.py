@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Cache Store Utility
+Copyright (C) 2024 HOMESERVER LLC
+
+One stable home for caches that outlive the profile (the offline mirror):
+${HOMERCHY_CACHE_STORE:-/mnt/work/.homerchy-store}/<name>. Packages are
+downloaded into the store and stay there; each build exposes the store in the
+profile by the cheapest means the filesystem offers:
+
+    reflink   copy-on-write clone (btrfs, XFS, bcachefs): independent files, no data copied
+    hardlink  link farm (same filesystem): no data copied
+    copy      plain copy (different filesystems)
+
+Nothing is moved between directories or chowned recursively: only files a
+root process just created in the store are handed back to the build user.
+"""
+
+import errno
+import fcntl
+import os
+import shutil
+from pathlib import Path
+from typing import Iterable, List, Optional
+
+from .colors import Colors
+from .privileged import run_privileged
+
+STORE_ENV = 'HOMERCHY_CACHE_STORE'
+DEFAULT_STORE = '/mnt/work/.homerchy-store'
+MODES = ('reflink', 'hardlink', 'copy')
+
+FICLONE = 0x40049409
+# Errors meaning "this filesystem cannot do that", as opposed to real failures
+_REFLINK_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+                        errno.ENOSYS, errno.EBADF}
+_HARDLINK_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP}
+
+
+def store_root() -> Path:
+    """Root directory of the cache store."""
+    return Path(os.environ.get(STORE_ENV) or DEFAULT_STORE)
+
+
+def _reflink(src: str, dst: str) -> None:
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        except OSError:
+            os.close(dst_fd)
+            os.unlink(dst)
+            raise
+        os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    st = os.stat(src)
+    os.chmod(dst, st.st_mode & 0o7777)
+    os.utime(dst, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+
+def place_file(src: str, dst: str, mode: Optional[str] = None) -> str:
+    """
+    Create dst as a reflink, hardlink or copy of src, cheapest first.
+
+    Args:
+        src: Existing file
+        dst: New path (must not exist)
+        mode: Mode that worked last time (cheaper ones are not retried)
+
+    Returns:
+        The mode used
+    """
+    start = MODES.index(mode) if mode else 0
+    for mode in MODES[start:]:
+        try:
+            if mode == 'reflink':
+                _reflink(src, dst)
+            elif mode == 'hardlink':
+                os.link(src, dst)
+            else:
+                shutil.copy2(src, dst)
+            return mode
+        except OSError as e:
+            unsupported = _REFLINK_UNSUPPORTED if mode == 'reflink' else _HARDLINK_UNSUPPORTED
+            if mode == 'copy' or e.errno not in unsupported:
+                raise
+    raise AssertionError("unreachable")
+
+
+def clone_tree(src: Path, dst: Path) -> str:
+    """
+    Recreate a directory tree with every file placed by place_file().
+
+    Files of a hardlinked clone share their data with src: replace a file
+    (unlink, then write) rather than writing into it.
+
+    Returns:
+        The cheapest mode every file could use ('reflink', 'hardlink' or 'copy')
+    """
+    mode = None
+    for dirpath, dirnames, filenames in os.walk(src):
+        target_dir = Path(dst) / os.path.relpath(dirpath, src)
+        target_dir.mkdir(parents=True, exist_ok=True)
+        shutil.copystat(dirpath, target_dir)
+        for name in dirnames + filenames:
+            source = os.path.join(dirpath, name)
+            target = str(target_dir / name)
+            if os.path.islink(source):
+                os.symlink(os.readlink(source), target)
+                if name in dirnames:
+                    dirnames.remove(name)
+            elif name in filenames:
+                mode = place_file(source, target, mode)
+    return mode or 'copy'
+
+
+def _same(src: os.DirEntry, dst: os.DirEntry) -> bool:
+    """True if dst already exposes src (same link target, same inode, or same size and mtime)."""
+    if src.is_symlink() or dst.is_symlink():
+        return src.is_symlink() and dst.is_symlink() and os.readlink(src.path) == os.readlink(dst.path)
+    a = src.stat(follow_symlinks=False)
+    b = dst.stat(follow_symlinks=False)
+    if (a.st_dev, a.st_ino) == (b.st_dev, b.st_ino):
+        return True
+    return a.st_size == b.st_size and a.st_mtime_ns == b.st_mtime_ns
+
+
+class CacheStore:
+    """Named cache directories in the store, exposed into build trees without moving them."""
+
+    def __init__(self, root: Optional[Path] = None):
+        self.root = Path(root) if root else store_root()
+        self.mode: Optional[str] = None
+
+    def path(self, name: str) -> Path:
+        """Directory of a named cache (created on first use)."""
+        path = self.root / name
+        try:
+            path.mkdir(parents=True, exist_ok=True)
+        except PermissionError:
+            # /mnt/work itself is usually root-owned
+            uid, gid = os.getuid(), os.getgid()
+            run_privileged([{'op': 'mkdir', 'path': path, 'uid': uid, 'gid': gid},
+                            {'op': 'chown', 'path': path, 'uid': uid, 'gid': gid, 'recursive': False}],
+                           check=True)
+        return path
+
+    def adopt(self, name: str, sources: Iterable[Path]) -> int:
+        """
+        Fold caches left in old locations into the store, then remove those locations.
+
+        Files already in the store win; the rest are renamed in (same filesystem,
+        nothing copied).
+
+        Args:
+            name: Named cache to adopt into
+            sources: Legacy directories (missing ones are ignored)
+
+        Returns:
+            Number of files adopted
+        """
+        target = self.path(name)
+        adopted = 0
+        for source in sources:
+            source = Path(source)
+            if not source.is_dir() or source.resolve() == target.resolve():
+                continue
+            moves = []
+            for entry in os.scandir(source):
+                if entry.is_dir(follow_symlinks=False) or entry.is_symlink():
+                    continue
+                if not os.path.lexists(target / entry.name):
+                    moves.append({'op': 'rename', 'src': entry.path, 'dst': str(target / entry.name)})
+            if moves:
+                print(f"{Colors.BLUE}Adopting {len(moves)} cached files from {source} into {target}...{Colors.NC}")
+                pending = []
+                for move in moves:
+                    try:
+                        os.rename(move['src'], move['dst'])
+                    except PermissionError:
+                        pending.append(move)
+                if pending:
+                    run_privileged(pending, check=False)
+                self.claim([Path(m['dst']) for m in moves])
+                adopted += len(moves)
+            try:
+                shutil.rmtree(source)
+            except PermissionError:
+                run_privileged([{'op': 'rmtree', 'path': source}], check=False)
+        return adopted
+
+    def claim(self, files: Iterable[Path]) -> None:
+        """
+        Give files a root process created in the store to the build user.
+
+        Only the given files are touched (no recursive chown of the store).
+        """
+        uid, gid = os.getuid(), os.getgid()
+        ops = []
+        for path in files:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if (st.st_uid, st.st_gid) != (uid, gid):
+                ops.append({'op': 'chown', 'path': path, 'uid': uid, 'gid': gid, 'recursive': False})
+        if ops:
+            run_privileged(ops, check=True)
+
+    def expose(self, name: str, dest: Path) -> str:
+        """
+        Make dest an up-to-date view of a named cache.
+
+        Entries already exposed are kept, stale ones removed, the rest
+        reflinked, hardlinked or copied in.
+
+        Args:
+            name: Named cache
+            dest: Directory inside the build tree
+
+        Returns:
+            The exposure mode used ('reflink', 'hardlink' or 'copy'; 'unchanged'
+            if nothing had to be placed)
+        """
+        source = self.path(name)
+        dest = Path(dest)
+        dest.mkdir(parents=True, exist_ok=True)
+        wanted = {e.name: e for e in os.scandir(source) if not e.is_dir(follow_symlinks=False)}
+        present = {e.name: e for e in os.scandir(dest)}
+
+        for entry_name, entry in present.items():
+            if entry_name in wanted and _same(wanted[entry_name], entry):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+        placed: List[str] = []
+        for entry_name, entry in wanted.items():
+            target = dest / entry_name
+            if os.path.lexists(target):
+                continue
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), target)
+            else:
+                self.mode = place_file(entry.path, str(target), self.mode)
+            placed.append(entry_name)
+
+        if not placed:
+            print(f"{Colors.GREEN}✓ {name} in {dest} is up to date ({len(wanted)} files){Colors.NC}")
+            return 'unchanged'
+        mode = self.mode or 'symlink'
+        print(f"{Colors.GREEN}✓ Exposed {name} in {dest} ({len(placed)} new via {mode}, "
+              f"{len(wanted) - len(placed)} unchanged){Colors.NC}")
+        return mode
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Dependency Graph Utility
+Copyright (C) 2024 HOMESERVER LLC
+
+Runs named steps in dependency order, optionally on a thread pool so that
+independent steps (package download vs. profile copy) overlap.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+
+@dataclass
+class DagResult:
+    """Outcome of a dependency graph run."""
+    results: Dict[str, Any] = field(default_factory=dict)
+    errors: Dict[str, BaseException] = field(default_factory=dict)
+    skipped: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors and not self.skipped
+
+
+def sequential_dependencies(order: List[str]) -> Dict[str, List[str]]:
+    """Dependencies that make every step wait for the one listed before it."""
+    return {name: order[i - 1:i] for i, name in enumerate(order)}
+
+
+def validate_dependencies(order: List[str], dependencies: Dict[str, List[str]]) -> None:
+    """
+    Check that dependencies only name known steps and contain no cycle.
+
+    Raises:
+        ValueError: On an unknown step or a dependency cycle
+    """
+    known = set(order)
+    for name, deps in dependencies.items():
+        if name not in known:
+            raise ValueError(f"Dependencies declared for unknown step: {name}")
+        for dep in deps:
+            if dep not in known:
+                raise ValueError(f"Step {name} depends on unknown step: {dep}")
+
+    state = {}
+
+    def visit(name: str, path: List[str]):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'active':
+            raise ValueError(f"Dependency cycle: {' -> '.join(path + [name])}")
+        state[name] = 'active'
+        for dep in dependencies.get(name, []):
+            visit(dep, path + [name])
+        state[name] = 'done'
+
+    for name in order:
+        visit(name, [])
+
+
+def topological_order(order: List[str], dependencies: Dict[str, List[str]]) -> List[str]:
+    """Return order rearranged (stably) so every step follows its dependencies."""
+    validate_dependencies(order, dependencies)
+    placed = []
+    remaining = list(order)
+    while remaining:
+        name = next(n for n in remaining if all(d in placed for d in dependencies.get(n, [])))
+        remaining.remove(name)
+        placed.append(name)
+    return placed
+
+
+def with_dependents(order: List[str], dependencies: Dict[str, List[str]], names: List[str]) -> List[str]:
+    """Return names plus every step that (transitively) depends on one of them, in order."""
+    selected = set(names)
+    for name in topological_order(order, dependencies):
+        if any(dep in selected for dep in dependencies.get(name, [])):
+            selected.add(name)
+    return [name for name in order if name in selected]
+
+
+def run_dag(order: List[str], dependencies: Dict[str, List[str]], run: Callable[[str], Any],
+            parallel: bool = False, continue_on_error: bool = False,
+            max_workers: Optional[int] = None,
+            on_error: Optional[Callable[[str, BaseException], None]] = None) -> DagResult:
+    """
+    Run every step once all of its dependencies have succeeded.
+
+    Steps whose dependencies failed are skipped. Without continue_on_error no
+    new step is started after the first failure (running ones are allowed to
+    finish). Sequential mode runs ready steps in the order given.
+
+    Args:
+        order: Step names in declaration order (tie-break and sequential order)
+        dependencies: Map of step name to the steps it waits for
+        run: Callable executing one step by name and returning its result
+        parallel: Run independent steps concurrently on a thread pool
+        continue_on_error: Keep starting independent steps after a failure
+        max_workers: Thread pool size (default: number of steps)
+        on_error: Called with (name, exception) as soon as a step fails
+
+    Returns:
+        DagResult: Per-step results, errors and skipped steps
+    """
+    validate_dependencies(order, dependencies)
+    outcome = DagResult()
+    pending = list(order)
+    stopped = False
+
+    def ready(name: str) -> bool:
+        return all(dep in outcome.results for dep in dependencies.get(name, []))
+
+    def blocked(name: str) -> bool:
+        return any(dep in outcome.errors or dep in outcome.skipped
+                   for dep in dependencies.get(name, []))
+
+    def record_failure(name: str, exc: BaseException):
+        nonlocal stopped
+        outcome.errors[name] = exc
+        if on_error:
+            on_error(name, exc)
+        if not continue_on_error:
+            stopped = True
+
+    def skip_blocked():
+        changed = True
+        while changed:
+            changed = False
+            for name in list(pending):
+                if blocked(name):
+                    pending.remove(name)
+                    outcome.skipped.append(name)
+                    changed = True
+
+    if not parallel:
+        while pending and not stopped:
+            skip_blocked()
+            name = next((n for n in pending if ready(n)), None)
+            if name is None:
+                break
+            pending.remove(name)
+            try:
+                outcome.results[name] = run(name)
+            except (Exception, SystemExit) as e:
+                record_failure(name, e)
+        outcome.skipped.extend(pending)
+        return outcome
+
+    with ThreadPoolExecutor(max_workers=max_workers or max(len(order), 1)) as pool:
+        running = {}
+        while True:
+            skip_blocked()
+            if not stopped:
+                for name in [n for n in pending if ready(n)]:
+                    pending.remove(name)
+                    running[pool.submit(run, name)] = name
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    outcome.results[name] = future.result()
+                except (Exception, SystemExit) as e:
+                    record_failure(name, e)
+
+    outcome.skipped.extend(pending)
+    return outcome
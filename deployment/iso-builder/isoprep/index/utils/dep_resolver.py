@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Dependency Resolver
+Copyright (C) 2024 HOMESERVER LLC
+
+Computes the full set of packages the offline mirror must hold: the listed
+packages and, transitively, everything they depend on. It follows the rules
+pacman applies when it downloads:
+
+    - a dependency is "name", or "name" with a version constraint (=, <, >, <=, >=)
+      compared the way vercmp does (epoch:version-release)
+    - it is satisfied by a package of that name, or by one that provides it
+      (a versioned dependency needs a versioned provide); virtual names such
+      as "sh" only exist as provides
+    - something already selected satisfies it before anything new is chosen;
+      otherwise sources are searched in order, a package of that exact name
+      before providers, providers by name
+    - a listed name that is a group stands for every package of the group
+
+Sources are dictionaries of packages by name (the mirror's package index,
+then each sync database in pacman.conf order); anything with name, version,
+depends, provides and groups attributes works.
+"""
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .version import vercmp
+
+_OPERATORS = ('>=', '<=', '=', '<', '>')
+
+
+def parse_dep(dep: str) -> Tuple[str, str, str]:
+    """
+    Split a dependency or provide into (name, operator, version).
+
+    Args:
+        dep: e.g. "glibc", "python>=3.11", "libfoo.so=1-64", "bash: description"
+
+    Returns:
+        Name, operator ('' for none) and version ('' for none)
+    """
+    dep = dep.split(': ', 1)[0].strip()
+    for position, char in enumerate(dep):
+        if char in '<>=':
+            for op in _OPERATORS:
+                if dep.startswith(op, position):
+                    return dep[:position], op, dep[position + len(op):]
+    return dep, '', ''
+
+
+def version_satisfies(version: str, op: str, wanted: str) -> bool:
+    """True if version meets the constraint op wanted ('' op: any version)."""
+    if not op:
+        return True
+    result = vercmp(version, wanted)
+    return {'=': result == 0, '>=': result >= 0, '<=': result <= 0,
+            '>': result > 0, '<': result < 0}[op]
+
+
+def satisfies(package, name: str, op: str, wanted: str) -> bool:
+    """True if package meets the dependency (by its own name or a provide)."""
+    if package.name == name and version_satisfies(package.version, op, wanted):
+        return True
+    for provide in package.provides:
+        provided, _, provided_version = parse_dep(provide)
+        if provided != name:
+            continue
+        if not op:
+            return True
+        # A versioned dependency needs a versioned provide
+        if provided_version and version_satisfies(provided_version, op, wanted):
+            return True
+    return False
+
+
+@dataclass
+class Resolution:
+    """A dependency closure: every package, where it comes from and why it is needed."""
+    packages: Dict[str, Tuple[str, object]] = field(default_factory=dict)   # name -> (source, package)
+    pulled_by: Dict[str, str] = field(default_factory=dict)       # name -> listed package that needed it first
+    required_by: Dict[str, str] = field(default_factory=dict)     # name -> package that depends on it directly
+    missing: List[Tuple[str, str]] = field(default_factory=list)  # (dependency, required by) nothing satisfies
+
+
+class _Sources:
+    """Lookups over the sources: by name, by provided name, by group (built on first use)."""
+
+    def __init__(self, sources: Sequence[Tuple[str, Dict[str, object]]]):
+        self.sources = list(sources)
+        self._providers: Optional[Dict[str, List[Tuple[str, object]]]] = None
+        self._groups: Optional[Dict[str, List[Tuple[str, object]]]] = None
+
+    def _index(self) -> None:
+        self._providers, self._groups = {}, {}
+        for source, packages in self.sources:
+            for name in sorted(packages):
+                package = packages[name]
+                for provide in package.provides:
+                    self._providers.setdefault(parse_dep(provide)[0], []).append((source, package))
+                for group in getattr(package, 'groups', ()):
+                    self._groups.setdefault(group, []).append((source, package))
+
+    def find(self, dep: str) -> Optional[Tuple[str, object]]:
+        """First package satisfying dep: an exact name in any source, else a provider."""
+        name, op, wanted = parse_dep(dep)
+        if '/' in name:
+            # repo/name selects one source
+            repo, name = name.split('/', 1)
+            packages = dict(self.sources).get(repo, {})
+            package = packages.get(name)
+            return (repo, package) if package and satisfies(package, name, op, wanted) else None
+        for source, packages in self.sources:
+            package = packages.get(name)
+            if package is not None and satisfies(package, name, op, wanted):
+                return source, package
+        if self._providers is None:
+            self._index()
+        for source, package in self._providers.get(name, []):
+            if satisfies(package, name, op, wanted):
+                return source, package
+        return None
+
+    def group(self, name: str) -> List[Tuple[str, object]]:
+        """Members of a group, each from the first source that has it."""
+        if self._groups is None:
+            self._index()
+        members: Dict[str, Tuple[str, object]] = {}
+        for source, package in self._groups.get(name, []):
+            members.setdefault(package.name, (source, package))
+        return [members[member] for member in sorted(members)]
+
+
+def resolve_closure(targets: Sequence[str], sources: Sequence[Tuple[str, Dict[str, object]]]) -> Resolution:
+    """
+    Resolve packages and all their dependencies.
+
+    Args:
+        targets: Package (or group, or repo/package) names, in list order
+        sources: (source name, packages by name), most preferred first
+
+    Returns:
+        Resolution; missing lists what nothing satisfies (the closure is incomplete then)
+    """
+    lookup = _Sources(sources)
+    resolution = Resolution()
+    # Selected packages by their name and by every name they provide
+    selected: Dict[str, List[object]] = {}
+
+    def select(source: str, package, target: str, parent: Optional[str]) -> bool:
+        chosen = resolution.packages.get(package.name)
+        if chosen is not None:
+            if chosen[1] is package:
+                return False
+            # A dependency needs another version (a cached package older than required): replace it
+            for provided in [package.name] + [parse_dep(provide)[0] for provide in chosen[1].provides]:
+                selected[provided] = [other for other in selected.get(provided, []) if other is not chosen[1]]
+        else:
+            resolution.pulled_by[package.name] = target
+            if parent:
+                resolution.required_by[package.name] = parent
+        resolution.packages[package.name] = (source, package)
+        for provided in [package.name] + [parse_dep(provide)[0] for provide in package.provides]:
+            selected.setdefault(provided, []).append(package)
+        return True
+
+    for target in targets:
+        found = lookup.find(target)
+        roots = [found] if found else lookup.group(target)
+        if not roots:
+            resolution.missing.append((target, '(package list)'))
+            continue
+        queue = [package for source, package in roots if select(source, package, target, None)]
+        while queue:
+            package = queue.pop(0)
+            for dep in package.depends:
+                name, op, wanted = parse_dep(dep)
+                if any(satisfies(chosen, name, op, wanted) for chosen in selected.get(name, ())):
+                    continue
+                provider = lookup.find(dep)
+                if provider is None:
+                    resolution.missing.append((dep, package.name))
+                elif select(provider[0], provider[1], target, package.name):
+                    queue.append(provider[1])
+    return resolution
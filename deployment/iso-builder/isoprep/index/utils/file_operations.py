@@ -96,6 +96,9 @@ def guaranteed_copytree(src, dst, ignore=None, show_progress=False):
         dst: Destination directory path
         ignore: Optional ignore function (returns list/set of ignored names)
         show_progress: If True, show progress indicator for long-running operations
+    
+    Returns:
+        int: Bytes copied
     """
     import sys
     import time
@@ -128,6 +131,7 @@ def guaranteed_copytree(src, dst, ignore=None, show_progress=False):
             print(f"{Colors.BLUE}Copying files...{Colors.NC}", end='', flush=True)
     
     copied_files = 0
+    copied_bytes = 0
     spinner_chars = ['|', '/', '-', '\\']
     spinner_idx = 0
     last_update = time.time()
@@ -260,6 +264,7 @@ def guaranteed_copytree(src, dst, ignore=None, show_progress=False):
                 if not dst_exists:
                     shutil.copy2(src_file, dst_file, follow_symlinks=False)
                     copied_files += 1
+                    copied_bytes += src_file.lstat().st_size
                     # Update progress spinner more frequently for large file counts
                     # Update every 1% progress, every 100 files, or every 0.2 seconds
                     if show_progress:
@@ -297,6 +302,7 @@ def guaranteed_copytree(src, dst, ignore=None, show_progress=False):
                                     pass  # Skip if we 'can't remove it
                                 shutil.copy2(src_file, dst_file, follow_symlinks=False)
                                 copied_files += 1
+                                copied_bytes += src_file.lstat().st_size
                                 if show_progress and (copied_files % 10 == 0 or time.time() - last_update > 0.1):
                                     spinner_idx = (spinner_idx + 1) % len(spinner_chars)
                                     progress_pct = int((copied_files / total_files) * 100) if total_files > 0 else 0
@@ -332,6 +338,7 @@ def guaranteed_copytree(src, dst, ignore=None, show_progress=False):
                             raise
                         shutil.copy2(src_file, dst_file, follow_symlinks=False)
                         copied_files += 1
+                        copied_bytes += src_file.lstat().st_size
                         # Update progress spinner
                         if show_progress and (copied_files % 10 == 0 or time.time() - last_update > 0.1):
                             spinner_idx = (spinner_idx + 1) % len(spinner_chars)
@@ -358,6 +365,7 @@ def guaranteed_copytree(src, dst, ignore=None, show_progress=False):
                                 raise
                         shutil.copy2(src_file, dst_file, follow_symlinks=False)
                         copied_files += 1
+                        copied_bytes += src_file.lstat().st_size
                         if show_progress and (copied_files % 10 == 0 or time.time() - last_update > 0.1):
                             spinner_idx = (spinner_idx + 1) % len(spinner_chars)
                             progress_pct = int((copied_files / total_files) * 100) if total_files > 0 else 0
@@ -384,3 +392,5 @@ def guaranteed_copytree(src, dst, ignore=None, show_progress=False):
         else:
             # If no files copied (all skipped), show a brief message
             print(f"{Colors.BLUE}✓ No files needed copying (all up to date or skipped){Colors.NC}")
+    
+    return copied_bytes
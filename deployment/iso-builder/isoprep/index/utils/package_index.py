@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Package Metadata Index
+Copyright (C) 2024 HOMESERVER LLC
+
+Metadata (name, version, dependencies, sizes) of every package archive in a
+directory, read from the .PKGINFO member without extracting the rest of the
+archive. makepkg writes .PKGINFO first, so only the first compressed block
+of each package is decompressed.
+
+The index is kept next to the packages (.package-index.json) and keyed by
+file name, size and mtime: once it is warm, looking up every package of the
+offline mirror is a single stat pass. A long-lived controller (controller
+--serve) also keeps it in memory between builds (utils.warm).
+
+.pkg.tar.zst needs the zstandard module (or Python 3.14's compression.zstd);
+without either, zstd is run once per package the index does not know yet.
+"""
+
+import dataclasses
+import json
+import os
+import subprocess
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from . import warm
+from .version import vercmp
+
+INDEX_NAME = '.package-index.json'
+INDEX_VERSION = 1
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+PACKAGE_SUFFIXES = ('.pkg.tar.zst', '.pkg.tar.xz', '.pkg.tar.gz', '.pkg.tar.bz2', '.pkg.tar')
+
+# .PKGINFO keys that may repeat, and the PackageInfo list each one fills
+_LIST_KEYS = {
+    'license': 'licenses',
+    'group': 'groups',
+    'depend': 'depends',
+    'optdepend': 'optdepends',
+    'makedepend': 'makedepends',
+    'checkdepend': 'checkdepends',
+    'conflict': 'conflicts',
+    'provides': 'provides',
+    'replaces': 'replaces',
+}
+_SCALAR_KEYS = {
+    'pkgname': 'name',
+    'pkgbase': 'base',
+    'pkgver': 'version',
+    'pkgdesc': 'desc',
+    'url': 'url',
+    'arch': 'arch',
+    'packager': 'packager',
+}
+
+
+@dataclass
+class PackageInfo:
+    """.PKGINFO of one package archive, with the file it was read from."""
+    filename: str
+    size: int                  # archive (compressed) size
+    mtime_ns: int
+    name: str = ''
+    version: str = ''
+    base: str = ''
+    desc: str = ''
+    url: str = ''
+    arch: str = ''
+    packager: str = ''
+    builddate: int = 0
+    isize: int = 0             # installed size
+    licenses: List[str] = field(default_factory=list)
+    groups: List[str] = field(default_factory=list)
+    depends: List[str] = field(default_factory=list)
+    optdepends: List[str] = field(default_factory=list)
+    makedepends: List[str] = field(default_factory=list)
+    checkdepends: List[str] = field(default_factory=list)
+    conflicts: List[str] = field(default_factory=list)
+    provides: List[str] = field(default_factory=list)
+    replaces: List[str] = field(default_factory=list)
+
+
+def is_package_file(name: str) -> bool:
+    """True for package archives (not their .sig files)."""
+    return name.endswith(PACKAGE_SUFFIXES)
+
+
+def parse_pkginfo(text: str, info: PackageInfo) -> PackageInfo:
+    """Fill info from the text of a .PKGINFO file."""
+    for line in text.splitlines():
+        if not line or line.startswith('#') or ' = ' not in line:
+            continue
+        key, value = line.split(' = ', 1)
+        if key in _LIST_KEYS:
+            getattr(info, _LIST_KEYS[key]).append(value)
+        elif key in _SCALAR_KEYS:
+            setattr(info, _SCALAR_KEYS[key], value)
+        elif key in ('size', 'builddate'):
+            try:
+                setattr(info, 'isize' if key == 'size' else key, int(value))
+            except ValueError:
+                pass
+    return info
+
+
+def _zstd_reader(path: Path):
+    """Decompressing reader of a .zst file (in-process when a zstd module is available)."""
+    try:
+        from compression import zstd
+        return zstd.open(path, 'rb'), None
+    except ImportError:
+        pass
+    try:
+        import zstandard
+        f = open(path, 'rb')
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True), None
+    except ImportError:
+        pass
+    proc = subprocess.Popen(['zstd', '-dcq', '--', str(path)], stdout=subprocess.PIPE,
+                            stderr=subprocess.DEVNULL)
+    return proc.stdout, proc
+
+
+def _is_zstd(path: Path) -> bool:
+    """True for zstd-compressed files (.pkg.tar.zst, and sync databases without a suffix)."""
+    if str(path).endswith('.zst'):
+        return True
+    try:
+        with open(path, 'rb') as f:
+            return f.read(4) == ZSTD_MAGIC
+    except OSError:
+        return False
+
+
+@contextmanager
+def open_package(path: Path) -> Iterator[tarfile.TarFile]:
+    """
+    Stream the members of a package archive or database (tarfile stream mode:
+    read each member in order).
+
+    Args:
+        path: Package archive (*.pkg.tar.*) or repository database
+
+    Yields:
+        TarFile positioned at the first member
+
+    Raises:
+        OSError, tarfile.TarError: If the archive cannot be opened
+    """
+    stream = proc = None
+    try:
+        if _is_zstd(path):
+            stream, proc = _zstd_reader(Path(path))
+            tar = tarfile.open(fileobj=stream, mode='r|')
+        else:
+            tar = tarfile.open(path, mode='r|*')
+        with tar:
+            yield tar
+    finally:
+        if stream is not None:
+            stream.close()
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+
+
+def read_pkginfo(path: Path) -> Optional[str]:
+    """
+    Text of the .PKGINFO member of a package archive, streamed without extracting the rest.
+
+    Args:
+        path: Package archive (*.pkg.tar.*)
+
+    Returns:
+        .PKGINFO contents, or None if the archive cannot be read or has none
+    """
+    try:
+        with open_package(path) as tar:
+            for member in tar:
+                if member.name.lstrip('./') == 'PKGINFO' and member.isfile():
+                    return tar.extractfile(member).read().decode('utf-8', errors='replace')
+        return None
+    except (OSError, EOFError, tarfile.TarError, ValueError):
+        return None
+
+
+class PackageIndex:
+    """Package metadata of one directory, persisted to INDEX_NAME in it."""
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.path = self.directory / INDEX_NAME
+        self.entries: Dict[str, PackageInfo] = {}
+        self._dirty = False
+        self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get('version') != INDEX_VERSION:
+            return
+        for entry in data.get('packages', []):
+            try:
+                info = PackageInfo(**entry)
+            except TypeError:
+                continue
+            self.entries[info.filename] = info
+
+    def save(self) -> None:
+        """Write the index if it changed (a read-only directory just keeps it in memory)."""
+        if not self._dirty:
+            return
+        data = {'version': INDEX_VERSION,
+                'packages': [dataclasses.asdict(info) for _, info in sorted(self.entries.items())]}
+        tmp = self.path.with_name(f'{INDEX_NAME}.{os.getpid()}.tmp')
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+            self._dirty = False
+        except OSError:
+            try:
+                tmp.unlink()
+            except OSError:
+                pass
+
+    def _fresh(self, name: str, st: os.stat_result) -> Optional[PackageInfo]:
+        info = self.entries.get(name)
+        if info and info.size == st.st_size and info.mtime_ns == st.st_mtime_ns:
+            return info
+        return None
+
+    def _read(self, name: str, st: os.stat_result) -> Optional[PackageInfo]:
+        text = read_pkginfo(self.directory / name)
+        if text is None:
+            return None
+        info = parse_pkginfo(text, PackageInfo(filename=name, size=st.st_size, mtime_ns=st.st_mtime_ns))
+        return info if info.name else None
+
+    def get(self, pkg_file: Path) -> Optional[PackageInfo]:
+        """
+        Metadata of one package file of this directory.
+
+        Args:
+            pkg_file: Package archive
+
+        Returns:
+            PackageInfo, or None if the file is missing or unreadable
+        """
+        try:
+            st = os.stat(pkg_file)
+        except OSError:
+            return None
+        name = Path(pkg_file).name
+        info = self._fresh(name, st)
+        if info is None:
+            info = self._read(name, st)
+            if info is None:
+                return None
+            self.entries[name] = info
+            self._dirty = True
+        return info
+
+    def scan(self) -> Dict[str, PackageInfo]:
+        """
+        Metadata of every package archive in the directory.
+
+        Files the index knows (same size and mtime) cost a stat; the others
+        are read in parallel. Entries of vanished files are dropped and the
+        index is saved.
+
+        Returns:
+            PackageInfo by file name (unreadable archives are left out)
+        """
+        known, unknown = {}, []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if not is_package_file(entry.name):
+                        continue
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    info = self._fresh(entry.name, st)
+                    if info is not None:
+                        known[entry.name] = info
+                    else:
+                        unknown.append((entry.name, st))
+        except OSError:
+            return {}
+
+        if unknown:
+            workers = min(len(unknown), os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                for (name, _), info in zip(unknown, pool.map(lambda item: self._read(*item), unknown)):
+                    if info is not None:
+                        known[name] = info
+        if unknown or len(known) != len(self.entries):
+            self.entries = dict(known)
+            self._dirty = True
+        self.save()
+        return known
+
+    def names(self) -> Dict[str, PackageInfo]:
+        """Metadata by package name (the highest version wins if a package has several files;
+        between equal versions, the newer file)."""
+        by_name: Dict[str, PackageInfo] = {}
+        for info in self.scan().values():
+            current = by_name.get(info.name)
+            if current is None:
+                by_name[info.name] = info
+                continue
+            order = vercmp(info.version, current.version)
+            if order > 0 or (order == 0 and (info.mtime_ns, info.filename) > (current.mtime_ns, current.filename)):
+                by_name[info.name] = info
+        return by_name
+
+
+def package_index(directory: Path) -> PackageIndex:
+    """
+    The index of a package directory, shared by every caller in the process.
+
+    Args:
+        directory: Directory holding package archives (the offline mirror)
+
+    Returns:
+        PackageIndex (kept in the warm 'packages' index between server builds)
+    """
+    indexes = warm.index('packages')
+    key = os.path.realpath(str(directory))
+    index = indexes.get(key)
+    if not isinstance(index, PackageIndex):
+        index = indexes[key] = PackageIndex(Path(directory))
+    return index
@@ -6,7 +6,45 @@ Copyright (C) 2024 HOMESERVER LLC
 Package list reading and processing utilities.
 """
 
+import json
 from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
+
+from .colors import Colors
+from .package_index import package_index
+
+# Package lists the offline mirror is built from, relative to repo_root (deployment/).
+# The ISO base list is read from the releng source, not the profile: profile_assembly
+# may be copying and extending the profile copy at the same time (execution.parallel)
+MIRROR_PACKAGE_LISTS = (
+    'iso-builder/archiso/configs/releng/packages.x86_64',
+    'install/homerchy-base.packages',
+    'install/homerchy-other.packages',
+    'iso-builder/builder/archinstall.packages',
+)
+
+# Build variants (VM test, developer, production): the installer profiles, relative to
+# repo_root. A profile may list extra "packages" its ISO carries; the shared offline
+# mirror holds the union of all of them, so every variant builds from one download
+VARIANTS_FILE = 'vmtools/index.json'
+
+# Essential base system packages (always needed)
+ESSENTIAL_PACKAGES = ('base', 'base-devel', 'linux', 'linux-firmware', 'linux-headers', 'syslinux')
+
+# Packages not available from Arch official repos (isoprep uses default pacman; no AUR/custom/homerchy-repo at build time)
+# These are installed later on the target (AUR helper, homerchy repo, or post-install).
+PACKAGES_SKIP_MIRROR = frozenset({
+    # AUR-only
+    'yay', 'yay-debug', 'spotify', 'typora', 'pinta', 'python-terminaltexteffects',
+    'tobi-try', 'ttf-ia-writer', 'ufw-docker', 'wayfreeze', 'xdg-terminal-exec',
+    'yaru-icon-theme', 'tzupdate',
+    # Custom / homerchy repo (omarchy-*)
+    'omarchy-keyring', 'omarchy-chromium', 'omarchy-nvim', 'omarchy-walker',
+    # Apple / custom hardware
+    'apple-bcm-firmware', 'apple-t2-audio-config', 'asdcontrol', 'gpu-screen-recorder',
+    'limine-mkinitcpio-hook', 'limine-snapper-sync', 'linux-t2', 'linux-t2-headers',
+    'macbook12-spi-driver-dkms', 't2fanrd', 'tiny-dfr',
+})
 
 
 def read_package_list(package_file: Path) -> list:
@@ -31,3 +69,83 @@ def read_package_list(package_file: Path) -> list:
                 packages.append(line)
     
     return packages
+
+
+def variant_packages(repo_root: Path) -> Dict[str, list]:
+    """
+    Extra packages of each build variant (profiles of vmtools/index.json).
+    
+    Args:
+        repo_root: Root of the repository (deployment/)
+        
+    Returns:
+        Package names by variant name (empty lists for variants without extras)
+    """
+    variants_file = repo_root / VARIANTS_FILE
+    if not variants_file.exists():
+        return {}
+    with open(variants_file, 'r') as f:
+        profiles = json.load(f).get('profiles', {})
+    return {name: list(profile.get('packages', [])) for name, profile in profiles.items()}
+
+
+def collect_mirror_packages(repo_root: Path, verbose: bool = False) -> Tuple[list, set]:
+    """
+    Packages the offline mirror must hold (explicitly listed; dependencies not resolved).
+    
+    Args:
+        repo_root: Root of the repository (deployment/)
+        verbose: Print what was read from each list
+        
+    Returns:
+        Tuple of (sorted package names, set of names skipped as not in the Arch repos)
+    """
+    all_packages = set()
+    for relative in MIRROR_PACKAGE_LISTS:
+        package_file = repo_root / relative
+        if package_file.exists():
+            packages = read_package_list(package_file)
+            all_packages.update(packages)
+            if verbose:
+                print(f"{Colors.GREEN}  ✓ Read {len(packages)} packages from {package_file.name}{Colors.NC}")
+    all_packages.update(ESSENTIAL_PACKAGES)
+    if verbose:
+        print(f"{Colors.GREEN}  ✓ Added {len(ESSENTIAL_PACKAGES)} essential base packages{Colors.NC}")
+    extras = set().union(*variant_packages(repo_root).values())
+    all_packages.update(extras)
+    if verbose and extras:
+        print(f"{Colors.GREEN}  ✓ Added {len(extras)} build variant packages{Colors.NC}")
+    
+    filtered = {p for p in all_packages if p not in PACKAGES_SKIP_MIRROR and not p.startswith('omarchy-')}
+    return sorted(filtered), all_packages - filtered
+
+
+def query_package_name(pkg_file: Path) -> Optional[str]:
+    """
+    Package name of a package file, from its .PKGINFO.
+    
+    Answers come from the package index of the file's directory
+    (utils.package_index), so each file is read once per process;
+    mirror_package_names() also saves the index for later builds.
+    
+    Args:
+        pkg_file: Package archive (*.pkg.tar.*)
+        
+    Returns:
+        Package name, or None if the file could not be read
+    """
+    info = package_index(pkg_file.parent).get(pkg_file)
+    return info.name if info else None
+
+
+def mirror_package_names(mirror_dir: Path) -> Set[str]:
+    """
+    Names of the packages in a package directory (one stat pass once the index is warm).
+    
+    Args:
+        mirror_dir: Directory holding package archives (the offline mirror)
+        
+    Returns:
+        Set of package names (unreadable archives are left out)
+    """
+    return {info.name for info in package_index(mirror_dir).scan().values()}
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Phase Cache Utility
+Copyright (C) 2024 HOMESERVER LLC
+
+Content-hashed cache of phase results. Each phase declares its inputs in its
+index.json under "cache"; the orchestrator fingerprints them and replays the
+stored result instead of re-running a phase whose inputs did not change.
+
+Declaration (paths may use {repo_root}, {work_dir}, {out_dir}, {profile_dir}):
+
+    "cache": {
+        "inputs": {
+            "files": ["{repo_root}/iso-builder/configs"],
+            "package_lists": ["{repo_root}/install/homerchy-base.packages"],
+            "env": ["OMARCHY_VM_BUILD"],
+            "upstream": ["package_management"],
+            "exclude": [".git", "__pycache__"]
+        }
+    },
+    "outputs": ["{out_dir}/*.iso"]
+
+A stored result is only replayed while the phase's top-level "outputs" exist.
+
+The phase's own source and the shared utils are always part of the fingerprint.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from . import warm
+from .package_utils import read_package_list
+
+CACHE_DIR_NAME = '.isoprep-cache'
+
+# Never descend into these when hashing a directory input
+DEFAULT_EXCLUDES = ['.git', '__pycache__']
+
+
+def missing_outputs(outputs: list, variables: dict) -> list:
+    """
+    Return the declared outputs of a phase that do not exist.
+
+    Args:
+        outputs: Output paths from the phase's index.json ({name} placeholders, globs)
+        variables: Values for the placeholders
+
+    Returns:
+        list: Missing paths (a glob is missing when it matches nothing)
+    """
+    missing = []
+    for template in outputs:
+        path = template.format(**{k: str(v) for k, v in variables.items()})
+        if any(c in path for c in '*?['):
+            parent = Path(path).parent
+            if not parent.is_dir() or not any(parent.glob(Path(path).name)):
+                missing.append(path)
+        elif not Path(path).exists():
+            missing.append(path)
+    return missing
+
+
+class PhaseCache:
+    """Fingerprints phase inputs and stores phase results in the work directory."""
+
+    def __init__(self, cache_dir: Path, variables: dict, index_path: Path):
+        """
+        Args:
+            cache_dir: Directory holding stored results and the digest memo
+            variables: Values for {name} placeholders in cache declarations
+            index_path: Orchestrator index directory (phase and utils source)
+        """
+        self.cache_dir = Path(cache_dir)
+        self.variables = {k: str(v) for k, v in variables.items()}
+        self.index_path = Path(index_path)
+        self.fingerprints: Dict[str, str] = {}
+        self.hits = []
+        self.misses = []
+        self._digests = self._load_json(self.cache_dir / 'digests.json') or {}
+        self._digests_dirty = False
+        # Phases may run concurrently (execution.parallel)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _load_json(path: Path) -> Optional[dict]:
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_json(self, path: Path, data: dict) -> None:
+        """Write data atomically so an interrupted build never leaves a torn record."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=2, default=str)
+        os.replace(tmp, path)
+
+    def expand(self, template: str) -> str:
+        """Substitute {repo_root}-style placeholders in a declared path."""
+        return template.format(**self.variables)
+
+    def _file_digest(self, path: Path) -> str:
+        """
+        SHA-256 of a file, memoized on (size, mtime) so unchanged files are not re-read.
+
+        Args:
+            path: Regular file to hash
+
+        Returns:
+            str: Hex digest, or a marker for unreadable files
+        """
+        try:
+            st = path.stat()
+        except OSError:
+            return 'missing'
+        key = str(path)
+        memo = self._digests.get(key)
+        if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+            return memo[2]
+
+        sha = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    sha.update(chunk)
+        except OSError:
+            return f"unreadable:{st.st_size}:{st.st_mtime_ns}"
+        digest = sha.hexdigest()
+        self._digests[key] = [st.st_size, st.st_mtime_ns, digest]
+        self._digests_dirty = True
+        return digest
+
+    def _path_digest(self, path: Path, excludes: list) -> str:
+        """Digest of a file, symlink or directory tree (names, modes and contents)."""
+        if path.is_symlink():
+            return 'link:' + os.readlink(path)
+        if path.is_file():
+            return self._file_digest(path)
+        if not path.is_dir():
+            return 'missing'
+        return self._tree_digest(path, excludes)
+
+    def _tree_digest(self, path: Path, excludes: list) -> str:
+        """
+        Digest of a directory from the digests of its entries (subdirectories recursively).
+
+        Under a long-lived controller (utils.warm) the digest of every directory
+        the server watches is kept between builds, so an unchanged subtree is
+        neither walked nor stat'ed again.
+        """
+        trees = warm.index('trees')
+        key = (os.path.realpath(path), tuple(excludes))
+        reuse = warm.watched(path)
+        if reuse and key in trees:
+            return trees[key]
+
+        sha = hashlib.sha256()
+        try:
+            entries = sorted(os.scandir(path), key=lambda e: e.name)
+        except OSError:
+            return 'unreadable'
+        for entry in entries:
+            if entry.name in excludes:
+                continue
+            full = Path(entry.path)
+            if entry.is_symlink():
+                # Symlinked directories are recorded, not followed
+                digest = 'link:' + os.readlink(full)
+            elif entry.is_dir():
+                digest = 'dir:' + self._tree_digest(full, excludes)
+            else:
+                try:
+                    mode = entry.stat().st_mode & 0o777
+                except OSError:
+                    mode = 0
+                digest = f"{mode:o}:{self._file_digest(full)}"
+            sha.update(f"{entry.name}\0{digest}\n".encode())
+        digest = sha.hexdigest()
+        if reuse:
+            trees[key] = digest
+        return digest
+
+    def fingerprint(self, phase_name: str, spec: dict) -> str:
+        """
+        Compute (once per run) the fingerprint of a phase's declared inputs.
+
+        Upstream phases must be fingerprinted first; their fingerprints stand in
+        for their results, since a phase's result is a function of its inputs.
+
+        Args:
+            phase_name: Phase to fingerprint
+            spec: The phase's "cache" declaration
+
+        Returns:
+            str: Hex fingerprint
+        """
+        if phase_name in self.fingerprints:
+            return self.fingerprints[phase_name]
+
+        inputs = spec.get('inputs', {})
+        excludes = DEFAULT_EXCLUDES + inputs.get('exclude', [])
+        material = {
+            'phase': phase_name,
+            'code': {name: self._path_digest(self.index_path / name, excludes)
+                     for name in (phase_name, 'utils')},
+            'files': {},
+            'package_lists': {},
+            'env': {},
+            'upstream': {},
+        }
+        for template in inputs.get('files', []):
+            path = Path(self.expand(template))
+            material['files'][template] = self._path_digest(path, excludes)
+        for template in inputs.get('package_lists', []):
+            path = Path(self.expand(template))
+            material['package_lists'][template] = sorted(set(read_package_list(path)))
+        for name in inputs.get('env', []):
+            material['env'][name] = os.environ.get(name)
+        for name in inputs.get('upstream', []):
+            material['upstream'][name] = self.fingerprints.get(name, 'uncached')
+
+        encoded = json.dumps(material, sort_keys=True).encode()
+        fp = hashlib.sha256(encoded).hexdigest()
+        self.fingerprints[phase_name] = fp
+        return fp
+
+    def lookup(self, phase_name: str, spec: dict, outputs: Optional[list] = None) -> Tuple[Optional[dict], str]:
+        """
+        Find a stored result for the phase's current inputs.
+
+        Args:
+            phase_name: Phase to look up
+            spec: The phase's "cache" declaration
+            outputs: The phase's declared outputs, which must all still exist
+
+        Returns:
+            Tuple of (stored result or None, reason for the hit or miss)
+        """
+        fp = self.fingerprint(phase_name, spec)
+        record = self._load_json(self.cache_dir / 'phases' / f'{phase_name}.json')
+        if not record:
+            return None, 'no stored result'
+        if record.get('fingerprint') != fp:
+            return None, 'inputs changed'
+        missing = missing_outputs(outputs or [], self.variables)
+        if missing:
+            return None, f"output missing: {missing[0]}"
+        return record.get('result', {}), f"fingerprint {fp[:12]}"
+
+    def store(self, phase_name: str, result: dict) -> None:
+        """Record a successful phase result under its fingerprint."""
+        fp = self.fingerprints.get(phase_name)
+        if fp is None:
+            return
+        with self._lock:
+            self._write_json(self.cache_dir / 'phases' / f'{phase_name}.json', {
+                'fingerprint': fp,
+                'stored_at': time.time(),
+                'result': result,
+            })
+        self.save()
+
+    def invalidate(self, phase_name: str) -> None:
+        """Drop a phase's stored result (its outputs are about to be rebuilt)."""
+        try:
+            (self.cache_dir / 'phases' / f'{phase_name}.json').unlink()
+        except OSError:
+            pass
+
+    def save(self) -> None:
+        """Persist the file digest memo."""
+        with self._lock:
+            if self._digests_dirty:
+                self._write_json(self.cache_dir / 'digests.json', dict(self._digests))
+                self._digests_dirty = False
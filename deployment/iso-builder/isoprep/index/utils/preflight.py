@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Preflight Utility
+Copyright (C) 2024 HOMESERVER LLC
+
+Estimates the disk space each phase of the build will need and checks it
+against the free space of the filesystems involved, before any expensive work:
+
+    package_management  mirror packages (with dependencies) not yet in the cache store
+    profile_assembly    the source tree injected into the profile
+    build               the pacstrapped root (installed size of the ISO's packages),
+                        the offline mirror packed into it, the squashfs image and
+                        the ISO (the last ISO's size from the build ledger)
+
+Download sizes come from the dependency closure over the sync databases the
+downloader keeps in the cache store, else from the host's pacman sync
+databases; without either the estimate falls back to the cache store's
+average package size. A short
+sequential-write probe measures the work filesystem's throughput.
+"""
+
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from .cache_store import _reflink
+from .colors import Colors
+from .dep_resolver import resolve_closure
+from .package_index import package_index
+from .package_utils import collect_mirror_packages, read_package_list
+from .sync_db import read_pacman_conf, read_sync_dbs
+
+# Repository top level (contains lib/controller)
+_TOP_LEVEL = Path(__file__).resolve().parents[5]
+
+MIB = 1024 * 1024
+GIB = 1024 * MIB
+FALLBACK_PACKAGE_SIZE = 4 * MIB      # per package, when pacman cannot tell
+FALLBACK_INSTALLED_SIZE = 6 * GIB    # pacstrapped root, when pacman cannot tell
+SQUASHFS_RATIO = 0.45                # squashfs size / installed size, without a ledger
+ISO_OVERHEAD = 256 * MIB             # boot files around the squashfs image
+
+_PKG_FILE = re.compile(r'^(?P<name>.+)-[^-]+-[^-]+-[^-]+\.pkg\.tar\.[a-z0-9]+$')
+_SIZE = re.compile(r'([\d.]+)\s*(B|KiB|MiB|GiB|TiB)')
+_UNITS = {'B': 1, 'KiB': 1024, 'MiB': MIB, 'GiB': GIB, 'TiB': 1024 * GIB}
+
+
+@dataclass
+class SpaceNeed:
+    """Space one phase is expected to consume below a path."""
+    phase: str
+    what: str
+    path: Path
+    size: int
+
+
+def _fmt(count: float) -> str:
+    for unit in ('B', 'K', 'M', 'G'):
+        if abs(count) < 1024 or unit == 'G':
+            return f"{count:.0f}{unit}" if unit == 'B' else f"{count:.1f}{unit}"
+        count /= 1024
+    return f"{count:.1f}G"
+
+
+def _existing(path: Path) -> Path:
+    """Nearest existing ancestor of path (statvfs needs one)."""
+    path = Path(path)
+    while not path.exists() and path != path.parent:
+        path = path.parent
+    return path
+
+
+def free_bytes(path: Path) -> int:
+    """Bytes available to unprivileged writers on path's filesystem."""
+    st = os.statvfs(_existing(path))
+    return st.f_bavail * st.f_frsize
+
+
+def tree_size(path: Path, excludes: Iterable[str] = ('.git',)) -> int:
+    """Apparent size of the regular files in a tree."""
+    excludes = set(excludes)
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [d for d in dirnames if d not in excludes]
+        for name in filenames:
+            try:
+                st = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            total += st.st_size
+    return total
+
+
+def pacman_download_sizes(packages: List[str], config: Optional[Path] = None) -> Optional[Dict[str, int]]:
+    """
+    Download size of packages and their dependencies, from the host's sync databases.
+
+    Returns:
+        Name -> download size, or None if pacman cannot resolve the set
+    """
+    targets = list(packages)
+    for _ in range(3):
+        cmd = ['pacman', '-Sp', '--print-format', '%n %s']
+        if config:
+            cmd += ['--config', str(config)]
+        try:
+            result = subprocess.run(cmd + targets, capture_output=True, text=True,
+                                    env={**os.environ, 'LC_ALL': 'C'})
+        except OSError:
+            return None
+        if result.returncode == 0:
+            sizes = {}
+            for line in result.stdout.splitlines():
+                name, _, size = line.rpartition(' ')
+                if name and size.isdigit():
+                    sizes[name] = int(size)
+            return sizes
+        # Drop targets pacman does not know and retry
+        missing = set(re.findall(r'target not found: (\S+)', result.stderr))
+        if not missing:
+            return None
+        targets = [t for t in targets if t not in missing]
+    return None
+
+
+def closure_download_sizes(packages: List[str], store_dir: Path,
+                           config: Optional[Path] = None) -> Optional[Dict[str, int]]:
+    """
+    Download size of what the offline mirror still lacks, from the dependency
+    closure over the sync databases kept next to it in the cache store.
+
+    Returns:
+        Name -> download size of the packages to fetch, or None if the cached
+        databases cannot resolve the set
+    """
+    db_dir = store_dir.parent / 'sync-db'
+    try:
+        conf = read_pacman_conf(config or Path('/etc/pacman.conf'))
+    except OSError:
+        return None
+    sync_dbs = read_sync_dbs(db_dir, conf.repos)
+    if not any(sync_dbs.values()):
+        return None
+    cached = package_index(store_dir).names() if store_dir.is_dir() else {}
+    resolution = resolve_closure(packages, [('cache', cached)] + list(sync_dbs.items()))
+    if resolution.missing:
+        return None
+    return {name: package.csize for name, (source, package) in resolution.packages.items() if source != 'cache'}
+
+
+def pacman_installed_size(packages: List[str], config: Optional[Path] = None) -> Optional[int]:
+    """Total installed size of packages and their dependencies, or None if unknown."""
+    closure = pacman_download_sizes(packages, config)
+    if not closure:
+        return None
+    cmd = ['pacman', '-Si']
+    if config:
+        cmd += ['--config', str(config)]
+    try:
+        result = subprocess.run(cmd + sorted(closure), capture_output=True, text=True,
+                                env={**os.environ, 'LC_ALL': 'C'})
+    except OSError:
+        return None
+    total = 0
+    for line in result.stdout.splitlines():
+        if line.startswith('Installed Size'):
+            match = _SIZE.search(line)
+            if match:
+                total += int(float(match.group(1)) * _UNITS[match.group(2)])
+    return total or None
+
+
+def cached_package_names(store_dir: Path) -> Dict[str, int]:
+    """Package name -> file size of the packages already in the cache store."""
+    cached = {}
+    if store_dir.is_dir():
+        for pkg in store_dir.glob('*.pkg.tar.*'):
+            match = _PKG_FILE.match(pkg.name)
+            if match and not pkg.name.endswith('.sig'):
+                cached[match.group('name')] = pkg.stat().st_size
+    return cached
+
+
+def last_iso_size() -> Optional[int]:
+    """Size of the ISO of the last successful build, from the controller's build ledger."""
+    if str(_TOP_LEVEL) not in sys.path:
+        sys.path.append(str(_TOP_LEVEL))
+    try:
+        from lib.controller.stats import load_records
+    except ImportError:
+        return None
+    for record in reversed(load_records(20)):
+        size = record.get('artifacts', {}).get('iso_size')
+        if record.get('exit_code') == 0 and size:
+            return size
+    return None
+
+
+def reflink_supported(directory: Path) -> bool:
+    """True if files in directory can be cloned (cp then copies the mirror for free)."""
+    try:
+        with tempfile.NamedTemporaryFile(dir=directory, prefix='.reflink-probe-') as src:
+            src.write(b'homerchy')
+            src.flush()
+            clone = src.name + '.clone'
+            try:
+                _reflink(src.name, clone)
+            except OSError:
+                return False
+            os.unlink(clone)
+            return True
+    except OSError:
+        return False
+
+
+def write_probe(directory: Path, size: int = 64 * MIB, chunk: int = 4 * MIB) -> Optional[float]:
+    """
+    Sequential-write throughput of directory's filesystem (bytes/s), written and fsynced.
+
+    Returns:
+        Throughput, or None if the probe could not run
+    """
+    block = os.urandom(chunk)
+    try:
+        fd, path = tempfile.mkstemp(dir=directory, prefix='.write-probe-')
+    except OSError:
+        return None
+    try:
+        start = time.monotonic()
+        written = 0
+        while written < size:
+            written += os.write(fd, block)
+        os.fsync(fd)
+        elapsed = time.monotonic() - start
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+        os.unlink(path)
+    return written / elapsed if elapsed > 0 else None
+
+
+def estimate(repo_root: Path, work_dir: Path, store_dir: Path) -> List[SpaceNeed]:
+    """
+    Estimate what each phase of the coming build will write.
+
+    Args:
+        repo_root: Root of the repository (deployment/)
+        work_dir: Build work directory
+        store_dir: Offline mirror in the cache store
+
+    Returns:
+        Space needs, per phase and location
+    """
+    download_conf = repo_root / 'iso-builder' / 'configs' / 'pacman-download.conf'
+    config = download_conf if download_conf.exists() else None
+    cached = cached_package_names(store_dir)
+    store_size = sum(cached.values())
+
+    # package_management: what the downloader will still fetch
+    packages, _ = collect_mirror_packages(repo_root)
+    delta = closure_download_sizes(packages, store_dir, config)
+    closure = pacman_download_sizes(packages, config) if delta is None else None
+    if delta is not None:
+        downloads = sum(delta.values())
+        detail = f"{len(delta)} packages to download"
+    elif closure is not None:
+        downloads = sum(size for name, size in closure.items() if name not in cached)
+        detail = f"{len([n for n in closure if n not in cached])} packages to download"
+    else:
+        missing = [p for p in packages if p not in cached]
+        average = store_size // len(cached) if cached else FALLBACK_PACKAGE_SIZE
+        downloads = len(missing) * average
+        detail = f"~{len(missing)} packages to download (pacman sizes unavailable)"
+    mirror_size = store_size + downloads
+
+    # profile_assembly: the injected source tree
+    source = tree_size(repo_root)
+
+    # build: pacstrap root + packed mirror + squashfs + ISO
+    iso_packages = read_package_list(repo_root / 'iso-builder' / 'archiso' / 'configs' / 'releng' / 'packages.x86_64')
+    installed = pacman_installed_size(iso_packages, config) if iso_packages else None
+    installed = installed or FALLBACK_INSTALLED_SIZE
+    archiso_tmp = work_dir / 'archiso-tmp'
+    mirror_copy = 0 if reflink_supported(_existing(work_dir)) else mirror_size
+    iso = last_iso_size() or int((installed + source) * SQUASHFS_RATIO) + mirror_size + ISO_OVERHEAD
+    squashfs = max(iso - ISO_OVERHEAD, 0)
+
+    return [
+        SpaceNeed('package_management', detail, store_dir, downloads),
+        SpaceNeed('profile_assembly', 'source tree injected into the profile', work_dir / 'profile', source),
+        SpaceNeed('build', 'pacstrapped root (installed size)', archiso_tmp, installed),
+        SpaceNeed('build', 'offline mirror packed into the root' + (' (reflinked)' if not mirror_copy else ''),
+                  archiso_tmp, mirror_copy),
+        SpaceNeed('build', 'squashfs image', archiso_tmp, squashfs),
+        SpaceNeed('build', 'ISO image', work_dir / 'isoout', iso),
+    ]
+
+
+def reclaimable(work_dir: Path, needed: int) -> Optional[str]:
+    """Suggest a cache eviction that would free `needed` bytes (None if none would)."""
+    if str(_TOP_LEVEL) not in sys.path:
+        sys.path.append(str(_TOP_LEVEL))
+    try:
+        from lib.controller import cache
+    except ImportError:
+        return None
+    # Evicting current mirror packages would only add downloads
+    entries = [e for e in cache.scan(work_dir) if e.tier < cache.TIER_PACKAGE]
+    total = sum(e.size for e in entries)
+    if total < needed:
+        return None
+    plan = cache.plan_eviction(entries, total - needed)
+    quota = sum(e.size for e in cache.scan(work_dir)) - sum(e.size for e in plan)
+    return (f"HOMERCHY_CACHE_QUOTA={_fmt(quota)} controller --cache trim  "
+            f"(evicts {len(plan)} stale entries, {_fmt(sum(e.size for e in plan))})")
+
+
+def run_preflight(repo_root: Path, work_dir: Path, store_dir: Path, config: dict) -> bool:
+    """
+    Check that the build fits on disk before it starts.
+
+    Args:
+        repo_root: Root of the repository (deployment/)
+        work_dir: Build work directory
+        store_dir: Offline mirror in the cache store
+        config: The prepare phase's "preflight" settings (margin, probe_mb, min_write_mb_s)
+
+    Returns:
+        bool: False if the build is expected to run out of space
+    """
+    print(f"{Colors.BLUE}Preflight: estimating disk space for this build...{Colors.NC}")
+    needs = estimate(repo_root, work_dir, store_dir)
+    margin = float(config.get('margin', 0.10))
+
+    for need in needs:
+        print(f"  {need.phase:<20} {_fmt(need.size):>8}  {need.what}")
+
+    # Group by filesystem: the work dir and the store usually share /mnt/work
+    by_fs: Dict[int, List[SpaceNeed]] = {}
+    for need in needs:
+        by_fs.setdefault(os.stat(_existing(need.path)).st_dev, []).append(need)
+
+    ok = True
+    for group in by_fs.values():
+        location = _existing(group[0].path)
+        required = int(sum(n.size for n in group) * (1 + margin))
+        available = free_bytes(location)
+        if required <= available:
+            print(f"{Colors.GREEN}✓ {_fmt(available)} free on {location}, "
+                  f"~{_fmt(required)} needed (with {margin:.0%} margin){Colors.NC}")
+            continue
+        ok = False
+        shortfall = required - available
+        print(f"{Colors.RED}ERROR: Not enough space on {location}: ~{_fmt(required)} needed, "
+              f"{_fmt(available)} free (short by {_fmt(shortfall)}){Colors.NC}")
+        suggestion = reclaimable(work_dir, shortfall)
+        if suggestion:
+            print(f"{Colors.YELLOW}  Free space by evicting stale build caches:\n    {suggestion}{Colors.NC}")
+        else:
+            print(f"{Colors.YELLOW}  Free space on {location} (controller -E removes every build cache){Colors.NC}")
+
+    probe_mb = int(config.get('probe_mb', 64))
+    if ok and probe_mb > 0:
+        rate = write_probe(_existing(work_dir), probe_mb * MIB)
+        if rate is not None:
+            written = sum(n.size for n in needs)
+            print(f"  Sequential write on {_existing(work_dir)}: {rate / MIB:.0f} MiB/s "
+                  f"(~{written / rate:.0f}s for this build's writes)")
+            if rate < float(config.get('min_write_mb_s', 50)) * MIB:
+                print(f"{Colors.YELLOW}WARNING: The work filesystem is slow; "
+                      f"expect I/O-bound phases{Colors.NC}")
+    return ok
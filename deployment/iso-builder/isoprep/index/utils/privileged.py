@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Privileged Operations Utility
+Copyright (C) 2024 HOMESERVER LLC
+
+Root filesystem operations for build phases. Routed through the controller's
+long-lived privileged helper (lib/controller/privhelper.py), which is shared
+with this process when the build is started by the controller. Falls back to
+one sudo call per operation when the helper is not importable.
+"""
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+# Repository top level (contains lib/controller)
+_TOP_LEVEL = Path(__file__).resolve().parents[5]
+
+_helper = None
+_helper_loaded = False
+
+
+def _get_helper():
+    """Return the shared privileged helper, or None to use plain sudo."""
+    global _helper, _helper_loaded
+    if not _helper_loaded:
+        _helper_loaded = True
+        if str(_TOP_LEVEL) not in sys.path:
+            sys.path.append(str(_TOP_LEVEL))
+        try:
+            from lib.controller.privhelper import get_helper
+            _helper = get_helper()
+        except ImportError:
+            _helper = None
+    return _helper
+
+
+def _sudo_argv(op: dict) -> list:
+    """Translate a helper operation into the equivalent sudo command."""
+    kind = op['op']
+    if kind == 'rename':
+        return ['sudo', 'mv', op['src'], op['dst']]
+    if kind == 'rmtree':
+        return ['sudo', 'rm', '-rf', op['path']]
+    if kind == 'rmdir':
+        return ['sudo', 'rmdir', op['path']]
+    if kind == 'unlink':
+        return ['sudo', 'rm', '-f', op['path']]
+    if kind == 'mkdir':
+        return ['sudo', 'mkdir', '-p', op['path']]
+    if kind == 'chown':
+        flags = ['-R'] if op.get('recursive', True) else []
+        return ['sudo', 'chown'] + flags + [f"{op['uid']}:{op['gid']}", op['path']]
+    if kind == 'symlink':
+        return ['sudo', 'ln', '-sfn', op['target'], op['link']]
+    raise ValueError(f"Unsupported privileged operation: {kind}")
+
+
+def run_privileged(ops: list, check: bool = True) -> bool:
+    """
+    Run a batch of privileged operations.
+
+    Args:
+        ops: Operation dicts ({'op': 'rename', 'src': ..., 'dst': ...} etc.)
+        check: Whether a failed operation aborts the build
+
+    Returns:
+        bool: True if every operation succeeded
+    """
+    ops = [{k: (str(v) if isinstance(v, Path) else v) for k, v in op.items()} for op in ops]
+    helper = _get_helper()
+    if helper is not None:
+        results = helper.batch(ops, check=check)
+        return all(r.get('ok') for r in results)
+
+    ok = True
+    for op in ops:
+        result = subprocess.run(_sudo_argv(op), check=check)
+        ok = ok and result.returncode == 0
+    return ok
+
+
+def sudo_move(src: Path, dst: Path, check: bool = True) -> bool:
+    """Move src to dst as root."""
+    return run_privileged([{'op': 'rename', 'src': src, 'dst': dst}], check=check)
+
+
+def sudo_rmtree(path: Path, check: bool = False) -> bool:
+    """Remove a file or directory tree as root."""
+    return run_privileged([{'op': 'rmtree', 'path': path}], check=check)
+
+
+def sudo_unlink(path: Path, check: bool = False) -> bool:
+    """Remove a single file or symlink as root."""
+    return run_privileged([{'op': 'unlink', 'path': path}], check=check)
+
+
+def sudo_mkdir(path: Path, check: bool = True) -> bool:
+    """Create a directory (and parents) as root."""
+    return run_privileged([{'op': 'mkdir', 'path': path}], check=check)
+
+
+def sudo_chown(path: Path, recursive: bool = True, check: bool = True) -> bool:
+    """Give path (recursively by default) to the current user."""
+    return run_privileged([{'op': 'chown', 'path': path, 'uid': os.getuid(),
+                            'gid': os.getgid(), 'recursive': recursive}], check=check)
+
+
+def sudo_symlink(target: Path, link: Path, check: bool = True) -> bool:
+    """Create or replace link -> target as root."""
+    return run_privileged([{'op': 'symlink', 'target': target, 'link': link}], check=check)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Profiler Utility
+Copyright (C) 2024 HOMESERVER LLC
+
+Per-phase and per-step resource accounting: wall time, CPU time, peak RSS,
+I/O bytes and the rusage of child processes (mkarchiso, pacman), plus named
+counters phases add to (bytes injected, packages downloaded) for the
+controller's build ledger and metrics.
+
+CPU and I/O are measured for the calling thread, so steps running side by
+side (execution.parallel) do not count each other's work. Child rusage is
+only available per process and covers every child reaped during the step.
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List
+
+_IO_FIELDS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+_RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+
+@dataclass
+class StepProfile:
+    """Resource usage of one phase or step."""
+    name: str
+    wall: float = 0.0
+    cpu: float = 0.0
+    max_rss_kb: int = 0
+    rchar: int = 0
+    wchar: int = 0
+    read_bytes: int = 0
+    write_bytes: int = 0
+    child_cpu: float = 0.0
+    child_max_rss_kb: int = 0
+    started: float = 0.0
+    ok: bool = True
+    cached: bool = False
+
+
+_records: List[StepProfile] = []
+_counters: Dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def _read_io() -> Dict[str, int]:
+    """Read the I/O counters of the current thread (falls back to the process)."""
+    counters = dict.fromkeys(_IO_FIELDS, 0)
+    for path in ('/proc/thread-self/io', '/proc/self/io'):
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in counters:
+                        counters[key] = int(value)
+            return counters
+        except (OSError, ValueError):
+            continue
+    return counters
+
+
+def _cpu(usage) -> float:
+    return usage.ru_utime + usage.ru_stime
+
+
+@contextmanager
+def profile_step(name: str):
+    """
+    Record the resources used by the enclosed block under name.
+
+    Args:
+        name: Step name, e.g. "build" or "profile_assembly/inject_repository_source"
+    """
+    record = StepProfile(name=name, started=time.time())
+    start_wall = time.monotonic()
+    start_self = resource.getrusage(_RUSAGE_THREAD)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_io = _read_io()
+    try:
+        yield record
+    except BaseException:
+        record.ok = False
+        raise
+    finally:
+        end_self = resource.getrusage(_RUSAGE_THREAD)
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        end_io = _read_io()
+        record.wall = time.monotonic() - start_wall
+        record.cpu = _cpu(end_self) - _cpu(start_self)
+        # ru_maxrss is a high-water mark: the peak reached by the end of this step
+        record.max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        record.child_cpu = _cpu(end_children) - _cpu(start_children)
+        record.child_max_rss_kb = end_children.ru_maxrss
+        for key in _IO_FIELDS:
+            setattr(record, key, max(end_io[key] - start_io[key], 0))
+        with _lock:
+            _records.append(record)
+
+
+def profiled(name: str):
+    """Decorator form of profile_step."""
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            with profile_step(name):
+                return func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+    return decorator
+
+
+def count(name: str, value: float = 1) -> None:
+    """
+    Add to a named counter of this build.
+
+    Args:
+        name: Counter name, e.g. "package_management/packages_downloaded"
+        value: Amount to add
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def profile_counters() -> Dict[str, float]:
+    """Return the counters of this build."""
+    with _lock:
+        return dict(_counters)
+
+
+def reset_profile() -> None:
+    """Forget recorded steps and counters (a new build in the same process)."""
+    with _lock:
+        _records.clear()
+        _counters.clear()
+
+
+def profile_records() -> List[dict]:
+    """Return every recorded step in start order."""
+    with _lock:
+        return [asdict(r) for r in sorted(_records, key=lambda r: r.started)]
+
+
+def write_profile(path: Path) -> None:
+    """
+    Write the recorded steps to path as JSON.
+
+    Args:
+        path: Destination file (written atomically)
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump({'steps': profile_records(), 'counters': profile_counters()}, f, indent=2)
+    os.replace(tmp, path)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Incremental Rebuild Planning
+Copyright (C) 2024 HOMESERVER LLC
+
+Maps changed source paths to the build work that consumes them, so a
+development loop (controller --watch) reruns only that work on top of the
+previous build's profile and mirror:
+
+    install/, any source file        profile_assembly: inject_repository_source
+    iso-builder/configs/             profile_assembly: apply_custom_overlays
+    vmtools/index.json               profile_assembly: inject_vm_profile, package_management
+    *.packages, mirror package lists package_management
+    iso-builder/configs/pacman.conf  (installed by the build phase itself)
+    iso-builder/archiso/ (releng)    profile_assembly: every step
+    iso-builder/isoprep/ (builder)   full build with the new builder code (builder=True)
+
+The build phase (mkarchiso) always runs; profile_assembly also reruns the
+steps after the ones named here (see utils.dag.with_dependents).
+"""
+
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from .package_utils import MIRROR_PACKAGE_LISTS, VARIANTS_FILE
+
+# Paths that never affect the ISO (editor scratch files, bytecode, build output)
+IGNORED_DIRS = frozenset({'.git', '__pycache__', 'isoprep-work'})
+IGNORED_SUFFIXES = ('.pyc', '.swp', '.swx', '~')
+IGNORED_PREFIXES = ('.#',)
+
+# Phases an incremental rebuild may run, in order (prepare only sets up a fresh build)
+REBUILD_PHASES = ('package_management', 'profile_assembly', 'build')
+
+
+@dataclass
+class RebuildPlan:
+    """Phases (and profile_assembly steps) an edit requires; full means a regular build."""
+    full: bool = False
+    builder: bool = False                                          # the build code itself changed
+    phases: List[str] = field(default_factory=list)
+    steps: Dict[str, List[str]] = field(default_factory=dict)
+    whole: Set[str] = field(default_factory=set)                   # phases to rerun in full
+    reasons: Dict[str, List[str]] = field(default_factory=dict)    # changed path -> what it triggers
+
+    def add(self, path: str, phase: str, step: Optional[str] = None) -> None:
+        if phase not in self.phases:
+            self.phases.append(phase)
+        if step is None:
+            self.whole.add(phase)
+        elif step not in self.steps.setdefault(phase, []):
+            self.steps[phase].append(step)
+        self.reasons.setdefault(path, []).append(f"{phase}/{step}" if step else phase)
+
+    def build_options(self) -> dict:
+        """BuildConfig fields for this plan (empty for a full build)."""
+        if self.full:
+            return {}
+        phases = [name for name in REBUILD_PHASES if name in self.phases or name == 'build']
+        steps = {name: list(steps) for name, steps in self.steps.items() if name not in self.whole}
+        return {'phases': phases, 'steps': steps}
+
+
+def _ignored(relative: Path) -> bool:
+    if any(part in IGNORED_DIRS for part in relative.parts):
+        return True
+    name = relative.name
+    return name.endswith(IGNORED_SUFFIXES) or name.startswith(IGNORED_PREFIXES) or name.isdigit()
+
+
+def plan_rebuild(repo_root: Path, changed: Iterable[str]) -> Optional[RebuildPlan]:
+    """
+    Decide what to rebuild for a set of changed paths.
+
+    Args:
+        repo_root: Root of the repository (deployment/)
+        changed: Changed paths (absolute)
+
+    Returns:
+        The plan, or None if nothing that goes into the ISO changed
+    """
+    root = Path(os.path.realpath(repo_root))
+    package_lists = {Path(p) for p in MIRROR_PACKAGE_LISTS}
+    plan = RebuildPlan()
+    for path in changed:
+        try:
+            relative = Path(os.path.realpath(path)).relative_to(root)
+        except ValueError:
+            continue
+        if relative == Path('.'):
+            # The whole tree (the watcher lost events)
+            plan.full = True
+            plan.reasons[path] = ['full build']
+            continue
+        if _ignored(relative):
+            continue
+        parts = relative.parts
+        if parts[:2] == ('iso-builder', 'isoprep'):
+            plan.full = plan.builder = True
+            plan.reasons[str(relative)] = ['builder changed']
+            continue
+        # Everything under deployment/ is copied into the ISO's /root/homerchy
+        plan.add(str(relative), 'profile_assembly', 'inject_repository_source')
+        if parts[:2] == ('iso-builder', 'archiso'):
+            plan.add(str(relative), 'profile_assembly')
+        elif parts[:2] == ('iso-builder', 'configs') and relative.name != 'pacman.conf':
+            if relative.name == 'pacman-download.conf':
+                plan.add(str(relative), 'package_management')
+            else:
+                plan.add(str(relative), 'profile_assembly', 'apply_custom_overlays')
+        if relative == Path(VARIANTS_FILE):
+            plan.add(str(relative), 'profile_assembly', 'inject_vm_profile')
+            plan.add(str(relative), 'package_management')
+        if relative in package_lists or relative.suffix == '.packages':
+            plan.add(str(relative), 'package_management')
+    if not plan.full and not plan.phases:
+        return None
+    return plan
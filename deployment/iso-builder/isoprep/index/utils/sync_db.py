@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Sync Database Utility
+Copyright (C) 2024 HOMESERVER LLC
+
+Reads what pacman would read to download packages, without pacman:
+
+    read_pacman_conf  repositories and their mirrors ($repo/$arch expanded,
+                      Include'd mirrorlists followed), ParallelDownloads,
+                      the global SigLevel
+    read_sync_db      the packages of a sync database (<repo>.db): file
+                      name, checksum, sizes, dependencies and provides
+
+Sync databases are kept in pacman's layout (<dbpath>/sync/<repo>.db), so the
+same directory also works as pacman's --dbpath.
+"""
+
+import glob
+import os
+import tarfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .package_index import open_package
+
+DEFAULT_PARALLEL_DOWNLOADS = 5
+DEFAULT_SIG_LEVEL = ['Required', 'DatabaseOptional']
+
+
+@dataclass
+class Repo:
+    """One [repo] section of pacman.conf."""
+    name: str
+    servers: List[str] = field(default_factory=list)
+
+
+@dataclass
+class PacmanConf:
+    """What the offline-mirror downloader needs from pacman.conf."""
+    arch: str
+    parallel_downloads: int = DEFAULT_PARALLEL_DOWNLOADS
+    sig_level: List[str] = field(default_factory=lambda: list(DEFAULT_SIG_LEVEL))
+    repos: List[Repo] = field(default_factory=list)
+
+
+@dataclass
+class SyncPackage:
+    """One package of a sync database."""
+    repo: str
+    name: str
+    version: str
+    filename: str
+    sha256: str = ''
+    csize: int = 0
+    isize: int = 0
+    groups: List[str] = field(default_factory=list)
+    depends: List[str] = field(default_factory=list)
+    provides: List[str] = field(default_factory=list)
+    conflicts: List[str] = field(default_factory=list)
+    replaces: List[str] = field(default_factory=list)
+
+
+def _pairs(path: Path):
+    """(key, value) of each option line of a pacman config file, with section headers as ('[', name)."""
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                yield '[', line[1:-1]
+            else:
+                key, _, value = line.partition('=')
+                yield key.strip(), value.strip()
+
+
+def read_pacman_conf(conf: Path) -> PacmanConf:
+    """
+    Repositories, mirrors, download parallelism and signature level of a pacman.conf.
+
+    Args:
+        conf: pacman.conf (pacman-download.conf for the offline mirror)
+
+    Returns:
+        PacmanConf; repos in file order, servers in mirrorlist order
+
+    Raises:
+        OSError: If conf cannot be read
+    """
+    result = PacmanConf(arch=os.uname().machine)
+    section: Optional[str] = None
+    servers: Dict[str, List[str]] = {}
+
+    def add_server(url: str) -> None:
+        if section and section != 'options':
+            servers[section].append(url)
+
+    for key, value in _pairs(conf):
+        if key == '[':
+            section = value
+            if section != 'options':
+                servers.setdefault(section, [])
+                result.repos.append(Repo(section))
+        elif section == 'options' and key == 'Architecture':
+            if value.split()[0] != 'auto':
+                result.arch = value.split()[0]
+        elif section == 'options' and key == 'ParallelDownloads':
+            try:
+                result.parallel_downloads = max(1, int(value))
+            except ValueError:
+                pass
+        elif section == 'options' and key == 'SigLevel':
+            result.sig_level = value.split()
+        elif key == 'Server':
+            add_server(value)
+        elif key == 'Include':
+            for included in sorted(glob.glob(value)):
+                try:
+                    for inc_key, inc_value in _pairs(Path(included)):
+                        if inc_key == 'Server':
+                            add_server(inc_value)
+                except OSError:
+                    continue
+
+    for repo in result.repos:
+        repo.servers = [url.replace('$repo', repo.name).replace('$arch', result.arch).rstrip('/')
+                        for url in servers[repo.name]]
+    return result
+
+
+def _fields(text: str) -> Dict[str, List[str]]:
+    fields, key = {}, None
+    for line in text.splitlines():
+        if line.startswith('%') and line.endswith('%') and len(line) > 2:
+            key = line[1:-1]
+            fields[key] = []
+        elif line and key:
+            fields[key].append(line)
+    return fields
+
+
+def read_sync_db(db_path: Path, repo: str) -> Dict[str, SyncPackage]:
+    """
+    Packages of a sync database.
+
+    Args:
+        db_path: <repo>.db (gzip or zstd compressed tar of <name>-<version>/desc)
+        repo: Repository name
+
+    Returns:
+        SyncPackage by package name (empty if the database cannot be read)
+    """
+    packages, by_dir = {}, {}
+    try:
+        with open_package(db_path) as tar:
+            for member in tar:
+                if not member.isfile() or not member.name.endswith(('/desc', '/depends')):
+                    continue
+                fields = _fields(tar.extractfile(member).read().decode('utf-8', errors='replace'))
+                dirname = member.name.rsplit('/', 1)[0]
+                if member.name.endswith('/depends'):
+                    # Databases written before pacman 5 keep dependencies apart from desc
+                    package = by_dir.get(dirname)
+                    if package is not None:
+                        package.depends += fields.get('DEPENDS', [])
+                        package.provides += fields.get('PROVIDES', [])
+                        package.conflicts += fields.get('CONFLICTS', [])
+                        package.replaces += fields.get('REPLACES', [])
+                    continue
+
+                def one(key: str, default: str = '') -> str:
+                    return (fields.get(key) or [default])[0]
+
+                try:
+                    csize, isize = int(one('CSIZE', '0')), int(one('ISIZE', '0'))
+                except ValueError:
+                    csize = isize = 0
+                name = one('NAME')
+                if not name:
+                    continue
+                packages[name] = by_dir[dirname] = SyncPackage(
+                    repo=repo, name=name, version=one('VERSION'), filename=one('FILENAME'),
+                    sha256=one('SHA256SUM'), csize=csize, isize=isize,
+                    groups=fields.get('GROUPS', []), depends=fields.get('DEPENDS', []),
+                    provides=fields.get('PROVIDES', []), conflicts=fields.get('CONFLICTS', []),
+                    replaces=fields.get('REPLACES', []),
+                )
+    except (OSError, EOFError, tarfile.TarError):
+        return {}
+    return packages
+
+
+def read_sync_dbs(db_dir: Path, repos: List[Repo]) -> Dict[str, Dict[str, SyncPackage]]:
+    """
+    Every repository's sync database in a pacman dbpath.
+
+    Args:
+        db_dir: dbpath (databases in db_dir/sync/<repo>.db)
+        repos: Repositories, in pacman.conf order
+
+    Returns:
+        SyncPackage by name, per repository name (in pacman.conf order)
+    """
+    return {repo.name: read_sync_db(db_dir / 'sync' / f'{repo.name}.db', repo.name) for repo in repos}
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Package Version Comparison
+Copyright (C) 2024 HOMESERVER LLC
+
+A port of pacman's vercmp (alpm's rpmvercmp over epoch:version-release), so
+package versions are ordered the way pacman orders them: "1.10" is newer than
+"1.9", "1.0" newer than "1.0rc1", any epoch newer than none.
+"""
+
+from typing import Optional, Tuple
+
+
+def _rpmvercmp(a: str, b: str) -> int:
+    """alpm's rpmvercmp: compare alternating numeric and alphabetic segments."""
+    if a == b:
+        return 0
+    i = j = 0
+    one, two = a, b
+    while i < len(one) and j < len(two):
+        start1, start2 = i, j
+        while i < len(one) and not one[i].isalnum():
+            i += 1
+        while j < len(two) and not two[j].isalnum():
+            j += 1
+        if i >= len(one) or j >= len(two):
+            break
+        # Different separator lengths decide it
+        if i - start1 != j - start2:
+            return -1 if i - start1 < j - start2 else 1
+
+        seg1, seg2 = i, j
+        isnum = one[i].isdigit()
+        if isnum:
+            while i < len(one) and one[i].isdigit():
+                i += 1
+            while j < len(two) and two[j].isdigit():
+                j += 1
+        else:
+            while i < len(one) and one[i].isalpha():
+                i += 1
+            while j < len(two) and two[j].isalpha():
+                j += 1
+        part1, part2 = one[seg1:i], two[seg2:j]
+        if not part2:
+            # Segments of different types: numeric is newer than alphabetic
+            return 1 if isnum else -1
+        if isnum:
+            part1, part2 = part1.lstrip('0'), part2.lstrip('0')
+            if len(part1) != len(part2):
+                return 1 if len(part1) > len(part2) else -1
+        if part1 != part2:
+            return 1 if part1 > part2 else -1
+
+    rest1, rest2 = one[i:], two[j:]
+    if not rest1 and not rest2:
+        return 0
+    # A remaining alphabetic part never beats an empty one
+    if (not rest1 and not rest2[:1].isalpha()) or rest1[:1].isalpha():
+        return -1
+    return 1
+
+
+def _split_evr(version: str) -> Tuple[str, str, Optional[str]]:
+    """epoch, version and release (None if absent) of epoch:version-release."""
+    digits = 0
+    while digits < len(version) and version[digits].isdigit():
+        digits += 1
+    if digits < len(version) and version[digits] == ':':
+        epoch, rest = version[:digits] or '0', version[digits + 1:]
+    else:
+        epoch, rest = '0', version
+    if '-' in rest:
+        rest, release = rest.rsplit('-', 1)
+        return epoch, rest, release
+    return epoch, rest, None
+
+
+def vercmp(a: str, b: str) -> int:
+    """
+    Compare two package versions like pacman's vercmp.
+
+    Returns:
+        -1, 0 or 1 as a is older than, equal to or newer than b (the release
+        is only compared when both versions have one)
+    """
+    if a == b:
+        return 0
+    epoch1, version1, release1 = _split_evr(a)
+    epoch2, version2, release2 = _split_evr(b)
+    result = _rpmvercmp(epoch1, epoch2) or _rpmvercmp(version1, version2)
+    if result == 0 and release1 is not None and release2 is not None:
+        result = _rpmvercmp(release1, release2)
+    return result
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+HOMESERVER Homerchy ISO Builder - Warm Index Utility
+Copyright (C) 2024 HOMESERVER LLC
+
+In-memory indexes a long-lived controller (controller --serve) keeps between
+builds, so back-to-back builds skip rescanning what did not change:
+
+    trees     directory digests for the phase cache, keyed by path and excludes
+    source    tree digest of each top-level item last injected into the profile
+    packages  package metadata index of each package directory (utils.package_index)
+
+The server imports this module once and forks every build from itself, so
+each build starts with the indexes left by the previous one; the build dumps
+them to HOMERCHY_WARM_STATE on exit for the server to take back. Tree digests
+are only trusted below the roots the server watches for changes (watched());
+the server drops the entries a change invalidates before the next build.
+
+Outside the server the indexes start empty and nothing is reused.
+"""
+
+import os
+import pickle
+from pathlib import Path
+from typing import Dict, Iterable, List
+
+STATE_ENV = 'HOMERCHY_WARM_STATE'
+
+_indexes: Dict[str, dict] = {}
+_watched: List[str] = []
+
+
+def index(name: str) -> dict:
+    """Return the named index, creating it empty on first use."""
+    return _indexes.setdefault(name, {})
+
+
+def set_watched(roots: Iterable[str]) -> None:
+    """Declare the directory trees whose changes the server reports."""
+    _watched[:] = [os.path.realpath(r) for r in roots]
+
+
+def watched(path) -> bool:
+    """True if changes below path are reported, so cached tree digests can be trusted."""
+    real = os.path.realpath(str(path))
+    return any(real == root or real.startswith(root.rstrip('/') + '/') for root in _watched)
+
+
+def invalidate(paths: Iterable[str]) -> None:
+    """
+    Drop tree digests and injected-source records that changed paths affect.
+
+    A change invalidates the tree of every directory containing it, and every
+    tree below it (a directory may have been replaced).
+
+    Args:
+        paths: Paths reported changed by the watcher
+    """
+    changed = [os.path.realpath(p) for p in paths]
+    if not changed:
+        return
+    for name in ('trees', 'source'):
+        entries = _indexes.get(name)
+        if not entries:
+            continue
+        for key in list(entries):
+            root = key[0] if isinstance(key, tuple) else key
+            for path in changed:
+                if (path == root or path.startswith(root.rstrip('/') + '/')
+                        or root.startswith(path.rstrip('/') + '/')):
+                    del entries[key]
+                    break
+
+
+def dump(path: Path) -> None:
+    """Write every index to path (the build hands its indexes back to the server)."""
+    tmp = Path(str(path) + '.tmp')
+    with open(tmp, 'wb') as f:
+        pickle.dump(_indexes, f)
+    os.replace(tmp, path)
+
+
+def load(path: Path) -> bool:
+    """Replace the indexes with those dumped to path; False if there is nothing usable."""
+    try:
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return False
+    if not isinstance(data, dict):
+        return False
+    _indexes.clear()
+    _indexes.update(data)
+    return True
+
+
+def dump_on_exit() -> None:
+    """Dump the indexes to HOMERCHY_WARM_STATE, if the server asked for them."""
+    target = os.environ.get(STATE_ENV)
+    if target:
+        try:
+            dump(Path(target))
+        except OSError:
+            pass
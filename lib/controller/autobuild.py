@@ -0,0 +1,103 @@
+"""
+Watch mode: rebuild the ISO whenever the sources change (controller --watch).
+
+The first build is a regular one. After that every change under deployment/
+is mapped to the isoprep steps that consume it (isoprep's
+utils/rebuild_plan.py): an edit under install/ reinjects the repository
+source, one under iso-builder/configs/ reapplies the overlays, a package
+list refreshes the offline mirror, and mkarchiso runs last. Changes to the
+builder itself restart watch mode with the new code.
+"""
+
+import importlib
+import os
+import select
+import sys
+import time
+from pathlib import Path
+
+from .build import REPO_ROOT, do_build, load_isoprep
+from .stats import _fmt_secs
+from .watch import TreeWatcher, WatchUnavailable
+from .workdir import WORK_DIR_BASE
+
+DEBOUNCE_ENV = 'HOMERCHY_WATCH_DEBOUNCE'
+DEFAULT_DEBOUNCE = 1.0      # seconds without events before a rebuild starts
+
+
+def _debounce() -> float:
+    try:
+        return max(0.0, float(os.environ.get(DEBOUNCE_ENV, DEFAULT_DEBOUNCE)))
+    except ValueError:
+        return DEFAULT_DEBOUNCE
+
+
+def _wait_for_changes(watcher: TreeWatcher, quiet: float) -> list:
+    """Block until something changes, then until the tree has been quiet for `quiet` seconds."""
+    select.select([watcher], [], [])
+    while True:
+        watcher.read()
+        readable, _, _ = select.select([watcher], [], [], quiet)
+        if not readable:
+            return watcher.drain()
+
+
+def do_watch(profile: bool = False) -> int:
+    """
+    Build, then rebuild only what each source edit affects until interrupted.
+
+    Args:
+        profile: Print the per-phase resource breakdown after every build
+
+    Returns:
+        Exit code (0 when stopped with Ctrl+C, 1 if watching is impossible)
+    """
+    repo_root = REPO_ROOT / "deployment"
+    try:
+        watcher = TreeWatcher([str(repo_root)], excludes=('.git', 'isoprep-work', '__pycache__'))
+    except WatchUnavailable as e:
+        print(f"Error: cannot watch {repo_root}: {e}", file=sys.stderr)
+        return 1
+
+    load_isoprep()
+    warm = importlib.import_module('utils.warm')
+    planner = importlib.import_module('utils.rebuild_plan')
+    # Digests of unchanged trees stay valid between builds (the watcher reports every change)
+    warm.set_watched([str(repo_root)])
+
+    print(f">>> Watch mode: building once, then on every change below {repo_root}")
+    last_exit = do_build(profile=profile)
+    try:
+        while True:
+            print(f"\n>>> Watching {repo_root} ({len(watcher.paths)} directories, Ctrl+C to stop)")
+            changed = _wait_for_changes(watcher, _debounce())
+            warm.invalidate(changed)
+            plan = planner.plan_rebuild(repo_root, changed)
+            if plan is None:
+                continue
+            for path, triggers in sorted(plan.reasons.items()):
+                print(f"  changed {path}: {', '.join(triggers)}")
+
+            if plan.builder:
+                # Phase modules and utils are imported once; only a new process runs the new code
+                print(">>> The builder changed; restarting watch mode")
+                watcher.close()
+                os.execv(sys.executable, [sys.executable] + sys.orig_argv[1:])
+
+            start = time.monotonic()
+            if last_exit != 0:
+                print(">>> Last build failed; resuming it instead of rebuilding incrementally")
+                last_exit = do_build(resume=True, profile=profile)
+            elif plan.full or not (Path(WORK_DIR_BASE) / 'profile').is_dir():
+                last_exit = do_build(profile=profile)
+            else:
+                options = plan.build_options()
+                print(f">>> Rebuilding: {', '.join(options['phases'])}")
+                last_exit = do_build(profile=profile, options=options)
+            status = "done" if last_exit == 0 else "FAILED"
+            print(f">>> Rebuild {status} in {_fmt_secs(time.monotonic() - start)}")
+    except KeyboardInterrupt:
+        print("\n>>> Watch mode stopped")
+        return 0
+    finally:
+        watcher.close()
@@ -2,26 +2,68 @@
 Build orchestration for ISO creation.
 """
 
+import dataclasses
+import importlib
 import os
 import sys
+import time
 from pathlib import Path
+from typing import List, Optional
 
-from .workdir import setup_build_workdir, cleanup_build_workdir
-from .utils import run_command
+from . import locks
+from .cache import enforce_quota, mark_build
+from .manifest import build_manifest, manifest_path, write_manifest
+from .metrics import write_build_metrics
+from .privhelper import get_helper
+from .reaper import reap
+from .stats import append_record, load_counters, load_profile, make_record, print_profile
+from .workdir import (archiso_tmp_usage, cleanup_build_workdir, place_archiso_tmp,
+                      setup_build_workdir, spill_archiso_tmp)
 
 
-def do_build(full_clean: bool = False, cache_db_only: bool = False) -> int:
+REPO_ROOT = Path(__file__).parent.parent.parent.resolve()
+ISOPREP_INDEX = REPO_ROOT / "deployment" / "iso-builder" / "isoprep" / "index"
+
+
+def load_isoprep():
+    """
+    Import isoprep's orchestrator (index/index.py) into this process.
+    
+    Returns:
+        The index module (Orchestrator, run_build; BuildConfig lives in its utils)
+    """
+    if str(ISOPREP_INDEX) not in sys.path:
+        sys.path.insert(0, str(ISOPREP_INDEX))
+    return importlib.import_module('index')
+
+
+def do_build(full_clean: bool = False, cache_db_only: bool = False, resume: bool = False,
+             profile: bool = False, options: Optional[dict] = None) -> int:
     """
     Build ISO.
     
     Args:
         full_clean: If True, do full clean rebuild
         cache_db_only: If True, preserve only database and package files
+        resume: If True, skip phases the previous build completed and restart
+            at the first incomplete one
+        profile: If True, print the per-phase resource breakdown afterwards
+            (it is recorded in the build ledger either way)
+        options: Further isoprep BuildConfig fields (phases and steps of an
+            incremental rebuild, see controller --watch)
     
     Returns:
         Exit code (0 for success)
     """
-    print(">>> Starting Build...")
+    print(">>> Resuming Build..." if resume else ">>> Starting Build...")
+    # One build or eject at a time; deploys of published ISOs carry on
+    with locks.hold(locks.WORKDIR, exclusive=True, purpose='build'):
+        return _build(full_clean, cache_db_only, resume, profile, options or {})
+
+
+def _build(full_clean: bool, cache_db_only: bool, resume: bool, profile: bool, options: dict) -> int:
+    """do_build() with the work directory locked."""
+    start_time = time.monotonic()
     
     # Setup work directory on disk
     work_dir = setup_build_workdir()
@@ -29,49 +71,61 @@ def do_build(full_clean: bool = False, cache_db_only: bool = False) -> int:
     # Clean up any stale mounts/processes before building to prevent accumulation
     if Path(work_dir).exists():
         print("Pre-build cleanup: Checking for stale mounts...")
-        try:
-            from .utils import run_shell_command
-            result = run_shell_command(
-                f'findmnt -rn -o TARGET -T "{work_dir}" 2>/dev/null | grep "^{work_dir}"',
-                check=False,
-                capture_output=True
-            )
-            if result.stdout.strip():
-                print("Found stale mounts from previous build, cleaning up...")
-                mounts = result.stdout.strip().split('\n')
-                for mountpoint in mounts:
-                    mountpoint = mountpoint.strip()
-                    if mountpoint:
-                        run_command(['umount', '-l', mountpoint], check=False, sudo=True)
-        except:
-            pass
+        stale = reap(work_dir, dry_run=True, verbose=False)
+        if stale.mounts:
+            print("Found stale mounts from previous build, cleaning up...")
+            reap(work_dir)
     
-    # Get repo root (parent of controller directory, which is deployment/)
-    repo_root = Path(__file__).parent.parent.parent.resolve()
-    build_script = repo_root / "deployment" / "iso-builder" / "isoprep" / "build.py"
+    # Memory-backed archiso-tmp when the last build's footprint fits in RAM
+    place_archiso_tmp(work_dir, resume=resume)
     
-    if not build_script.exists():
-        print(f"Error: Build script not found at {build_script}")
+    if not (ISOPREP_INDEX / "index.py").exists():
+        print(f"Error: isoprep orchestrator not found at {ISOPREP_INDEX}")
         # DO NOT cleanup - preserve state for debugging
         return 1
     
-    # Set environment variables for work directory location and cleanup modes
-    os.environ['HOMERCHY_WORK_DIR'] = work_dir
-    os.environ['HOMERCHY_FULL_CLEAN'] = str(full_clean).lower()
-    os.environ['HOMERCHY_CACHE_DB_ONLY'] = str(cache_db_only).lower()
+    profile_file = Path(work_dir) / '.isoprep-profile.json'
     
-    # Run build
+    # Run the build in this process, sharing one privileged helper with every phase (single sudo prompt)
+    helper = get_helper()
     try:
-        result = run_command([sys.executable, str(build_script)], check=False)
-        build_exit = result.returncode
+        isoprep = load_isoprep()
+        config = isoprep.BuildConfig(
+            work_dir=Path(work_dir),
+            repo_root=REPO_ROOT / "deployment",
+            full_clean=full_clean,
+            cache_db_only=cache_db_only,
+            resume=resume,
+            skip_preflight=os.environ.get('HOMERCHY_SKIP_PREFLIGHT', 'false').lower() == 'true',
+            profile_file=profile_file,
+            **options,
+        )
+        build_exit = run_isoprep(isoprep, config)
+        if build_exit != 0 and spill_archiso_tmp(work_dir):
+            # The tmpfs filled up: redo the failed phase with archiso-tmp on disk
+            print(">>> Retrying on disk...")
+            build_exit = run_isoprep(isoprep, dataclasses.replace(config, resume=True))
+        
+        if build_exit == 0:
+            write_iso_manifests(Path(work_dir), helper)
+            # Keep the caches this build left behind within the disk quota
+            mark_build(Path(work_dir))
+            enforce_quota(Path(work_dir))
+        
+        # Record the build in the ledger (controller --stats)
+        record = make_record(build_exit, time.monotonic() - start_time, load_profile(profile_file),
+                             artifacts=iso_artifacts(Path(work_dir)) if build_exit == 0 else None,
+                             counters=load_counters(profile_file),
+                             full_clean=full_clean, cache_db_only=cache_db_only, resume=resume,
+                             **({'incremental': options['phases']} if options.get('phases') else {}))
+        append_record(record)
+        write_build_metrics(record)
+        if profile:
+            print_profile(record)
         
         # DO NOT cleanup after build - cleanup only happens on rebuild (pre-build) or eject
         # This allows inspection of profile directory and build artifacts
         
-        # Clear the cleanup flags
-        os.environ.pop('HOMERCHY_FULL_CLEAN', None)
-        os.environ.pop('HOMERCHY_CACHE_DB_ONLY', None)
-        
         return build_exit
     except Exception as e:
         print(f"Error running build: {e}", file=sys.stderr)
@@ -79,4 +133,72 @@ def do_build(full_clean: bool = False, cache_db_only: bool = False) -> int:
         return 1
 
 
+def run_isoprep(isoprep, config) -> int:
+    """
+    Run one isoprep build in this process.
+    
+    Modules and warm indexes already loaded (by the build server, or by an
+    earlier attempt) are reused, and the privileged helper of this process
+    is shared with the phases directly.
+    
+    Args:
+        isoprep: The orchestrator module (load_isoprep())
+        config: isoprep BuildConfig
+    
+    Returns:
+        Exit code of the build
+    """
+    try:
+        result = isoprep.run_build(config)
+    except SystemExit as e:
+        # A phase gave up with sys.exit()
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    finally:
+        # Hand the warm indexes back to a long-lived controller (controller --serve)
+        isoprep.warm.dump_on_exit()
+    if result.failed:
+        print(f"Failed phases: {', '.join(result.failed)}", file=sys.stderr)
+    return 0 if result.success else 1
+
+
+def iso_artifacts(work_dir: Path) -> dict:
+    """Size of the newest ISO and of archiso-tmp (which sizes the next tmpfs), for the build ledger."""
+    artifacts = {'archiso_tmp_size': archiso_tmp_usage(str(work_dir))}
+    isos = sorted((work_dir / "isoout").glob("omarchy-*.iso"), key=lambda p: p.stat().st_mtime)
+    if isos:
+        artifacts['iso_size'] = isos[-1].stat().st_size
+    return artifacts
+
 
+def write_iso_manifests(work_dir: Path, helper, iso_files: Optional[List[Path]] = None) -> None:
+    """
+    Write the block manifest (used by incremental deploy) next to each fresh ISO.
+    
+    isoout/ may be root-owned after mkarchiso; the manifest is then staged in the
+    work directory and moved into place by the privileged helper.
+    
+    Args:
+        work_dir: Build work directory
+        helper: Privileged helper of this build
+        iso_files: ISOs to cover (default: the ISOs in work_dir/isoout)
+    """
+    if iso_files is None:
+        iso_files = sorted((work_dir / "isoout").glob("omarchy-*.iso"))
+    for iso_file in iso_files:
+        target = manifest_path(str(iso_file))
+        if target.exists() and target.stat().st_mtime_ns >= iso_file.stat().st_mtime_ns:
+            continue
+        try:
+            manifest = build_manifest(str(iso_file))
+        except OSError as e:
+            print(f"WARNING: Could not hash {iso_file.name}: {e}")
+            continue
+        if write_manifest(manifest) is None:
+            staged = write_manifest(manifest, work_dir / target.name)
+            if staged is None or not helper.rename(staged, target, check=False).get('ok'):
+                print(f"WARNING: Could not write {target}; deploy will hash the ISO itself")
+                continue
+        print(f"✓ Block manifest written: {target}")
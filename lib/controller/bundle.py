@@ -0,0 +1,352 @@
+"""
+Portable offline-mirror bundles for build hosts without network access.
+
+`--export-cache FILE` packs the offline mirror of the cache store (packages,
+signatures and the repository database) into one file; `--import-cache FILE`
+merges such a file into the store of another host in a single sequential
+read, so it streams from a USB drive at full speed.
+
+A bundle is a POSIX (pax) tar archive:
+
+    <package files>      each with a HOMERCHY.sha256 pax header
+    <database files>     offline.db.tar.gz, offline.files.tar.gz, their symlinks
+    MANIFEST.json        every member with size, sha256 and data offset
+
+Members are stored uncompressed: packages are already zstd- or xz-compressed
+and the database is gzip. Any tar can list or unpack a bundle, and the data
+offsets in the manifest let a reader seek straight to one package.
+
+Import copies only what the store lacks. A file whose name and hash match is
+skipped, and one whose content is already there under another name is
+linked. Every copied file is verified against its hash. The database is
+replaced last, once the whole bundle has been read and checked, so a
+truncated bundle never leaves a database that names missing packages.
+"""
+
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import time
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from . import locks
+from .cache import WORK_DIR_BASE, store_root
+from .privhelper import get_helper
+from .stats import _fmt_bytes, _fmt_secs
+
+FORMAT = 'homerchy-cache-bundle'
+VERSION = 1
+MANIFEST_NAME = 'MANIFEST.json'
+SHA256_HEADER = 'HOMERCHY.sha256'
+MIRROR_NAME = 'offline-mirror'
+CHUNK = 1024 * 1024
+
+# Phase cache record of package_management (isoprep utils/phase_cache.py): its
+# fingerprint does not cover the store, so an import must force it to rerun
+PHASE_RECORD = Path(WORK_DIR_BASE) / '.isoprep-cache' / 'phases' / 'package_management.json'
+
+
+def hashes_path() -> Path:
+    """Memo of offline-mirror file hashes, keyed by name, size and mtime."""
+    state_home = os.environ.get('XDG_STATE_HOME') or str(Path.home() / '.local' / 'state')
+    return Path(state_home) / 'homerchy' / 'mirror-hashes.json'
+
+
+def _is_package(name: str) -> bool:
+    return '.pkg.tar.' in name
+
+
+def _is_skipped(name: str) -> bool:
+    """Members import never takes (and export leaves out): hidden files and paths."""
+    return name.startswith('.') or name != os.path.basename(name)
+
+
+def _sha256_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashMemo:
+    """sha256 of mirror files, recomputed only when a file's size or mtime changes."""
+
+    def __init__(self):
+        try:
+            with open(hashes_path(), 'r') as f:
+                self.entries: Dict[str, list] = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def digest(self, path: Path) -> str:
+        st = path.stat()
+        memo = self.entries.get(path.name)
+        if memo and memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+            return memo[2]
+        sha = _sha256_file(path)
+        self.entries[path.name] = [st.st_size, st.st_mtime_ns, sha]
+        return sha
+
+    def record(self, path: Path, sha: str) -> None:
+        st = path.stat()
+        self.entries[path.name] = [st.st_size, st.st_mtime_ns, sha]
+
+    def known(self, mirror: Path) -> Dict[str, str]:
+        """Hashes of the files of mirror that are still unchanged, by hash."""
+        found = {}
+        for entry in os.scandir(mirror):
+            memo = self.entries.get(entry.name)
+            if memo and entry.is_file(follow_symlinks=False):
+                st = entry.stat(follow_symlinks=False)
+                if memo[0] == st.st_size and memo[1] == st.st_mtime_ns:
+                    found[memo[2]] = entry.name
+        return found
+
+    def save(self, mirror: Path) -> None:
+        present = set(os.listdir(mirror)) if mirror.is_dir() else set()
+        self.entries = {name: memo for name, memo in self.entries.items() if name in present}
+        path = hashes_path()
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"WARNING: Could not save {path}: {e}")
+
+
+def _mirror_dir(create: bool = False) -> Path:
+    mirror = store_root() / MIRROR_NAME
+    if create and not mirror.is_dir():
+        uid, gid = os.getuid(), os.getgid()
+        get_helper().batch([{'op': 'mkdir', 'path': str(mirror), 'uid': uid, 'gid': gid},
+                            {'op': 'chown', 'path': str(mirror), 'uid': uid, 'gid': gid,
+                             'recursive': False}])
+    return mirror
+
+
+def do_export_cache(bundle: str) -> int:
+    """
+    Pack the offline mirror into a bundle file.
+
+    Args:
+        bundle: Path of the bundle to write (replaced atomically)
+
+    Returns:
+        Exit code (0 for success)
+    """
+    # Builds rewrite the mirror; other exports may read it alongside
+    with locks.hold(locks.WORKDIR, exclusive=False, purpose='export cache'):
+        return _export(Path(bundle))
+
+
+def _export(bundle: Path) -> int:
+    mirror = _mirror_dir()
+    if not mirror.is_dir() or not any(mirror.iterdir()):
+        print(f"Error: no offline mirror to export in {mirror} (run a build first)", file=sys.stderr)
+        return 1
+    # Dotfiles are local state (the package index, partial downloads), not mirror content
+    entries = sorted((e for e in os.scandir(mirror) if not _is_skipped(e.name)),
+                     key=lambda e: (not _is_package(e.name), e.name))
+    memo = HashMemo()
+    start = time.monotonic()
+    manifest = {'format': FORMAT, 'version': VERSION, 'created': time.time(),
+                'files': {}, 'symlinks': {}}
+    total = 0
+    partial = bundle.with_name(bundle.name + '.part')
+    print(f">>> Exporting {mirror} to {bundle}...")
+    try:
+        with tarfile.open(partial, 'w', format=tarfile.PAX_FORMAT) as tar:
+            for entry in entries:
+                path = Path(entry.path)
+                if entry.is_symlink():
+                    manifest['symlinks'][entry.name] = os.readlink(path)
+                    info = tarfile.TarInfo(entry.name)
+                    info.type = tarfile.SYMTYPE
+                    info.linkname = manifest['symlinks'][entry.name]
+                    info.mtime = int(entry.stat(follow_symlinks=False).st_mtime)
+                    tar.addfile(info)
+                    continue
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                sha = memo.digest(path)
+                info = tar.gettarinfo(str(path), arcname=entry.name)
+                info.uid = info.gid = 0
+                info.uname = info.gname = ''
+                info.pax_headers = {SHA256_HEADER: sha}
+                with open(path, 'rb') as f:
+                    tar.addfile(info, f)
+                # The data ends on the last full 512-byte block before tar.offset
+                offset = tar.offset - -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+                manifest['files'][entry.name] = {'size': info.size, 'sha256': sha, 'offset': offset}
+                total += info.size
+            data = json.dumps(manifest, indent=1, sort_keys=True).encode()
+            info = tarfile.TarInfo(MANIFEST_NAME)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+        os.replace(partial, bundle)
+    except OSError as e:
+        print(f"Error: could not write {bundle}: {e}", file=sys.stderr)
+        try:
+            partial.unlink()
+        except OSError:
+            pass
+        return 1
+    finally:
+        memo.save(mirror)
+    elapsed = time.monotonic() - start
+    print(f"✓ Exported {len(manifest['files'])} files ({_fmt_bytes(total)}) in {_fmt_secs(elapsed)} "
+          f"to {bundle}")
+    return 0
+
+
+def do_import_cache(bundle: str) -> int:
+    """
+    Merge a bundle into the offline mirror of the cache store.
+
+    Args:
+        bundle: Path of the bundle to read ('-' for standard input)
+
+    Returns:
+        Exit code (0 for success)
+    """
+    with locks.hold(locks.WORKDIR, exclusive=True, purpose='import cache'):
+        return _import(bundle)
+
+
+def _copy_member(source, target: Path, expected: str) -> Tuple[bool, int]:
+    """Write a member to target through a temporary file; returns (hash matched, bytes)."""
+    partial = target.with_name(f'.{target.name}.part')
+    digest = hashlib.sha256()
+    written = 0
+    with open(partial, 'wb') as out:
+        for chunk in iter(lambda: source.read(CHUNK), b''):
+            digest.update(chunk)
+            out.write(chunk)
+            written += len(chunk)
+    if digest.hexdigest() != expected:
+        partial.unlink()
+        return False, written
+    os.replace(partial, target)
+    return True, written
+
+
+def _import(bundle: str) -> int:
+    mirror = _mirror_dir(create=True)
+    staging = mirror.parent / f'.{MIRROR_NAME}-import'
+    memo = HashMemo()
+    start = time.monotonic()
+    by_hash = memo.known(mirror)
+    stats = {'copied': 0, 'linked': 0, 'skipped': 0, 'bytes': 0}
+    received: Dict[str, str] = {}
+    symlinks: Dict[str, str] = {}
+    manifest: Optional[dict] = None
+    print(f">>> Importing {bundle} into {mirror}...")
+    try:
+        if staging.exists():
+            # Left by an interrupted import (possibly root-owned after a build touched it)
+            try:
+                shutil.rmtree(staging)
+            except PermissionError:
+                get_helper().batch([{'op': 'rmtree', 'path': str(staging)}], check=False)
+        staging.mkdir(parents=True, exist_ok=True)
+        source = sys.stdin.buffer if bundle == '-' else open(bundle, 'rb')
+        with source, tarfile.open(fileobj=source, mode='r|') as tar:
+            for member in tar:
+                name = member.name
+                if _is_skipped(name):
+                    print(f"WARNING: Skipping unexpected member {member.name}")
+                    continue
+                if member.name == MANIFEST_NAME:
+                    manifest = json.load(tar.extractfile(member))
+                    continue
+                if member.issym():
+                    symlinks[name] = member.linkname
+                    continue
+                if not member.isfile():
+                    continue
+                sha = member.pax_headers.get(SHA256_HEADER)
+                if not sha:
+                    print(f"WARNING: {name} has no hash in the bundle; skipped")
+                    continue
+                received[name] = sha
+                # Packages go straight into the mirror; the database waits for the manifest
+                target = (mirror if _is_package(name) else staging) / name
+                existing = mirror / name
+                if _is_package(name) and existing.is_file() and memo.digest(existing) == sha:
+                    stats['skipped'] += 1
+                    continue
+                twin = by_hash.get(sha)
+                if twin and (mirror / twin).is_file():
+                    partial = target.with_name(f'.{name}.part')
+                    try:
+                        os.link(mirror / twin, partial)
+                    except OSError:
+                        pass    # Another filesystem or link limit: copy it below
+                    else:
+                        os.replace(partial, target)
+                        stats['linked'] += 1
+                        continue
+                ok, size = _copy_member(tar.extractfile(member), target, sha)
+                if not ok:
+                    print(f"Error: {name} does not match its hash; the bundle is damaged", file=sys.stderr)
+                    return 1
+                if target.parent == mirror:
+                    memo.record(target, sha)
+                    by_hash[sha] = name
+                stats['copied'] += 1
+                stats['bytes'] += size
+    except (OSError, tarfile.TarError, ValueError) as e:
+        print(f"Error: could not read {bundle}: {e}", file=sys.stderr)
+        return 1
+    finally:
+        memo.save(mirror)
+
+    if not manifest or manifest.get('format') != FORMAT:
+        print("Error: bundle has no manifest (truncated?); packages kept, database left unchanged",
+              file=sys.stderr)
+        return 1
+    if manifest.get('version', 0) > VERSION:
+        print(f"Error: bundle format {manifest['version']} is newer than this controller supports",
+              file=sys.stderr)
+        return 1
+    # Members skipped on purpose (hidden files of bundles from older exports) are not missing
+    missing = [name for name, info in manifest['files'].items()
+               if not _is_skipped(name) and received.get(name) != info['sha256']]
+    if missing:
+        print(f"Error: bundle is incomplete ({len(missing)} files missing, e.g. {missing[0]}); "
+              "database left unchanged", file=sys.stderr)
+        return 1
+
+    # Every package is in place: switch the database over
+    for entry in os.scandir(staging):
+        os.replace(entry.path, mirror / entry.name)
+    for name, target in manifest.get('symlinks', symlinks).items():
+        if _is_skipped(name):
+            continue
+        link = mirror / name
+        partial = mirror / f'.{name}.part'
+        if os.path.lexists(partial):
+            partial.unlink()
+        os.symlink(target, partial)
+        os.replace(partial, link)
+    staging.rmdir()
+    try:
+        PHASE_RECORD.unlink()
+    except OSError:
+        pass
+
+    elapsed = time.monotonic() - start
+    rate = stats['bytes'] / elapsed if elapsed > 0 else 0
+    print(f"✓ Imported {bundle}: {stats['copied']} copied ({_fmt_bytes(stats['bytes'])}, "
+          f"{_fmt_bytes(rate)}/s), {stats['linked']} linked, {stats['skipped']} already present, "
+          f"in {_fmt_secs(elapsed)}")
+    return 0
@@ -0,0 +1,404 @@
+"""
+Size-bounded build cache manager for /mnt/work.
+
+Builds keep the offline mirror packages, the profile, archiso-tmp and the
+ISOs in isoout/ between runs. This module tracks those entries with their
+last-used times in an index
+(${HOMERCHY_CACHE_INDEX:-${XDG_STATE_HOME:-~/.local/state}/homerchy/cache.json})
+and keeps their total size (the newest ISO aside) under a quota
+(HOMERCHY_CACHE_QUOTA, e.g. "40G", default 40G)
+by evicting least-recently-used entries, cheapest to lose first:
+
+    1. superseded package versions (an older version of a package the mirror
+       also holds a newer version of)
+    2. ISOs other than the newest, with their manifests
+    3. the archiso-tmp package cache
+    4. the profile
+    5. current offline mirror packages in the cache store (re-downloaded on demand)
+
+The newest ISO is never evicted. Entries are marked used when a build
+succeeds (everything it kept) and when an ISO is deployed. Quotas are
+enforced after each successful build, after `-e` and with `--cache trim`.
+"""
+
+import functools
+import importlib
+import json
+import os
+import re
+import time
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from . import locks
+from .privhelper import get_helper
+from .stats import _fmt_bytes
+
+WORK_DIR_BASE = "/mnt/work/homerchy-deployment/deployment/isoprep-work"
+STORE_ENV = 'HOMERCHY_CACHE_STORE'
+DEFAULT_STORE = "/mnt/work/.homerchy-store"
+SYSTEM_TEMP_CACHE = "/mnt/work/.homerchy-cache-temp"
+MIRROR_SUBDIRS = ("airootfs/var/cache/omarchy/mirror/offline",
+                  "airootfs/var/cache/homerchy/mirror/offline")
+DEFAULT_QUOTA = "40G"
+
+TIER_SUPERSEDED = 1
+TIER_STALE_ISO = 2
+TIER_ARCHISO_TMP = 3
+TIER_PROFILE = 4
+TIER_PACKAGE = 5
+TIER_NAMES = {
+    TIER_SUPERSEDED: 'superseded package',
+    TIER_STALE_ISO: 'stale ISO',
+    TIER_ARCHISO_TMP: 'archiso-tmp',
+    TIER_PROFILE: 'profile',
+    TIER_PACKAGE: 'package',
+}
+
+_PKG_FILE = re.compile(r'^(?P<name>.+)-(?P<version>[^-]+-[^-]+)-[^-]+\.pkg\.tar\.[a-z0-9]+$')
+_SIZE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', re.IGNORECASE)
+
+
+@dataclass
+class CacheEntry:
+    """One evictable cache entry."""
+    path: Path
+    tier: int
+    size: int
+    last_used: float
+    companions: List[Path] = field(default_factory=list)   # removed along with path
+
+    @property
+    def kind(self) -> str:
+        return TIER_NAMES[self.tier]
+
+
+def index_path() -> Path:
+    """Location of the last-used index."""
+    override = os.environ.get('HOMERCHY_CACHE_INDEX')
+    if override:
+        return Path(override)
+    state_home = os.environ.get('XDG_STATE_HOME') or str(Path.home() / '.local' / 'state')
+    return Path(state_home) / 'homerchy' / 'cache.json'
+
+
+def parse_size(text: str) -> int:
+    """
+    Parse a size such as "40G", "512M" or "1.5T" (powers of 1024) into bytes.
+
+    Raises:
+        ValueError: If the size cannot be parsed
+    """
+    match = _SIZE.match(str(text))
+    if not match:
+        raise ValueError(f"invalid size: {text!r}")
+    scale = 1024 ** ' KMGT'.index(match.group(2).upper() or ' ')
+    return int(float(match.group(1)) * scale)
+
+
+def quota_bytes() -> int:
+    """Configured quota (HOMERCHY_CACHE_QUOTA); an invalid value falls back to the default."""
+    value = os.environ.get('HOMERCHY_CACHE_QUOTA', DEFAULT_QUOTA)
+    try:
+        return parse_size(value)
+    except ValueError:
+        print(f"WARNING: Ignoring invalid HOMERCHY_CACHE_QUOTA={value!r}, using {DEFAULT_QUOTA}")
+        return parse_size(DEFAULT_QUOTA)
+
+
+def load_index() -> Dict[str, float]:
+    try:
+        with open(index_path(), 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return {k: float(v) for k, v in data.items()} if isinstance(data, dict) else {}
+
+
+def save_index(index: Dict[str, float]) -> None:
+    path = index_path()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=0, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"WARNING: Could not update cache index {path}: {e}")
+
+
+def store_root() -> Path:
+    """Root of the cache store the offline mirror lives in (see isoprep utils/cache_store.py)."""
+    return Path(os.environ.get(STORE_ENV) or DEFAULT_STORE)
+
+
+def disk_usage(path: Path, skip: Iterable[Path] = ()) -> int:
+    """Allocated size of a file or tree (unreadable parts count as empty)."""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return 0
+    total = st.st_blocks * 512
+    if not os.path.isdir(path) or os.path.islink(path):
+        return total
+    for dirpath, dirnames, filenames in os.walk(path, onerror=lambda e: None):
+        if skip:
+            dirnames[:] = [d for d in dirnames if Path(dirpath, d) not in skip]
+        for name in dirnames + filenames:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+
+def _last_used(path: Path, index: Dict[str, float]) -> float:
+    if str(path) in index:
+        return index[str(path)]
+    try:
+        return os.lstat(path).st_mtime
+    except OSError:
+        return 0.0
+
+
+def mirror_dirs(work_dir: Path) -> List[Path]:
+    """
+    The cache store's offline mirror, plus places older builds parked one in.
+
+    The profile's copy is only a view of the store (reflinks or hardlinks) and
+    is not counted.
+    """
+    dirs = [store_root() / 'offline-mirror', work_dir / 'offline-mirror-cache-temp',
+            Path(SYSTEM_TEMP_CACHE)]
+    return [d for d in dirs if d.is_dir()]
+
+
+def _isoprep_utils():
+    """isoprep's utils package (package index, vercmp), imported the way builds load it."""
+    from .build import load_isoprep
+    load_isoprep()
+    return importlib.import_module('utils')
+
+
+def package_entries(mirror: Path, index: Dict[str, float]) -> List[CacheEntry]:
+    """
+    Package files of one mirror; all but the highest version of each package are superseded.
+
+    Names and versions come from each file's .PKGINFO through isoprep's package
+    index and are ordered like pacman's vercmp; a file the index cannot read
+    falls back to the name and version in its file name. The mtime only breaks
+    ties between equal versions.
+    """
+    utils = _isoprep_utils()
+    infos = utils.package_index(mirror).scan()
+    by_name: Dict[str, List[tuple]] = {}
+    for pkg in mirror.glob('*.pkg.tar.*'):
+        if pkg.name.endswith('.sig'):
+            continue
+        info = infos.get(pkg.name)
+        if info is not None:
+            name, version = info.name, info.version
+        else:
+            match = _PKG_FILE.match(pkg.name)
+            name, version = (match.group('name'), match.group('version')) if match else (pkg.name, '')
+        try:
+            mtime = pkg.stat().st_mtime
+        except OSError:
+            continue
+        by_name.setdefault(name, []).append((pkg, version, mtime))
+
+    def newest_first(a: tuple, b: tuple) -> int:
+        order = utils.vercmp(b[1], a[1])
+        return order or (b[2] > a[2]) - (b[2] < a[2])
+
+    entries = []
+    for files in by_name.values():
+        files.sort(key=functools.cmp_to_key(newest_first))
+        for position, (pkg, _, _) in enumerate(files):
+            sig = pkg.with_name(pkg.name + '.sig')
+            companions = [sig] if sig.exists() else []
+            size = disk_usage(pkg) + sum(disk_usage(c) for c in companions)
+            entries.append(CacheEntry(pkg, TIER_SUPERSEDED if position else TIER_PACKAGE,
+                                      size, _last_used(pkg, index), companions))
+    return entries
+
+
+def scan(work_dir: Optional[Path] = None) -> List[CacheEntry]:
+    """
+    Collect every evictable cache entry, in eviction order.
+
+    Args:
+        work_dir: Build work directory (default: the standard one)
+
+    Returns:
+        Entries sorted by tier, then least recently used first
+    """
+    work_dir = Path(work_dir or os.environ.get('HOMERCHY_WORK_DIR', WORK_DIR_BASE))
+    index = load_index()
+    entries: List[CacheEntry] = []
+
+    for mirror in mirror_dirs(work_dir):
+        entries.extend(package_entries(mirror, index))
+
+    isos = sorted((work_dir / 'isoout').glob('*.iso'), key=lambda p: p.stat().st_mtime, reverse=True)
+    for iso in isos[1:]:
+        companions = [p for p in iso.parent.glob(iso.name + '.*')]
+        size = disk_usage(iso) + sum(disk_usage(c) for c in companions)
+        entries.append(CacheEntry(iso, TIER_STALE_ISO, size, _last_used(iso, index), companions))
+
+    archiso_tmp = work_dir / 'archiso-tmp'
+    # A tmpfs archiso-tmp holds no disk space (eject unmounts it)
+    if archiso_tmp.exists() and not os.path.ismount(archiso_tmp):
+        entries.append(CacheEntry(archiso_tmp, TIER_ARCHISO_TMP, disk_usage(archiso_tmp),
+                                  _last_used(archiso_tmp, index)))
+
+    profile = work_dir / 'profile'
+    if profile.exists():
+        views = [profile / sub for sub in MIRROR_SUBDIRS]
+        entries.append(CacheEntry(profile, TIER_PROFILE, disk_usage(profile, skip=views),
+                                  _last_used(profile, index)))
+
+    entries.sort(key=lambda e: (e.tier, e.last_used))
+    return entries
+
+
+def mark_used(paths: List[Path]) -> None:
+    """Record paths as used now."""
+    index = load_index()
+    now = time.time()
+    for path in paths:
+        index[str(path)] = now
+    # Forget entries that no longer exist
+    save_index({k: v for k, v in index.items() if os.path.lexists(k)})
+
+
+def mark_build(work_dir: Path) -> None:
+    """After a successful build: mark everything the build kept (but superseded packages) used."""
+    used = [e.path for e in scan(work_dir) if e.tier != TIER_SUPERSEDED]
+    isos = sorted((Path(work_dir) / 'isoout').glob('*.iso'), key=lambda p: p.stat().st_mtime)
+    mark_used(used + isos[-1:])
+
+
+def _evict(entry: CacheEntry, helper) -> bool:
+    ops = [{'op': 'rmtree' if entry.path.is_dir() else 'unlink', 'path': str(entry.path)}]
+    ops += [{'op': 'unlink', 'path': str(c)} for c in entry.companions]
+    return helper.batch(ops, check=False)[0].get('ok', False)
+
+
+def plan_eviction(entries: List[CacheEntry], quota: int) -> List[CacheEntry]:
+    """Entries to evict (in order) to bring the total under quota."""
+    excess = sum(e.size for e in entries) - quota
+    plan = []
+    for entry in entries:
+        if excess <= 0:
+            break
+        plan.append(entry)
+        excess -= entry.size
+    return plan
+
+
+def enforce_quota(work_dir: Optional[Path] = None, quota: Optional[int] = None,
+                  dry_run: bool = False) -> int:
+    """
+    Evict least-recently-used cache entries until the caches fit the quota.
+
+    The caller holds the work directory lock. Old ISOs are only evicted if
+    nobody is reading isoout/ (a deploy or VM may be using one).
+
+    Args:
+        work_dir: Build work directory (default: the standard one)
+        quota: Quota in bytes (default: HOMERCHY_CACHE_QUOTA)
+        dry_run: Only report what would be evicted
+
+    Returns:
+        Bytes freed (or that would be freed)
+    """
+    with ExitStack() as stack:
+        try:
+            stack.enter_context(locks.hold(locks.ISOOUT, exclusive=True, wait=False,
+                                           purpose='cache eviction'))
+            isos_free = True
+        except locks.LockBusy:
+            isos_free = False
+        return _enforce_quota(work_dir, quota, dry_run, isos_free)
+
+
+def _enforce_quota(work_dir: Optional[Path], quota: Optional[int], dry_run: bool,
+                   isos_free: bool) -> int:
+    quota = quota_bytes() if quota is None else quota
+
+    def candidates() -> List[CacheEntry]:
+        entries = scan(work_dir)
+        if isos_free:
+            return entries
+        return [e for e in entries if e.tier != TIER_STALE_ISO]
+
+    entries = candidates()
+    plan = plan_eviction(entries, quota)
+    if not plan:
+        return 0
+    if not isos_free:
+        print("Old ISOs are in use (deploy or VM running); leaving them in place")
+
+    print(f"Build caches use {_fmt_bytes(sum(e.size for e in entries))}, over the "
+          f"{_fmt_bytes(quota)} quota; {'would evict' if dry_run else 'evicting'} "
+          f"least recently used entries...")
+    freed = 0
+    evicted: List[CacheEntry] = []
+    attempted = set()
+    helper = None if dry_run else get_helper()
+    while plan:
+        # One tier per pass, rescanning after each
+        tier = plan[0].tier
+        for entry in (e for e in plan if e.tier == tier):
+            attempted.add(entry.path)
+            if dry_run or _evict(entry, helper):
+                freed += entry.size
+                evicted.append(entry)
+                if tier not in (TIER_SUPERSEDED, TIER_PACKAGE):
+                    print(f"  {'Would evict' if dry_run else 'Evicted'} {entry.kind}: {entry.path} "
+                          f"({_fmt_bytes(entry.size)})")
+            else:
+                print(f"  WARNING: Could not evict {entry.path}")
+        if dry_run:
+            plan = [e for e in plan if e.tier != tier]
+            continue
+        plan = [e for e in plan_eviction(candidates(), quota) if e.path not in attempted]
+    packages = [e for e in evicted if e.tier in (TIER_SUPERSEDED, TIER_PACKAGE)]
+    if packages:
+        print(f"  {'Would evict' if dry_run else 'Evicted'} {len(packages)} package files "
+              f"({_fmt_bytes(sum(e.size for e in packages))})")
+    if not dry_run:
+        mark_used([])   # drop index entries of evicted paths
+    print(f"✓ {'Would free' if dry_run else 'Freed'} {_fmt_bytes(freed)}")
+    return freed
+
+
+def do_cache(action: str = 'status') -> int:
+    """controller --cache [status|trim]"""
+    if action == 'trim':
+        with locks.hold(locks.WORKDIR, exclusive=True, purpose='cache trim'):
+            if enforce_quota() == 0:
+                print(f"Build caches are within the {_fmt_bytes(quota_bytes())} quota.")
+        return 0
+
+    entries = scan()
+    quota = quota_bytes()
+    total = sum(e.size for e in entries)
+    print(f"Build caches: {_fmt_bytes(total)} of {_fmt_bytes(quota)} quota")
+    now = time.time()
+    for tier, name in TIER_NAMES.items():
+        group = [e for e in entries if e.tier == tier]
+        if not group:
+            continue
+        size = sum(e.size for e in group)
+        oldest = min(e.last_used for e in group)
+        print(f"  {name + 's' if len(group) > 1 else name:<20} {len(group):>5}  {_fmt_bytes(size):>8}  "
+              f"least recently used {(now - oldest) / 86400:.1f} days ago")
+    plan = plan_eviction(entries, quota)
+    if plan:
+        print(f"Over quota: `--cache trim` would evict {len(plan)} entries "
+              f"({_fmt_bytes(sum(e.size for e in plan))})")
+    return 0
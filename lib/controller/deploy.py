@@ -1,50 +1,77 @@
 """
 ISO deployment to physical device.
+
+Only blocks that differ from the ISO's block manifest are written, so
+re-flashing a stick that holds a similar build, or re-running an
+interrupted deploy, is much faster than a full write.
 """
 
 import os
 import sys
 from pathlib import Path
+from typing import List, Optional
 
-from .utils import run_command
+from . import locks
+from .cache import mark_used
+from .flash import flash_as_root
+from .manifest import ensure_manifest
 
 WORK_DIR_BASE = "/mnt/work/homerchy-deployment/deployment/isoprep-work"
 
 
-def do_deploy(target_dev: str) -> None:
+def latest_iso() -> Optional[Path]:
+    """Newest ISO in the work directory's isoout/, or None."""
+    work_dir = os.environ.get('HOMERCHY_WORK_DIR', WORK_DIR_BASE)
+    iso_dir = Path(work_dir) / "isoout"
+    iso_files = sorted(iso_dir.glob("omarchy-*.iso"), key=lambda p: p.stat().st_mtime, reverse=True)
+    return iso_files[0] if iso_files else None
+
+
+def confirm_deploy(target_devs: List[str], iso_file: Optional[Path]) -> bool:
+    """Warn about the devices about to be overwritten and ask for confirmation."""
+    print(f"WARNING: This will overwrite ALL data on {', '.join(target_devs)}")
+    if iso_file:
+        print(f"Target ISO: {iso_file}")
+    response = input("Are you sure? [y/N] ")
+    return response.lower() in ('y', 'yes')
+
+
+def do_deploy(target_devs: List[str], assume_yes: bool = False) -> None:
     """
-    Deploy ISO to a device.
+    Deploy ISO to one or more devices at once.
     
     Args:
-        target_dev: Target device path (e.g., /dev/sdX)
+        target_devs: Target device paths (e.g., /dev/sdX /dev/sdY)
+        assume_yes: Skip the confirmation prompt (already confirmed by a
+            controller client submitting to the build server)
     """
-    if not target_dev:
+    if not target_devs:
         print("Error: No target device specified for deploy.")
         sys.exit(1)
     
+    # Readers share isoout/: builds publish new ISOs alongside, eject waits
+    with locks.hold(locks.ISOOUT, exclusive=False, purpose='deploy'):
+        _deploy(target_devs, assume_yes)
+
+
+def _deploy(target_devs: List[str], assume_yes: bool) -> None:
+    """do_deploy() with isoout/ locked for reading."""
     # ISO is now in work directory
-    work_dir = os.environ.get('HOMERCHY_WORK_DIR', WORK_DIR_BASE)
-    iso_dir = Path(work_dir) / "isoout"
-    
-    # Find latest ISO
-    iso_files = sorted(iso_dir.glob("omarchy-*.iso"), key=lambda p: p.stat().st_mtime, reverse=True)
-    if not iso_files:
-        print(f"Error: No ISO found to deploy in {iso_dir}")
+    iso_file = latest_iso()
+    if iso_file is None:
+        print(f"Error: No ISO found to deploy in {Path(os.environ.get('HOMERCHY_WORK_DIR', WORK_DIR_BASE)) / 'isoout'}")
         sys.exit(1)
     
-    iso_file = iso_files[0]
-    
-    print(f"WARNING: This will overwrite ALL data on {target_dev}")
-    print(f"Target ISO: {iso_file}")
-    response = input("Are you sure? [y/N] ")
+    # Hash the ISO (if the build did not) before any sudo re-exec, so the manifest
+    # lands next to the ISO as the invoking user
+    ensure_manifest(str(iso_file))
+    mark_used([iso_file])
     
-    if response.lower() in ('y', 'yes'):
-        print(f"Writing to {target_dev}...")
-        # dd uses special syntax where options are passed as if=file, of=file, etc.
-        run_command([
-            'dd', f'if={iso_file}', f'of={target_dev}',
-            'bs=4M', 'status=progress', 'oflag=sync'
-        ], sudo=True)
+    if assume_yes or confirm_deploy(target_devs, iso_file):
+        print(f"Writing to {', '.join(target_devs)}...")
+        if flash_as_root(str(iso_file), target_devs, incremental=True) != 0:
+            print("Error: Deploy failed.")
+            sys.exit(1)
         print("Deploy complete.")
     else:
         print("Deploy cancelled.")
@@ -0,0 +1,852 @@
+"""
+High-throughput image writer for deploying ISOs to USB sticks.
+
+Replaces `dd bs=4M oflag=sync`: the image is streamed through page-aligned
+buffers by a reader thread and one writer thread per target using O_DIRECT
+(no page cache, no per-block sync), with a single fsync at the end. The image
+is read and hashed once however many targets there are; each buffer goes back
+to the pool when every writer is done with it, so a batch of sticks takes as
+long as the slowest one. A failing target drops out without stopping the
+others. Every target is then read back in parallel and compared block by
+block. Works against block devices, loop devices and regular files.
+
+Incremental mode (--incremental) uses the ISO's block manifest (see
+manifest.py): each target's existing blocks are hashed first and only those
+that differ are written, synced, read back and journalled in 256 MiB
+checkpoints, so re-flashing a stick holding a similar build or resuming an
+interrupted deploy touches only what changed.
+"""
+
+import argparse
+import errno
+import hashlib
+import mmap
+import os
+import queue
+import stat
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .manifest import DeployJournal, Manifest, ensure_manifest
+from .metrics import DEPLOY_FILE, METRICS_DIR_ENV, metrics_dir, write_deploy_metrics
+from .reaper import read_mounts
+
+REPO_ROOT = Path(__file__).parent.parent.parent.resolve()
+
+BLOCK_SIZE = 4 * 1024 * 1024
+ALIGN = 4096            # O_DIRECT offset/length alignment (covers 512e and 4Kn devices)
+BUFFERS = 3             # one being read, one being written, one spare
+MULTI_BUFFERS = 8       # with several targets, lets faster sticks run ahead of the slowest
+VERIFY_WORKERS = 4
+CHECKPOINT_BLOCKS = 64  # incremental writes sync, read back and journal every 256 MiB
+
+
+class FlashError(Exception):
+    """Raised when an image cannot be written or verified."""
+
+
+@dataclass
+class FlashResult:
+    """Outcome of writing one image to one target."""
+    image: str
+    target: str
+    size: int
+    block_size: int = BLOCK_SIZE
+    elapsed: float = 0.0
+    sha256: str = ''
+    verified: Optional[bool] = None
+    verify_elapsed: float = 0.0
+    mismatched_blocks: List[int] = field(default_factory=list)
+    direct_io: bool = True
+    error: str = ''
+    written: int = 0
+    skipped_blocks: int = 0
+    resumed_from: int = 0
+    block_hashes: List[bytes] = field(default_factory=list, repr=False)
+
+    @property
+    def ok(self) -> bool:
+        return not self.error and self.verified is not False
+
+
+def _open_direct(path: str, flags: int) -> tuple:
+    """
+    Open path with O_DIRECT, falling back to buffered I/O where unsupported (tmpfs).
+
+    Returns:
+        Tuple of (fd, whether O_DIRECT is in effect)
+    """
+    try:
+        return os.open(path, flags | os.O_DIRECT), True
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+    return os.open(path, flags), False
+
+
+def _aligned_buffer(size: int) -> mmap.mmap:
+    """Anonymous mapping: page-aligned, as O_DIRECT requires."""
+    return mmap.mmap(-1, size)
+
+
+def _target_size(fd: int) -> Optional[int]:
+    """Capacity of a block device, or None for regular files."""
+    if not stat.S_ISBLK(os.fstat(fd).st_mode):
+        return None
+    size = os.lseek(fd, 0, os.SEEK_END)
+    os.lseek(fd, 0, os.SEEK_SET)
+    return size
+
+
+def check_target(target: str, image_size: int) -> None:
+    """
+    Refuse targets that are mounted or too small for the image.
+
+    Raises:
+        FlashError: If the target is unusable
+    """
+    real = os.path.realpath(target)
+    for mount in read_mounts('/'):
+        if mount.source == real or (mount.source.startswith(real) and mount.source[len(real):].lstrip('p').isdigit()):
+            raise FlashError(f"{target} is mounted at {mount.target}; unmount it first")
+    if os.path.exists(real) and stat.S_ISBLK(os.stat(real).st_mode):
+        fd = os.open(real, os.O_RDONLY)
+        try:
+            capacity = _target_size(fd)
+        finally:
+            os.close(fd)
+        if capacity is not None and capacity < image_size:
+            raise FlashError(f"{target} holds {capacity} bytes; the image needs {image_size}")
+
+
+def check_targets(targets: List[str]) -> None:
+    """
+    Refuse a target list that names the same device twice.
+
+    Raises:
+        FlashError: If two entries resolve to the same path
+    """
+    seen = {}
+    for target in targets:
+        real = os.path.realpath(target)
+        if real in seen:
+            raise FlashError(f"{target} and {seen[real]} are the same target")
+        seen[real] = target
+
+
+class Progress:
+    """Throttled single-line MB/s and ETA reporting."""
+
+    def __init__(self, label: str, total: int, enabled: bool = True, interval: float = 0.5):
+        self.label = label
+        self.total = total
+        self.enabled = enabled
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last = 0.0
+        self.done = 0
+        self.lock = threading.Lock()
+
+    def advance(self, count: int) -> None:
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            if self.enabled and (now - self.last >= self.interval or self.done >= self.total):
+                self.last = now
+                self._print(now)
+
+    def _print(self, now: float) -> None:
+        elapsed = max(now - self.start, 1e-6)
+        rate = self.done / elapsed
+        remaining = (self.total - self.done) / rate if rate > 0 else 0
+        pct = self.done * 100 / self.total if self.total else 100
+        print(f"\r{self.label}: {self.done / 1e6:8.0f}/{self.total / 1e6:.0f} MB "
+              f"({pct:5.1f}%) {rate / 1e6:7.1f} MB/s  ETA {int(remaining // 60)}m{int(remaining % 60):02d}s ",
+              end='', flush=True)
+
+    def finish(self) -> None:
+        if self.enabled:
+            self._print(time.monotonic())
+            print()
+
+
+class ProgressGroup:
+    """
+    One progress line for several targets: percentage per device, ETA of the slowest.
+
+    channel(target) returns a Progress whose advance() also refreshes the shared line.
+    """
+
+    def __init__(self, label: str, totals: Dict[str, int], enabled: bool = True,
+                 interval: float = 0.5):
+        self.label = label
+        self.enabled = enabled
+        self.interval = interval
+        self.start = time.monotonic()
+        self.last = 0.0
+        self.lock = threading.Lock()
+        self.meters = {t: _GroupMeter(self, os.path.basename(t), total) for t, total in totals.items()}
+
+    def channel(self, target: str) -> 'Progress':
+        return self.meters[target]
+
+    def drop(self, target: str) -> None:
+        """Stop counting a failed target towards the ETA."""
+        self.meters[target].failed = True
+
+    def refresh(self, force: bool = False) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if self.enabled and (force or now - self.last >= self.interval):
+                self.last = now
+                self._print(now)
+
+    def _print(self, now: float) -> None:
+        elapsed = max(now - self.start, 1e-6)
+        parts = []
+        remaining = 0.0
+        for meter in self.meters.values():
+            if meter.failed:
+                parts.append(f"{meter.name} FAIL")
+                continue
+            pct = meter.done * 100 / meter.total if meter.total else 100
+            parts.append(f"{meter.name} {pct:3.0f}%")
+            rate = meter.done / elapsed
+            if rate > 0:
+                remaining = max(remaining, (meter.total - meter.done) / rate)
+        print(f"\r{self.label}: {' '.join(parts)}  ETA {int(remaining // 60)}m{int(remaining % 60):02d}s ",
+              end='', flush=True)
+
+    def finish(self) -> None:
+        if self.enabled:
+            self._print(time.monotonic())
+            print()
+
+
+class _GroupMeter(Progress):
+    """Per-target counter inside a ProgressGroup."""
+
+    def __init__(self, group: ProgressGroup, name: str, total: int):
+        super().__init__(name, total, enabled=False)
+        self.group = group
+        self.name = name
+        self.failed = False
+
+    def advance(self, count: int) -> None:
+        super().advance(count)
+        self.group.refresh()
+
+
+def _span(indexes: List[int], size: int, block_size: int) -> int:
+    """Bytes covered by the given block indexes of a size-byte image."""
+    return sum(min(block_size, size - i * block_size) for i in indexes)
+
+
+def _pwrite_all(fd: int, data, offset: int) -> None:
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+class _Sink:
+    """One write target: its fds, its queue of filled buffers and its result."""
+
+    def __init__(self, result: FlashResult):
+        self.result = result
+        self.queue: queue.Queue = queue.Queue()
+        self.dst_fd = -1
+        self.tail_fd = -1
+        self.error: Optional[BaseException] = None
+
+    def open(self) -> None:
+        target = self.result.target
+        flags = os.O_WRONLY
+        if not os.path.exists(target):
+            flags |= os.O_CREAT
+        self.dst_fd, self.result.direct_io = _open_direct(target, flags)
+        # The unaligned tail of the image cannot go through O_DIRECT
+        self.tail_fd = os.open(target, os.O_WRONLY)
+
+    def sync(self) -> None:
+        os.fsync(self.dst_fd)
+        os.fsync(self.tail_fd)
+
+    def close(self) -> None:
+        for fd in (self.dst_fd, self.tail_fd):
+            if fd >= 0:
+                os.close(fd)
+        self.dst_fd = self.tail_fd = -1
+
+    def fail(self, error: BaseException) -> None:
+        if self.error is None:
+            self.error = error
+            self.result.error = f"write failed: {error}"
+
+
+def write_images(image: str, targets: List[str], block_size: int = BLOCK_SIZE,
+                 progress: bool = True, manifest: Optional[Manifest] = None,
+                 dirty: Optional[Dict[str, List[int]]] = None,
+                 journals: Optional[Dict[str, DeployJournal]] = None,
+                 verify: bool = False) -> List[FlashResult]:
+    """
+    Stream image onto every target at once: one reader thread, one writer thread per target.
+
+    The image is read and hashed once. A target that fails is marked in its
+    result (.error) and the others carry on.
+
+    With a manifest, only the blocks listed in dirty[target] are written and the
+    image blocks read are checked against the manifest instead of being hashed
+    into a new one. With journals as well, each writer syncs every
+    CHECKPOINT_BLOCKS blocks, reads those blocks back (if verify) and records in
+    its journal how far the target is known to be good.
+
+    Args:
+        image: Image file to write
+        targets: Block devices, loop devices or regular files
+        block_size: Transfer size (multiple of ALIGN); the manifest's, if given
+        progress: Print progress while writing
+        manifest: Block hashes of image
+        dirty: Block indexes to write per target (requires manifest)
+        journals: Resume journal per target (requires dirty)
+        verify: Read checkpointed blocks back before advancing a journal
+
+    Returns:
+        One FlashResult per target, in order, each with the image hash and
+        per-block hashes in .block_hashes
+    """
+    if manifest is not None:
+        block_size = manifest.block_size
+    if block_size % ALIGN:
+        raise FlashError(f"block size must be a multiple of {ALIGN}")
+    size = os.path.getsize(image)
+    count_blocks = (size + block_size - 1) // block_size
+    sinks = [_Sink(FlashResult(image=image, target=t, size=size, block_size=block_size))
+             for t in targets]
+    for sink in sinks:
+        try:
+            sink.open()
+        except OSError as e:
+            sink.fail(e)
+    block_hashes: List[bytes] = [] if manifest is None else manifest.blocks
+    image_hash = hashlib.sha256()
+
+    if dirty is None:
+        order = range(count_blocks)
+        wanted = None
+        totals = {t: size for t in targets}
+    else:
+        order = sorted(set().union(*dirty.values()))
+        wanted = {t: set(dirty[t]) for t in targets}
+        totals = {t: _span(dirty[t], size, block_size) for t in targets}
+
+    single = len(sinks) == 1
+    if single:
+        group = None
+        meters = [Progress('Writing', totals[targets[0]], enabled=progress)]
+    else:
+        group = ProgressGroup('Writing', totals, enabled=progress)
+        meters = [group.channel(t) for t in targets]
+        for sink in sinks:
+            if sink.error is not None:
+                group.drop(sink.result.target)
+
+    free: queue.Queue = queue.Queue()
+    for _ in range(BUFFERS if single else MULTI_BUFFERS):
+        free.put(_aligned_buffer(block_size))
+    refs = {}
+    refs_lock = threading.Lock()
+    read_errors: List[BaseException] = []
+
+    def release(buf) -> None:
+        with refs_lock:
+            refs[id(buf)] -= 1
+            if refs[id(buf)]:
+                return
+        free.put(buf)
+
+    def reader(src_fd: int):
+        try:
+            for index in order:
+                if all(s.error is not None for s in sinks):
+                    return
+                live = [s for s in sinks if s.error is None
+                        and (wanted is None or index in wanted[s.result.target])]
+                if not live:
+                    continue
+                buf = free.get()
+                offset = index * block_size
+                expected = min(block_size, size - offset)
+                count = os.preadv(src_fd, [buf], offset)
+                if count < expected:
+                    raise FlashError(f"short read from image at offset {offset}")
+                chunk = memoryview(buf)[:count]
+                digest = hashlib.sha256(chunk).digest()
+                if manifest is None:
+                    image_hash.update(chunk)
+                    block_hashes.append(digest)
+                elif digest != manifest.blocks[index]:
+                    raise FlashError(f"image differs from its manifest at block {index}")
+                with refs_lock:
+                    refs[id(buf)] = len(live)
+                for sink in live:
+                    sink.queue.put((index, offset, count, buf))
+        except BaseException as e:
+            read_errors.append(e)
+        finally:
+            for sink in sinks:
+                sink.queue.put(None)
+
+    def checkpoint(sink: _Sink, journal: DeployJournal, pending: List[int], next_block: int) -> None:
+        sink.sync()
+        if verify and pending:
+            bad = verify_target(sink.result.target, size, block_hashes, block_size=block_size,
+                                workers=1, progress=False, indexes=pending)
+            if bad:
+                sink.result.mismatched_blocks.extend(bad)
+                raise FlashError(f"{len(bad)} block(s) read back wrong, first at offset {bad[0] * block_size}")
+        journal.save(next_block)
+        pending.clear()
+
+    def writer(sink: _Sink, meter: Progress):
+        start = time.monotonic()
+        journal = journals.get(sink.result.target) if journals else None
+        pending: List[int] = []
+        while True:
+            item = sink.queue.get()
+            if item is None:
+                break
+            index, offset, count, buf = item
+            try:
+                if sink.error is None and not read_errors:
+                    aligned = count - count % ALIGN
+                    if aligned:
+                        _pwrite_all(sink.dst_fd, memoryview(buf)[:aligned], offset)
+                    if aligned < count:
+                        _pwrite_all(sink.tail_fd, memoryview(buf)[aligned:count], offset + aligned)
+                    sink.result.written += count
+                    meter.advance(count)
+                    pending.append(index)
+                    if journal and len(pending) >= CHECKPOINT_BLOCKS:
+                        checkpoint(sink, journal, pending, index + 1)
+            except BaseException as e:
+                # Keep draining so the shared buffers are still released
+                sink.fail(e)
+                if group:
+                    group.drop(sink.result.target)
+            finally:
+                release(buf)
+        if sink.error is None and not read_errors:
+            try:
+                if journal:
+                    checkpoint(sink, journal, pending, count_blocks)
+                else:
+                    sink.sync()
+            except (OSError, FlashError) as e:
+                sink.fail(e)
+        sink.result.elapsed = time.monotonic() - start
+
+    src_fd, _ = _open_direct(image, os.O_RDONLY)
+    threads = [threading.Thread(target=reader, args=(src_fd,), name='flash-reader')]
+    threads += [threading.Thread(target=writer, args=(s, m), name=f'flash-writer-{i}')
+                for i, (s, m) in enumerate(zip(sinks, meters)) if s.error is None]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads[1:]:
+            t.join()
+        threads[0].join()
+    finally:
+        os.close(src_fd)
+        for sink in sinks:
+            sink.close()
+
+    if read_errors:
+        raise FlashError(f"reading {image} failed: {read_errors[0]}") from read_errors[0]
+    if group:
+        group.finish()
+    else:
+        meters[0].finish()
+    for sink in sinks:
+        sink.result.sha256 = image_hash.hexdigest() if manifest is None else manifest.sha256
+        sink.result.block_hashes = block_hashes
+    return [s.result for s in sinks]
+
+
+def write_image(image: str, target: str, block_size: int = BLOCK_SIZE,
+                progress: bool = True) -> FlashResult:
+    """
+    Stream image onto target with a reader and a writer thread.
+
+    Args:
+        image: Image file to write
+        target: Block device, loop device or regular file
+        block_size: Transfer size (multiple of ALIGN)
+        progress: Print MB/s and ETA while writing
+
+    Returns:
+        FlashResult with the image hash and per-block hashes in .block_hashes
+
+    Raises:
+        FlashError: If the write fails
+    """
+    result = write_images(image, [target], block_size=block_size, progress=progress)[0]
+    if result.error:
+        raise FlashError(result.error)
+    return result
+
+
+def verify_target(target: str, size: int, block_hashes: List[bytes], block_size: int = BLOCK_SIZE,
+                  workers: int = VERIFY_WORKERS, progress: bool = True,
+                  meter: Optional[Progress] = None, indexes: Optional[List[int]] = None,
+                  label: str = 'Verifying') -> List[int]:
+    """
+    Read target back in parallel and compare blocks with the expected hashes.
+
+    O_DIRECT reads bypass the page cache so the device itself is checked; without
+    it, the cached pages of the target are dropped first.
+
+    Args:
+        target: Device or file that was written
+        size: Image size in bytes
+        block_hashes: SHA-256 digest of each block_size block of the image
+        block_size: Block size used for block_hashes
+        workers: Parallel reader threads
+        progress: Print MB/s and ETA while verifying
+        meter: Report into this meter instead of printing a line of its own
+        indexes: Only check these blocks (default: all)
+        label: Label of the progress line
+
+    Returns:
+        List of mismatching block indexes (empty if the target matches)
+    """
+    indexes = list(range(len(block_hashes))) if indexes is None else sorted(indexes)
+    if not indexes:
+        return []
+    own_meter = meter is None
+    if own_meter:
+        meter = Progress(label, _span(indexes, size, block_size), enabled=progress)
+    workers = max(1, min(workers, len(indexes)))
+    per_worker = (len(indexes) + workers - 1) // workers
+
+    def check(part: List[int]) -> List[int]:
+        fd, direct = _open_direct(target, os.O_RDONLY)
+        bad = []
+        try:
+            if not direct:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            buf = _aligned_buffer(block_size)
+            for index in part:
+                offset = index * block_size
+                expected = min(block_size, size - offset)
+                got = os.preadv(fd, [buf], offset)
+                data = memoryview(buf)[:min(got, expected)]
+                if got < expected or hashlib.sha256(data).digest() != block_hashes[index]:
+                    bad.append(index)
+                meter.advance(expected)
+        finally:
+            os.close(fd)
+        return bad
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        parts = [indexes[i:i + per_worker] for i in range(0, len(indexes), per_worker)]
+        mismatched = sorted(b for part in pool.map(check, parts) for b in part)
+    if own_meter:
+        meter.finish()
+    return mismatched
+
+
+def _check_many(label: str, jobs: Dict[str, List[int]], size: int, block_hashes: List[bytes],
+                block_size: int, progress: bool = True) -> Dict[str, object]:
+    """
+    Run verify_target on several targets concurrently under one progress line.
+
+    Returns:
+        Per target, the list of mismatching blocks or the OSError that stopped the check
+    """
+    found: Dict[str, object] = {}
+    if not jobs:
+        return found
+    group = None
+    if len(jobs) > 1:
+        group = ProgressGroup(label, {t: _span(ix, size, block_size) for t, ix in jobs.items()},
+                              enabled=progress)
+
+    def run(target: str) -> None:
+        try:
+            found[target] = verify_target(target, size, block_hashes, block_size=block_size,
+                                          progress=progress, indexes=jobs[target], label=label,
+                                          meter=group.channel(target) if group else None)
+        except OSError as e:
+            found[target] = e
+            if group:
+                group.drop(target)
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        list(pool.map(run, jobs))
+    if group:
+        group.finish()
+    return found
+
+
+def verify_targets(results: List[FlashResult], progress: bool = True) -> None:
+    """
+    Verify every successfully written target concurrently, filling in each result.
+
+    Args:
+        results: Results from write_images (failed ones are skipped)
+        progress: Print progress while verifying
+    """
+    pending = [r for r in results if not r.error]
+    if not pending:
+        return
+    first = pending[0]
+    start = time.monotonic()
+    every = list(range(len(first.block_hashes)))
+    found = _check_many('Verifying', {r.target: every for r in pending}, first.size,
+                        first.block_hashes, first.block_size, progress=progress)
+    for result in pending:
+        result.verify_elapsed = time.monotonic() - start
+        outcome = found[result.target]
+        if isinstance(outcome, OSError):
+            result.error = f"verify failed: {outcome}"
+            continue
+        result.mismatched_blocks = outcome
+        result.verified = not outcome
+
+
+def _flash_incremental(image: str, targets: List[str], manifest: Manifest, verify: bool,
+                       progress: bool) -> List[FlashResult]:
+    """
+    Write only the blocks each target does not already hold, resuming interrupted deploys.
+
+    A journal is trusted only if the last block it vouches for still reads back
+    as the image; blocks from there on are compared against the manifest and
+    only the ones that differ are written (and read back, if verify).
+    """
+    if not manifest.matches(image):
+        raise FlashError(f"manifest of {image} is stale")
+    size, block_size = manifest.size, manifest.block_size
+    count = len(manifest.blocks)
+    journals = {t: DeployJournal.load(t, manifest) for t in targets}
+
+    guards = {t: [j.next_block - 1] for t, j in journals.items() if j.next_block}
+    for target, outcome in _check_many('Checking', guards, size, manifest.blocks, block_size,
+                                       progress=False).items():
+        if outcome:
+            journals[target].next_block = 0
+    resumed = {t: j.next_block for t, j in journals.items()}
+
+    scans = {t: list(range(resumed[t], count)) for t in targets if os.path.exists(t)}
+    found = _check_many('Comparing', scans, size, manifest.blocks, block_size, progress=progress)
+    dirty = {}
+    for target in targets:
+        outcome = found.get(target)
+        dirty[target] = outcome if isinstance(outcome, list) else list(range(resumed[target], count))
+
+    results = write_images(image, targets, progress=progress, manifest=manifest, dirty=dirty,
+                           journals=journals, verify=verify)
+    for result in results:
+        result.resumed_from = resumed[result.target]
+        result.skipped_blocks = count - resumed[result.target] - len(dirty[result.target])
+        if result.mismatched_blocks:
+            result.verified = False
+        elif not result.error:
+            journals[result.target].clear()
+            if verify:
+                result.verified = True
+    return results
+
+
+def flash_many(image: str, targets: List[str], block_size: int = BLOCK_SIZE, verify: bool = True,
+               progress: bool = True, manifest: Optional[Manifest] = None) -> List[FlashResult]:
+    """
+    Write image to several targets at once and (optionally) verify each of them.
+
+    Targets that are mounted, too small, unwritable or fail verification are
+    reported in their result without affecting the rest. With a manifest, only
+    blocks that differ from the image are written and interrupted deploys resume.
+
+    Args:
+        image: Image file to write
+        targets: Block devices, loop devices or regular files (no duplicates)
+        block_size: Transfer size in bytes (ignored with a manifest)
+        verify: Read every target back and compare block hashes
+        progress: Print progress lines
+        manifest: Block hashes of image, for incremental writes
+
+    Returns:
+        One FlashResult per target, in order
+    """
+    check_targets(targets)
+    size = os.path.getsize(image)
+    results = {}
+    usable = []
+    for target in targets:
+        try:
+            check_target(target, size)
+            usable.append(target)
+        except (FlashError, OSError) as e:
+            results[target] = FlashResult(image=image, target=target, size=size,
+                                          block_size=block_size, error=str(e))
+    if usable and manifest is not None:
+        for result in _flash_incremental(image, usable, manifest, verify, progress):
+            results[result.target] = result
+    elif usable:
+        written = write_images(image, usable, block_size=block_size, progress=progress)
+        for result in written:
+            results[result.target] = result
+        if verify:
+            verify_targets(written, progress=progress)
+    return [results[t] for t in targets]
+
+
+def flash(image: str, target: str, block_size: int = BLOCK_SIZE, verify: bool = True,
+          progress: bool = True) -> FlashResult:
+    """
+    Write image to target and (optionally) verify it.
+
+    Args:
+        image: Image file to write
+        target: Block device, loop device or regular file
+        block_size: Transfer size in bytes
+        verify: Read the target back and compare block hashes
+        progress: Print progress lines
+
+    Returns:
+        FlashResult
+
+    Raises:
+        FlashError: If the target is unusable or the write fails
+    """
+    result = flash_many(image, [target], block_size=block_size, verify=verify, progress=progress)[0]
+    if result.error:
+        raise FlashError(result.error)
+    return result
+
+
+def print_result(result: FlashResult) -> None:
+    """Print a summary of a flash run."""
+    if result.error:
+        print(f"ERROR: {result.target}: {result.error}")
+        return
+    rate = result.written / result.elapsed / 1e6 if result.elapsed else 0
+    print(f"✓ Wrote {result.written / 1e6:.0f} MB to {result.target} in {result.elapsed:.1f}s "
+          f"({rate:.1f} MB/s{'' if result.direct_io else ', buffered'})")
+    total = (result.size + result.block_size - 1) // result.block_size
+    if result.resumed_from:
+        print(f"  Resumed at block {result.resumed_from}; {result.skipped_blocks} of the remaining "
+              f"{total - result.resumed_from} blocks already matched the image")
+    elif result.skipped_blocks:
+        print(f"  {result.skipped_blocks} of {total} blocks already matched the image")
+    print(f"  Image SHA-256: {result.sha256}")
+    if result.verified is True:
+        took = f" ({result.verify_elapsed:.1f}s)" if result.verify_elapsed else ''
+        print(f"✓ Verified {result.target}{took}")
+    elif result.verified is False:
+        print(f"ERROR: Verification of {result.target} failed: {len(result.mismatched_blocks)} block(s) differ "
+              f"(first at offset {result.mismatched_blocks[0] * result.block_size})")
+
+
+def print_results(results: List[FlashResult]) -> None:
+    """Print a summary per target, plus a tally when there are several."""
+    for result in results:
+        print_result(result)
+    if len(results) > 1:
+        failed = [r.target for r in results if not r.ok]
+        print(f"{len(results) - len(failed)}/{len(results)} targets written successfully"
+              + (f"; failed: {', '.join(failed)}" if failed else ''))
+
+
+def flash_as_root(image: str, targets: List[str], verify: bool = True,
+                  incremental: bool = False) -> int:
+    """
+    Flash in-process when every target is writable, otherwise once under sudo.
+
+    Without a terminal on stdin (a build-server job) sudo runs with -n: it
+    fails instead of waiting for a password nobody can type, and the caller
+    is told how to deploy instead.
+
+    Args:
+        image: Image file to write
+        targets: Target devices
+        verify: Read the targets back
+        incremental: Write only blocks that differ from the image's manifest
+
+    Returns:
+        Exit code (0 if every target succeeded)
+    """
+    if os.geteuid() == 0 or all(os.path.exists(t) and os.access(t, os.W_OK) for t in targets):
+        try:
+            manifest = ensure_manifest(image) if incremental else None
+            results = flash_many(image, targets, verify=verify, manifest=manifest)
+        except (FlashError, OSError) as e:
+            print(f"\nError: {e}", file=sys.stderr)
+            return 1
+        print_results(results)
+        write_deploy_metrics(results)
+        return 0 if all(r.ok for r in results) else 1
+
+    interactive = sys.stdin is not None and sys.stdin.isatty()
+    cmd = ['sudo'] + ([] if interactive else ['-n'])
+    cmd += [sys.executable, '-m', 'lib.controller.flash', image] + list(targets)
+    if not verify:
+        cmd.append('--no-verify')
+    if incremental:
+        cmd.append('--incremental')
+    if metrics_dir() is not None:
+        # sudo resets the environment
+        cmd += ['--metrics-dir', str(metrics_dir())]
+    if interactive:
+        return subprocess.run(cmd, cwd=str(REPO_ROOT)).returncode
+
+    proc = subprocess.run(cmd, cwd=str(REPO_ROOT), stdin=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                          text=True, env={**os.environ, 'LC_ALL': 'C'})
+    if proc.returncode != 0 and 'password is required' in proc.stderr:
+        print("Error: Writing to the devices needs root, and sudo wants a password that cannot be "
+              "asked for here (no terminal, e.g. a build-server job).", file=sys.stderr)
+        print("Run the build server as root, allow passwordless sudo for "
+              f"'{sys.executable} -m lib.controller.flash', or stop the server "
+              "(deployment/controller --serve stop) and deploy from a terminal.", file=sys.stderr)
+        return 1
+    sys.stderr.write(proc.stderr)
+    return proc.returncode
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Write an image to one or more devices with O_DIRECT and verify them')
+    parser.add_argument('image', help='Image file (ISO)')
+    parser.add_argument('targets', nargs='+', metavar='target', help='Target block device or file')
+    parser.add_argument('--block-size', type=int, default=BLOCK_SIZE,
+                        help=f'Transfer size in bytes (default {BLOCK_SIZE})')
+    parser.add_argument('--no-verify', action='store_true',
+                        help='Skip reading the targets back')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Write only blocks that differ from the image manifest and resume interrupted runs')
+    parser.add_argument('--metrics-dir', metavar='DIR',
+                        help=f'Write {DEPLOY_FILE} for the node_exporter textfile collector (default ${METRICS_DIR_ENV})')
+    args = parser.parse_args()
+    if args.metrics_dir:
+        os.environ[METRICS_DIR_ENV] = args.metrics_dir
+
+    try:
+        manifest = ensure_manifest(args.image) if args.incremental else None
+        results = flash_many(args.image, args.targets, block_size=args.block_size,
+                             verify=not args.no_verify, manifest=manifest)
+    except (FlashError, OSError) as e:
+        print(f"\nError: {e}", file=sys.stderr)
+        sys.exit(1)
+    print_results(results)
+    write_deploy_metrics(results)
+    sys.exit(0 if all(r.ok for r in results) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Locks that let controller commands run side by side on one work directory.
+
+Two flock(2) locks live in ${HOMERCHY_LOCK_DIR:-/tmp/homerchy-locks}, one
+directory (sticky, world-writable) for every user, so a `sudo controller` run
+and a user's run exclude each other:
+
+    workdir  exclusive: build, eject, cache trim (they rewrite the work directory)
+    isoout   shared:    deploy, launch-iso (they read a published ISO)
+             exclusive: eject, evicting old ISOs, replacing a published ISO
+
+Builds write the ISO to a staging directory and publish it into isoout/ by
+rename, so a deploy of ISO N keeps running while ISO N+1 builds; only
+replacing or deleting an ISO someone is reading waits for them.
+
+Locks are re-entrant within a thread (a build that ends by trimming caches
+already holds the work directory). Other threads of the process, such as the
+jobs of a build server, open the lock on their own and are excluded like other
+processes. A process that exits drops its locks.
+"""
+
+import fcntl
+import os
+import stat
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple
+
+LOCK_DIR_ENV = 'HOMERCHY_LOCK_DIR'
+DEFAULT_LOCK_DIR = '/tmp/homerchy-locks'
+WORKDIR = 'workdir'
+ISOOUT = 'isoout'
+POLL_INTERVAL = 0.5     # seconds between attempts while waiting
+
+# name -> [fd, exclusive, depth] for the locks the current thread holds
+_local = threading.local()
+
+
+def _held() -> Dict[str, list]:
+    held = getattr(_local, 'held', None)
+    if held is None:
+        held = _local.held = {}
+    return held
+
+
+class LockBusy(Exception):
+    """Raised when a lock is taken and the caller asked not to wait."""
+
+
+def lock_dir() -> Path:
+    """Directory of the lock files."""
+    return Path(os.environ.get(LOCK_DIR_ENV) or DEFAULT_LOCK_DIR)
+
+
+def _ensure_lock_dir() -> Path:
+    """Create the lock directory (mode 1777) or check that the existing one is a real directory."""
+    directory = lock_dir()
+    try:
+        directory.mkdir(parents=True)
+        os.chmod(directory, 0o1777)
+    except FileExistsError:
+        pass
+    st = os.lstat(directory)
+    if not stat.S_ISDIR(st.st_mode):
+        raise OSError(f"lock directory {directory} is not a directory")
+    return directory
+
+
+def holders(name: str) -> List[Tuple[int, str]]:
+    """Live processes holding (or waiting to upgrade) a lock: (pid, purpose)."""
+    found = []
+    for info in lock_dir().glob(f'{name}.*.holder'):
+        try:
+            pid = int(info.name.split('.')[1])
+            purpose = info.read_text().strip()
+        except (ValueError, OSError):
+            continue
+        if info == _holder_file(name):
+            continue
+        if Path(f'/proc/{pid}').exists():
+            found.append((pid, purpose))
+        else:
+            try:
+                info.unlink()
+            except OSError:
+                pass
+    return found
+
+
+def _holder_file(name: str) -> Path:
+    return lock_dir() / f'{name}.{os.getpid()}.{threading.get_ident()}.holder'
+
+
+def _flock(fd: int, exclusive: bool, name: str, wait: bool, purpose: str) -> None:
+    mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+    announced = False
+    while True:
+        try:
+            fcntl.flock(fd, mode | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if not wait:
+                raise LockBusy(name)
+        if not announced:
+            others = ', '.join(f"{what or 'controller'} (pid {pid})" for pid, what in holders(name))
+            print(f"Waiting for the {name} lock{' held by ' + others if others else ''}...",
+                  file=sys.stderr)
+            announced = True
+        time.sleep(POLL_INTERVAL)
+
+
+@contextmanager
+def hold(name: str, exclusive: bool, wait: bool = True, purpose: str = '') -> Iterator[None]:
+    """
+    Hold a lock for the duration of a with-block.
+
+    Args:
+        name: Lock name (WORKDIR or ISOOUT)
+        exclusive: Exclusive (writer) or shared (reader) lock
+        wait: Wait for the lock; if False raise LockBusy when it is taken
+        purpose: What the lock is for, shown to commands waiting on it
+
+    Raises:
+        LockBusy: If wait is False and the lock is taken
+    """
+    held = _held()
+    entry = held.get(name)
+    if entry is not None:
+        fd, held_exclusive, _ = entry
+        if exclusive and not held_exclusive:
+            # Upgrade (flock converts in place; the shared lock may be lost while waiting)
+            _flock(fd, True, name, wait, purpose)
+            entry[1] = True
+        entry[2] += 1
+        try:
+            yield
+        finally:
+            entry[2] -= 1
+            if exclusive and not held_exclusive:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                entry[1] = False
+        return
+
+    directory = _ensure_lock_dir()
+    # Read-only is enough for flock, and lets every user open a lock file another user created
+    fd = os.open(directory / f'{name}.lock', os.O_RDONLY | os.O_CREAT | os.O_CLOEXEC | os.O_NOFOLLOW, 0o644)
+    try:
+        _flock(fd, exclusive, name, wait, purpose)
+    except BaseException:
+        os.close(fd)
+        raise
+    held[name] = [fd, exclusive, 1]
+    try:
+        _holder_file(name).write_text(purpose)
+    except OSError:
+        pass
+    try:
+        yield
+    finally:
+        del held[name]
+        try:
+            _holder_file(name).unlink()
+        except OSError:
+            pass
+        os.close(fd)
@@ -8,11 +8,12 @@ Thin wrapper providing CLI interface to deployment/deployment/controller operati
 """
 
 import argparse
+import os
 import sys
 import time
 from pathlib import Path
 
-from . import eject, build, vm, deploy
+from . import eject, build, vm, deploy, stats, server, cache, locks, matrix, autobuild, bundle
 
 
 def usage():
@@ -20,14 +21,39 @@ def usage():
     print("Usage: deployment/deployment/controller [OPTIONS]")
     print("Options:")
     print("  -b, --build       Generate a new Homerchy ISO")
+    print("  -r, --resume      Resume a failed build from its first incomplete phase")
     print("  -l, --launch      Launch the VM from onmachine/deployment/installed disk (existing system)")
     print("  -L, --launch-iso  Launch the VM from ISO (fresh onmachine/onmachine/deployment/install)")
     print("  -f, --full        Build the ISO (reusing cache) and then launch the VM from ISO")
     print("  -F, --full-clean  Full clean rebuild (eject all caches, build, then launch from ISO)")
-    print("  -d, --deploy DEV  Deploy (dd) the ISO to a device (e.g. /dev/sdX)")
+    print("  -d, --deploy DEV  Write the ISO to one or more devices at once (e.g. /dev/sdX /dev/sdY)")
     print("  -e, --eject       Eject cartridge (preserves caches for faster rebuilds)")
     print("  -E, --eject-full  Full eject (removes all caches, completely clean)")
+    print("  --matrix [VAR...] Build every ISO variant (or the named ones) from one shared package cache")
+    print("  --jobs N          Variants a matrix build runs at once (default HOMERCHY_MATRIX_JOBS or 2)")
+    print("  --watch           Build, then rebuild only what each source edit affects (Ctrl+C stops)")
+    print("  --profile         Print the per-phase resource breakdown after a build")
+    print("  --stats [N]       Compare the last N builds (default 5) and flag regressions")
+    print("  --cache [ACTION]  Show build cache usage (status, default) or evict down to the quota (trim)")
+    print("  --export-cache FILE  Pack the offline package mirror into FILE (for air-gapped hosts)")
+    print("  --import-cache FILE  Merge a bundle written by --export-cache into the offline mirror")
+    print("  --serve [ACTION]  Run the build server (start, default), or query/stop it (status, stop);")
+    print("                    while it runs, -b/-r/-e/-E/-d are queued on it")
     print("  -h, --help        Show this help message")
+    print("Set HOMERCHY_METRICS_DIR to write Prometheus textfile metrics for builds and deploys.")
+
+
+def forward_to_server(args) -> int:
+    """Submit -b/-r/-e/-E/-d to the running build server and stream the job output."""
+    if args.build or args.resume:
+        return server.submit('build', {'resume': bool(args.resume), 'profile': bool(args.profile)})
+    if args.deploy:
+        # Confirm here: the server's jobs have no terminal to ask on
+        if not deploy.confirm_deploy(args.deploy, deploy.latest_iso()):
+            print("Deploy cancelled.")
+            return 0
+        return server.submit('deploy', {'devices': args.deploy})
+    return server.submit('eject', {'full': bool(args.eject_full)})
 
 
 def main():
@@ -38,14 +64,29 @@ def main():
         epilog="""
 Examples:
   deployment/controller -b              # Build ISO (reusing cache)
+  deployment/controller -r              # Resume a failed build
+  deployment/controller -b --profile    # Build and print per-phase resource usage
+  deployment/controller --watch         # Rebuild on every edit under deployment/
+  deployment/controller --matrix        # Build the VM-test, developer and production ISOs
+  deployment/controller --matrix developer production --jobs 1
+  deployment/controller --stats 10      # Compare the last 10 builds
   deployment/controller -F              # Full clean rebuild and launch VM
   deployment/controller -e              # Eject cartridge (preserve caches)
   deployment/deployment/controller -d /dev/sdX     # Deploy ISO to device
+  deployment/controller -d /dev/sdX /dev/sdY    # Flash several devices in one pass
+  deployment/controller --cache trim    # Evict old caches down to HOMERCHY_CACHE_QUOTA
+  deployment/controller --export-cache /media/usb/mirror.hcb   # Carry the package cache over
+  deployment/controller --import-cache /media/usb/mirror.hcb   # ...to a host without network
+  deployment/controller --serve         # Run the build server (keeps indexes warm between builds)
+  deployment/controller --serve status  # Show the server's queue
+  HOMERCHY_METRICS_DIR=/var/lib/node_exporter deployment/controller -b   # Export Prometheus metrics
         """
     )
     
     parser.add_argument('-b', '--build', action='store_true',
                        help='Generate a new Homerchy ISO')
+    parser.add_argument('-r', '--resume', action='store_true',
+                       help='Resume a failed build from its first incomplete phase')
     parser.add_argument('-l', '--launch', action='store_true',
                        help='Launch the VM from onmachine/deployment/deployment/installed disk (existing system)')
     parser.add_argument('-L', '--launch-iso', action='store_true',
@@ -54,12 +95,33 @@ Examples:
                        help='Build the ISO (reusing cache) and then launch the VM from ISO')
     parser.add_argument('-F', '--full-clean', action='store_true',
                        help='Full clean rebuild (eject all caches, build, then launch from ISO)')
-    parser.add_argument('-d', '--deploy', metavar='DEV',
-                       help='Deploy (dd) the ISO to a device (e.g. /dev/sdX)')
+    parser.add_argument('-d', '--deploy', metavar='DEV', nargs='+',
+                       help='Write the ISO to one or more devices at once (e.g. /dev/sdX)')
     parser.add_argument('-e', '--eject', action='store_true',
                        help='Eject cartridge (preserves caches for faster rebuilds)')
     parser.add_argument('-E', '--eject-full', action='store_true',
                        help='Full eject (removes all caches, completely clean)')
+    parser.add_argument('--matrix', nargs='*', metavar='VARIANT',
+                       help='Build every ISO variant of vmtools/index.json (or the named ones) '
+                            'from one shared package cache')
+    parser.add_argument('--jobs', type=int, metavar='N',
+                       help='Variants a matrix build runs at once (default HOMERCHY_MATRIX_JOBS or 2)')
+    parser.add_argument('--watch', action='store_true',
+                       help='Build, then rebuild only what each source edit affects')
+    parser.add_argument('--profile', action='store_true',
+                       help='Print the per-phase resource breakdown after a build')
+    parser.add_argument('--stats', nargs='?', type=int, const=5, metavar='N',
+                       help='Compare the last N builds (default 5) and flag regressions')
+    parser.add_argument('--cache', nargs='?', const='status', choices=['status', 'trim'],
+                       metavar='ACTION',
+                       help='Show build cache usage (status) or evict down to the quota (trim)')
+    parser.add_argument('--export-cache', metavar='FILE',
+                       help='Pack the offline package mirror into FILE (for air-gapped hosts)')
+    parser.add_argument('--import-cache', metavar='FILE',
+                       help='Merge a bundle written by --export-cache into the offline mirror')
+    parser.add_argument('--serve', nargs='?', const='start', choices=['start', 'status', 'stop'],
+                       metavar='ACTION',
+                       help='Run the build server (start), or query/stop it (status, stop)')
     
     args = parser.parse_args()
     
@@ -68,9 +130,39 @@ Examples:
         usage()
         sys.exit(1)
     
+    if args.serve:
+        sys.exit(server.do_serve(args.serve))
+    
+    # Queue jobs on the build server when one is running
+    if (args.build or args.resume or args.eject or args.eject_full or args.deploy) \
+            and server.available():
+        sys.exit(forward_to_server(args))
+    
     # Handle each option
     if args.build:
-        sys.exit(build.do_build(full_clean=False, cache_db_only=False))
+        sys.exit(build.do_build(full_clean=False, cache_db_only=False, profile=args.profile))
+    
+    if args.watch:
+        sys.exit(autobuild.do_watch(profile=args.profile))
+    
+    if args.matrix is not None:
+        sys.exit(matrix.do_matrix(args.matrix, args.jobs))
+    
+    if args.resume:
+        sys.exit(build.do_build(full_clean=False, cache_db_only=False, resume=True,
+                                profile=args.profile))
+    
+    if args.cache:
+        sys.exit(cache.do_cache(args.cache))
+    
+    if args.export_cache:
+        sys.exit(bundle.do_export_cache(args.export_cache))
+    
+    if args.import_cache:
+        sys.exit(bundle.do_import_cache(args.import_cache))
+    
+    if args.stats is not None:
+        sys.exit(stats.do_stats(args.stats))
     
     if args.launch:
         vm.do_launch()
@@ -81,7 +173,7 @@ Examples:
         return
     
     if args.full:
-        exit_code = build.do_build(full_clean=False, cache_db_only=True)
+        exit_code = build.do_build(full_clean=False, cache_db_only=True, profile=args.profile)
         if exit_code == 0:
             vm.do_launch_iso()
         else:
@@ -94,21 +186,25 @@ Examples:
         start_time = time.time()
         print(">>> Full Clean: Starting timer...")
         
-        # Full clean: remove everything in /mnt/work/
-        print(">>> Full Clean: Removing everything in /mnt/work/...")
-        from .utils import run_command, run_shell_command
-        work_base = Path("/mnt/work")
-        if work_base.exists():
-            # Remove all contents (including hidden files/dirs) but keep the directory itself
-            # Use find to safely remove hidden files without matching . and ..
-            run_shell_command(
-                'find /mnt/work -mindepth 1 -maxdepth 1 -exec rm -rf {} +',
-                sudo=True,
-                check=False
-            )
-            print("✓ /mnt/work/ fully cleaned")
-        # Build with full clean
-        exit_code = build.do_build(full_clean=True, cache_db_only=False)
+        # Full clean: remove the build's directories in /mnt/work/ (work dir, cache store, scratch)
+        print(">>> Full Clean: Removing the build's directories in /mnt/work/...")
+        from .privhelper import get_helper, work_roots
+        from .reaper import reap
+        with locks.hold(locks.WORKDIR, exclusive=True, purpose='full clean'):
+            entries = [Path(root) for root in work_roots() if os.path.lexists(root)]
+            if entries:
+                with locks.hold(locks.ISOOUT, exclusive=True, purpose='full clean'):
+                    helper = get_helper()
+                    # Reap only what is being removed: /mnt/work may be a disk of its own,
+                    # and processes elsewhere on it are none of the build's business
+                    for entry in entries:
+                        if entry.is_dir() and not entry.is_symlink():
+                            reap(str(entry))
+                    helper.batch([{'op': 'rmtree', 'path': str(entry)} for entry in entries],
+                                 check=False)
+                print("✓ Build directories in /mnt/work/ fully cleaned")
+            # Build with full clean
+            exit_code = build.do_build(full_clean=True, cache_db_only=False, profile=args.profile)
         if exit_code == 0:
             vm.do_launch_iso()
             # End timer and display elapsed time
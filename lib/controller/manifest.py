@@ -0,0 +1,196 @@
+"""
+Block-hash manifests for built ISOs and resume journals for deploys.
+
+Each ISO in isoout/ gets a manifest next to it (omarchy-*.iso.blocks.json)
+holding the SHA-256 of every block. Deploy compares a target's existing
+blocks against it and writes only those that differ. While writing, a
+journal per target
+(${XDG_STATE_HOME:-~/.local/state}/homerchy/deploy/<target-id>.json)
+records the block up to which the target is known to hold the image, so an
+interrupted deploy picks up where it stopped.
+"""
+
+import hashlib
+import json
+import os
+import stat
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional
+
+MANIFEST_SUFFIX = '.blocks.json'
+MANIFEST_VERSION = 1
+MANIFEST_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+@dataclass
+class Manifest:
+    """Block hashes of one image."""
+    image: str
+    size: int
+    mtime_ns: int
+    block_size: int
+    sha256: str
+    blocks: List[bytes] = field(default_factory=list, repr=False)
+
+    def block_length(self, index: int) -> int:
+        """Bytes in block index (the last one may be short)."""
+        return min(self.block_size, self.size - index * self.block_size)
+
+    def matches(self, image: str) -> bool:
+        """True if image is still the file this manifest was made from."""
+        try:
+            st = os.stat(image)
+        except OSError:
+            return False
+        return st.st_size == self.size and st.st_mtime_ns == self.mtime_ns
+
+    def to_dict(self) -> dict:
+        return {
+            'version': MANIFEST_VERSION,
+            'image': os.path.basename(self.image),
+            'size': self.size,
+            'mtime_ns': self.mtime_ns,
+            'block_size': self.block_size,
+            'sha256': self.sha256,
+            'blocks': [b.hex() for b in self.blocks],
+        }
+
+
+def manifest_path(image: str) -> Path:
+    """Where the manifest of image lives."""
+    return Path(str(image) + MANIFEST_SUFFIX)
+
+
+def build_manifest(image: str, block_size: int = MANIFEST_BLOCK_SIZE) -> Manifest:
+    """Hash image block by block."""
+    st = os.stat(image)
+    whole = hashlib.sha256()
+    blocks = []
+    with open(image, 'rb', buffering=0) as f:
+        buf = bytearray(block_size)
+        view = memoryview(buf)
+        while True:
+            count = f.readinto(buf)
+            if not count:
+                break
+            whole.update(view[:count])
+            blocks.append(hashlib.sha256(view[:count]).digest())
+    return Manifest(image=str(image), size=st.st_size, mtime_ns=st.st_mtime_ns,
+                    block_size=block_size, sha256=whole.hexdigest(), blocks=blocks)
+
+
+def load_manifest(image: str) -> Optional[Manifest]:
+    """Manifest of image, or None if missing, unreadable or made from another build."""
+    try:
+        with open(manifest_path(image), 'r') as f:
+            data = json.load(f)
+        if data.get('version') != MANIFEST_VERSION:
+            return None
+        manifest = Manifest(image=str(image), size=data['size'], mtime_ns=data['mtime_ns'],
+                            block_size=data['block_size'], sha256=data['sha256'],
+                            blocks=[bytes.fromhex(b) for b in data['blocks']])
+    except (OSError, ValueError, KeyError):
+        return None
+    return manifest if manifest.matches(image) else None
+
+
+def write_manifest(manifest: Manifest, path: Optional[Path] = None) -> Optional[Path]:
+    """
+    Store manifest (next to its image unless path is given).
+
+    Returns:
+        The path written, or None if the directory is not writable
+    """
+    path = Path(path) if path else manifest_path(manifest.image)
+    tmp = path.with_name(path.name + '.tmp')
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(manifest.to_dict(), f)
+        os.replace(tmp, path)
+    except OSError:
+        return None
+    return path
+
+
+def ensure_manifest(image: str) -> Manifest:
+    """Load the manifest of image, (re)building and storing it if missing or stale."""
+    manifest = load_manifest(image)
+    if manifest is None:
+        print(f"Hashing {os.path.basename(image)} into a block manifest...")
+        manifest = build_manifest(image)
+        if write_manifest(manifest) is None:
+            print(f"WARNING: Could not write {manifest_path(image)}; it will be rebuilt next deploy")
+    return manifest
+
+
+def journal_dir() -> Path:
+    """Directory holding the deploy resume journals."""
+    state_home = os.environ.get('XDG_STATE_HOME') or str(Path.home() / '.local' / 'state')
+    return Path(state_home) / 'homerchy' / 'deploy'
+
+
+def target_identity(target: str) -> str:
+    """
+    Stable name of the physical target, so a journal is never applied to another stick
+    that happens to appear under the same /dev node.
+    """
+    real = os.path.realpath(target)
+    if not os.path.exists(real) or not stat.S_ISBLK(os.stat(real).st_mode):
+        return f"file:{real}"
+    by_id = Path('/dev/disk/by-id')
+    names = []
+    if by_id.is_dir():
+        names = sorted(p.name for p in by_id.iterdir() if os.path.realpath(p) == real)
+    with open(real, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+    return f"dev:{names[0] if names else real}:{size}"
+
+
+class DeployJournal:
+    """Highest block below which a target is known to hold a given image."""
+
+    def __init__(self, target: str, identity: str, manifest: Manifest, next_block: int = 0):
+        self.target = target
+        self.identity = identity
+        self.manifest = manifest
+        self.next_block = next_block
+        self.path = journal_dir() / (hashlib.sha256(identity.encode()).hexdigest()[:16] + '.json')
+
+    @classmethod
+    def load(cls, target: str, manifest: Manifest) -> 'DeployJournal':
+        """Journal of target for this image (starting at block 0 if none applies)."""
+        try:
+            identity = target_identity(target)
+        except OSError:
+            return cls(target, f"unreadable:{os.path.realpath(target)}", manifest)
+        journal = cls(target, identity, manifest)
+        try:
+            with open(journal.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return journal
+        if (data.get('identity') == identity and data.get('sha256') == manifest.sha256
+                and data.get('block_size') == manifest.block_size):
+            journal.next_block = min(int(data.get('next_block', 0)), len(manifest.blocks))
+        return journal
+
+    def save(self, next_block: int) -> None:
+        self.next_block = next_block
+        data = {'identity': self.identity, 'target': self.target, 'sha256': self.manifest.sha256,
+                'block_size': self.manifest.block_size, 'next_block': next_block}
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+    def clear(self) -> None:
+        self.next_block = 0
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
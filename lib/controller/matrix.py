@@ -0,0 +1,145 @@
+"""
+Matrix builds: every ISO variant from one package download and one base profile.
+
+The variants are the installer profiles of deployment/vmtools/index.json
+(VM test, developer, production). isoprep downloads the union of their
+packages into the shared offline mirror and assembles the base profile once;
+each variant then clones the profile, applies its overlay and runs mkarchiso
+in its own work directory, a few at a time.
+"""
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from . import locks
+from .build import REPO_ROOT, load_isoprep, write_iso_manifests
+from .cache import enforce_quota, mark_build
+from .metrics import write_build_metrics
+from .privhelper import get_helper
+from .reaper import reap
+from .stats import _fmt_bytes, _fmt_secs, append_record, load_counters, load_profile, make_record
+from .workdir import setup_build_workdir
+
+JOBS_ENV = 'HOMERCHY_MATRIX_JOBS'
+DEFAULT_JOBS = 2
+REPORT_NAME = 'matrix-report.json'
+
+
+def default_jobs() -> int:
+    """Variants built at once: $HOMERCHY_MATRIX_JOBS, else 2 (mkarchiso is I/O and CPU heavy)."""
+    try:
+        return max(1, int(os.environ.get(JOBS_ENV, DEFAULT_JOBS)))
+    except ValueError:
+        return DEFAULT_JOBS
+
+
+def do_matrix(variants: Optional[List[str]] = None, jobs: Optional[int] = None) -> int:
+    """
+    Build several ISO variants sharing one package cache.
+
+    Args:
+        variants: Variant names (default: every profile of vmtools/index.json)
+        jobs: Variants built concurrently (default: default_jobs())
+
+    Returns:
+        Exit code (0 if every variant built)
+    """
+    print(">>> Starting Matrix Build...")
+    with locks.hold(locks.WORKDIR, exclusive=True, purpose='matrix build'):
+        return _matrix(variants or None, jobs or default_jobs())
+
+
+def _matrix(variants: Optional[List[str]], jobs: int) -> int:
+    """do_matrix() with the work directory locked."""
+    start_time = time.monotonic()
+    work_dir = Path(setup_build_workdir())
+    if work_dir.exists():
+        stale = reap(str(work_dir), dry_run=True, verbose=False)
+        if stale.mounts:
+            print("Found stale mounts from previous build, cleaning up...")
+            reap(str(work_dir))
+
+    profile_file = work_dir / '.isoprep-profile.json'
+    helper = get_helper()
+    try:
+        isoprep = load_isoprep()
+        config = isoprep.BuildConfig(
+            work_dir=work_dir,
+            repo_root=REPO_ROOT / "deployment",
+            skip_preflight=os.environ.get('HOMERCHY_SKIP_PREFLIGHT', 'false').lower() == 'true',
+            profile_file=profile_file,
+        )
+        try:
+            result = isoprep.run_matrix(config, variants, jobs)
+        finally:
+            isoprep.warm.dump_on_exit()
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    except SystemExit as e:
+        print(f"Matrix build failed in the base phases (exit {e.code})", file=sys.stderr)
+        return 1
+    except Exception as e:
+        print(f"Error running matrix build: {e}", file=sys.stderr)
+        return 1
+
+    exit_code = 0 if result.success else 1
+    if not result.base.success:
+        print(f"Failed phases: {', '.join(result.base.failed)}", file=sys.stderr)
+    iso_files = [Path(iso) for variant in result.variants for iso in variant.iso_files]
+    if iso_files:
+        write_iso_manifests(work_dir, helper, iso_files)
+        mark_build(work_dir)
+        enforce_quota(work_dir)
+
+    print_report(result)
+    write_report(result, work_dir / REPORT_NAME)
+
+    artifacts = {}
+    sizes = [iso.stat().st_size for iso in iso_files if iso.exists()]
+    if sizes:
+        artifacts['iso_size'] = max(sizes)
+    record = make_record(exit_code, time.monotonic() - start_time, load_profile(profile_file),
+                         artifacts=artifacts, counters=load_counters(profile_file),
+                         matrix=[v.name for v in result.variants], jobs=jobs)
+    append_record(record)
+    write_build_metrics(record)
+    return exit_code
+
+
+def print_report(result) -> None:
+    """Per-variant outcome table of a matrix build."""
+    print()
+    print(f"Matrix build: {len(result.variants)} variant(s) in {_fmt_secs(result.wall)} "
+          f"(base phases {_fmt_secs(result.base.wall)})")
+    if not result.variants:
+        return
+    print(f"  {'variant':<16} {'status':<7} {'time':>9} {'size':>9}  iso")
+    for variant in result.variants:
+        iso = Path(variant.iso_files[0]) if variant.iso_files else None
+        size = _fmt_bytes(iso.stat().st_size) if iso and iso.exists() else '-'
+        where = iso.name if iso else (f"see {variant.log}" if variant.log else '-')
+        print(f"  {variant.name:<16} {'ok' if variant.success else 'FAILED':<7} "
+              f"{_fmt_secs(variant.wall):>9} {size:>9}  {where}")
+
+
+def write_report(result, path: Path) -> None:
+    """Save the matrix outcome as JSON next to the builds (a failure to write is only reported)."""
+    report = {
+        'success': result.success,
+        'wall': result.wall,
+        'base': {'success': result.base.success, 'wall': result.base.wall,
+                 'cache_hits': result.base.cache_hits, 'failed': result.base.failed},
+        'variants': [{'name': v.name, 'success': v.success, 'wall': v.wall,
+                      'iso_files': v.iso_files, 'log': str(v.log) if v.log else None}
+                     for v in result.variants],
+    }
+    try:
+        path.write_text(json.dumps(report, indent=2) + '\n')
+        print(f"Report: {path}")
+    except OSError as e:
+        print(f"WARNING: Could not write {path}: {e}")
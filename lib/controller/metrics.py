@@ -0,0 +1,205 @@
+"""
+Build and deploy health in Prometheus textfile format.
+
+With HOMERCHY_METRICS_DIR set (point it at node_exporter's
+--collector.textfile.directory), every build and deploy rewrites its file:
+
+    homerchy_build.prom    last build: duration, phase durations, bytes the
+                           source injection copied, packages downloaded vs
+                           reused, ISO size, squashfs compression ratio
+    homerchy_deploy.prom   last deploy: bytes, duration, throughput per device
+
+Counters (*_total) carry on from the values in the previous file, so they
+survive between controller runs; deleting the file resets them, which
+Prometheus' rate() treats like any counter reset.
+
+The build file also carries the regression checks of `--stats` against the
+ledger, ready for alerting rules such as
+
+    homerchy_build_time_regression == 1      (build slower than its median)
+    homerchy_iso_size_regression == 1        (ISO bigger than its median)
+"""
+
+import os
+import re
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .stats import find_regressions, load_records
+
+METRICS_DIR_ENV = 'HOMERCHY_METRICS_DIR'
+BUILD_FILE = 'homerchy_build.prom'
+DEPLOY_FILE = 'homerchy_deploy.prom'
+REGRESSION_WINDOW = 5       # earlier builds the regression checks compare against (as --stats)
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*(?:\{[^}]*\})?)\s+(\S+)')
+
+# (name, type, help, [(labels, value)])
+Family = Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]
+
+
+def metrics_dir() -> Optional[Path]:
+    """Textfile collector directory, or None if metrics are disabled."""
+    directory = os.environ.get(METRICS_DIR_ENV)
+    return Path(directory) if directory else None
+
+
+def _series(name: str, labels: Dict[str, str]) -> str:
+    if not labels:
+        return name
+    pairs = []
+    for key, value in sorted(labels.items()):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return f'{name}{{{",".join(pairs)}}}'
+
+
+def _previous(path: Path) -> Dict[str, float]:
+    """Counter samples of the previous file, by series."""
+    samples = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                match = _SAMPLE.match(line)
+                if match and match.group(1).split('{')[0].endswith('_total'):
+                    try:
+                        samples[match.group(1)] = float(match.group(2))
+                    except ValueError:
+                        pass
+    except OSError:
+        pass
+    return samples
+
+
+def _increment(previous: Dict[str, float], name: str, labels: Dict[str, str], by: float) -> Tuple[Dict[str, str], float]:
+    return labels, previous.get(_series(name, labels), 0.0) + by
+
+
+def _write(path: Path, families: List[Family]) -> None:
+    """Write a textfile atomically (node_exporter must never read half of it)."""
+    lines = []
+    for name, kind, text, samples in families:
+        if not samples:
+            continue
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(f'{_series(name, labels)} {int(value) if value == int(value) else repr(float(value))}'
+                     for labels, value in samples)
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"WARNING: Could not write metrics {path}: {e}")
+
+
+def write_build_metrics(record: Dict) -> None:
+    """
+    Export one build's ledger record (stats.make_record) as homerchy_build.prom.
+
+    Args:
+        record: Ledger record of the build that just finished
+    """
+    directory = metrics_dir()
+    if directory is None:
+        return
+    path = directory / BUILD_FILE
+    previous = _previous(path)
+    success = record.get('exit_code') == 0
+    counters = record.get('counters', {})
+    artifacts = record.get('artifacts', {})
+    flags = record.get('flags', {})
+    kind = 'matrix' if flags.get('matrix') else 'incremental' if flags.get('incremental') else 'full'
+
+    phases = [({'phase': step['name']}, step['wall']) for step in record.get('steps', [])
+              if '/' not in step['name']]
+    previous_builds = [r for r in load_records(REGRESSION_WINDOW + 1)
+                       if r.get('timestamp') != record.get('timestamp')][-REGRESSION_WINDOW:]
+    regressions = find_regressions(record, previous_builds) if success else []
+    slower = any(': wall ' in line for line in regressions)
+    bigger = any(line.startswith('iso_size:') for line in regressions)
+
+    ratio = []
+    if counters.get('build/squashfs_bytes'):
+        ratio = [({}, counters.get('build/airootfs_bytes', 0) / counters['build/squashfs_bytes'])]
+
+    _write(path, [
+        ('homerchy_build_last_success', 'gauge', 'Whether the last build succeeded (1) or failed (0).',
+         [({'kind': kind}, 1.0 if success else 0.0)]),
+        ('homerchy_build_last_timestamp_seconds', 'gauge', 'Unix time the last build finished.',
+         [({}, record.get('timestamp', time.time()))]),
+        ('homerchy_build_duration_seconds', 'gauge', 'Wall time of the last build.',
+         [({'kind': kind}, record.get('wall', 0.0))]),
+        ('homerchy_build_phase_duration_seconds', 'gauge', 'Wall time of each phase of the last build.',
+         phases),
+        ('homerchy_source_injection_bytes', 'gauge', 'Bytes the last build copied into the ISO source tree.',
+         [({}, counters.get('profile_assembly/source_bytes_copied', 0))]),
+        ('homerchy_packages_downloaded', 'gauge', 'Packages the last build downloaded.',
+         [({}, counters.get('package_management/packages_downloaded', 0))]),
+        ('homerchy_packages_reused', 'gauge', 'Packages the last build found in the offline mirror.',
+         [({}, counters.get('package_management/packages_reused', 0))]),
+        ('homerchy_packages_downloaded_bytes', 'gauge', 'Bytes of packages the last build downloaded.',
+         [({}, counters.get('package_management/bytes_downloaded', 0))]),
+        ('homerchy_iso_size_bytes', 'gauge', 'Size of the ISO the last successful build produced.',
+         [({}, artifacts['iso_size'])] if artifacts.get('iso_size') else []),
+        ('homerchy_squashfs_compression_ratio', 'gauge',
+         'Uncompressed airootfs bytes per byte of squashfs image in the last build.', ratio),
+        ('homerchy_build_time_regression', 'gauge',
+         'Whether the last build or one of its steps took 25% longer than the median of recent builds.',
+         [({}, 1.0 if slower else 0.0)]),
+        ('homerchy_iso_size_regression', 'gauge',
+         'Whether the last ISO is 25% bigger than the median of recent builds.',
+         [({}, 1.0 if bigger else 0.0)]),
+        ('homerchy_builds_total', 'counter', 'Builds run, by result.', [
+            _increment(previous, 'homerchy_builds_total', {'result': 'success'}, 1 if success else 0),
+            _increment(previous, 'homerchy_builds_total', {'result': 'failure'}, 0 if success else 1),
+        ]),
+        ('homerchy_repo_db_regenerations_total', 'counter', 'Offline repository database regenerations.',
+         [_increment(previous, 'homerchy_repo_db_regenerations_total', {},
+                     counters.get('package_management/repo_db_regenerations', 0))]),
+        ('homerchy_packages_downloaded_total', 'counter', 'Packages downloaded into the offline mirror.',
+         [_increment(previous, 'homerchy_packages_downloaded_total', {},
+                     counters.get('package_management/packages_downloaded', 0))]),
+    ])
+
+
+def write_deploy_metrics(results) -> None:
+    """
+    Export one deploy as homerchy_deploy.prom.
+
+    Args:
+        results: flash.FlashResult per target device
+    """
+    directory = metrics_dir()
+    if directory is None or not results:
+        return
+    path = directory / DEPLOY_FILE
+    previous = _previous(path)
+    ok = [r for r in results if r.ok]
+    written = sum(r.written for r in results)
+
+    def per_target(value) -> List[Tuple[Dict[str, str], float]]:
+        return [({'device': r.target}, float(value(r))) for r in results]
+
+    _write(path, [
+        ('homerchy_deploy_last_success', 'gauge', 'Whether every device of the last deploy succeeded.',
+         [({}, 1.0 if len(ok) == len(results) else 0.0)]),
+        ('homerchy_deploy_last_timestamp_seconds', 'gauge', 'Unix time the last deploy finished.',
+         [({}, time.time())]),
+        ('homerchy_deploy_bytes', 'gauge', 'Bytes written to each device by the last deploy.',
+         per_target(lambda r: r.written)),
+        ('homerchy_deploy_duration_seconds', 'gauge', 'Write time per device of the last deploy.',
+         per_target(lambda r: r.elapsed)),
+        ('homerchy_deploy_throughput_bytes_per_second', 'gauge', 'Write throughput per device of the last deploy.',
+         per_target(lambda r: r.written / r.elapsed if r.elapsed else 0)),
+        ('homerchy_deploys_total', 'counter', 'Device writes, by result.', [
+            _increment(previous, 'homerchy_deploys_total', {'result': 'success'}, len(ok)),
+            _increment(previous, 'homerchy_deploys_total', {'result': 'failure'}, len(results) - len(ok)),
+        ]),
+        ('homerchy_deploy_bytes_total', 'counter', 'Bytes written to devices.',
+         [_increment(previous, 'homerchy_deploy_bytes_total', {}, written)]),
+    ])
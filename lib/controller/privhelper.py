@@ -0,0 +1,406 @@
+"""
+Long-lived privileged helper for filesystem operations.
+
+One root process is started per build (a single sudo prompt) and executes
+batched JSON operations sent over a pipe with direct syscalls, instead of
+forking `sudo rm`, `sudo mv`, `sudo chown -R` and `sudo umount` for every
+step. Only paths below an explicit allow-list of roots (the build's work
+directory, the cache store and the mirror link mkarchiso reads) are accepted,
+and symlinks may only point inside them.
+
+Protocol (one JSON document per line):
+    request:  {"id": 1, "ops": [{"op": "rename", "src": "...", "dst": "..."}, ...]}
+    response: {"id": 1, "results": [{"ok": true}, {"ok": false, "error": "..."}]}
+
+Supported ops: rename, rmtree, rmdir, unlink, mkdir, chown (recursive), symlink,
+mount_tmpfs, unmount, reap. Operations in a batch run in order; a failing op does not
+stop the rest of the batch.
+"""
+
+import argparse
+import atexit
+import ctypes
+import ctypes.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from .reaper import MNT_DETACH, _umount2, read_mounts, reap
+
+REPO_ROOT = Path(__file__).parent.parent.parent.resolve()
+
+# Where profile_assembly links the offline mirror for mkarchiso's pacman.conf
+SYSTEM_MIRROR_ROOT = "/var/cache/omarchy/mirror"
+
+
+def work_roots() -> List[str]:
+    """The build's own directories: work directory, cache store and their scratch directories."""
+    from .cache import SYSTEM_TEMP_CACHE, WORK_DIR_BASE, store_root
+    from .workdir import ISO_TEMP_DIR
+    return [WORK_DIR_BASE, str(store_root()), ISO_TEMP_DIR, SYSTEM_TEMP_CACHE]
+
+
+def build_roots() -> List[str]:
+    """Paths a build is allowed to touch with root privileges."""
+    return work_roots() + [SYSTEM_MIRROR_ROOT]
+
+FDS_ENV = 'HOMERCHY_PRIVHELPER_FDS'
+ROOTS_ENV = 'HOMERCHY_PRIVHELPER_ROOTS'
+
+
+class PathNotAllowed(Exception):
+    """Raised by the server for paths outside the allowed roots."""
+
+
+def _check_path(path: str, roots: List[str]) -> str:
+    """
+    Normalise path and ensure it lies under one of roots.
+
+    The parent directory is resolved so a symlink cannot be used to escape
+    the allowed roots; the final component is kept as-is so symlinks
+    themselves can be removed or replaced.
+    """
+    if not path or not os.path.isabs(path):
+        raise PathNotAllowed(f"not an absolute path: {path!r}")
+    path = os.path.normpath(path)
+    parent = os.path.realpath(os.path.dirname(path))
+    resolved = os.path.join(parent, os.path.basename(path))
+    for root in roots:
+        if resolved == root or resolved.startswith(root.rstrip('/') + '/'):
+            return resolved
+    raise PathNotAllowed(f"outside allowed roots: {path}")
+
+
+def _check_link_target(link: str, target: str, roots: List[str]) -> str:
+    """Ensure a symlink at link pointing to target resolves inside one of roots."""
+    if not target:
+        raise PathNotAllowed("empty symlink target")
+    resolved = os.path.realpath(os.path.join(os.path.dirname(link), target))
+    for root in roots:
+        if resolved == root or resolved.startswith(root.rstrip('/') + '/'):
+            return target
+    raise PathNotAllowed(f"symlink target outside allowed roots: {target}")
+
+
+def _require_real_dir(path: str) -> None:
+    """Ensure path is a directory itself, not a symlink a root operation would follow."""
+    if os.path.islink(path):
+        raise PathNotAllowed(f"refusing to follow symlink: {path}")
+    if not os.path.isdir(path):
+        raise NotADirectoryError(path)
+
+
+def _chown_recursive(path: str, uid: int, gid: int) -> None:
+    os.lchown(path, uid, gid)
+    if os.path.isdir(path) and not os.path.islink(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for name in dirnames + filenames:
+                os.lchown(os.path.join(dirpath, name), uid, gid)
+
+
+def _mount_tmpfs(target: str, size: int, mode: str = '0755') -> None:
+    """Call mount(2) directly for a size-capped tmpfs on target."""
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    data = f"size={size},mode={mode}".encode()
+    if libc.mount(b'tmpfs', os.fsencode(target), b'tmpfs', 0, data) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), target)
+
+
+def _execute(op: Dict, roots: List[str]) -> Dict:
+    """Run a single operation and return its result record."""
+    kind = op.get('op')
+    try:
+        if kind == 'rename':
+            src = _check_path(op['src'], roots)
+            dst = _check_path(op['dst'], roots)
+            if not os.path.lexists(src):
+                if op.get('missing_ok'):
+                    return {'ok': True, 'skipped': True}
+                raise FileNotFoundError(src)
+            try:
+                os.rename(src, dst)
+            except OSError as e:
+                if e.errno != 18:  # EXDEV: fall back to copy + delete
+                    raise
+                shutil.move(src, dst)
+        elif kind == 'rmtree':
+            path = _check_path(op['path'], roots)
+            if read_mounts(path):
+                raise OSError(f"refusing to remove {path}: mounts exist below it")
+            if os.path.islink(path) or os.path.isfile(path):
+                os.unlink(path)
+            elif os.path.isdir(path):
+                shutil.rmtree(path)
+        elif kind == 'rmdir':
+            path = _check_path(op['path'], roots)
+            if os.path.isdir(path):
+                os.rmdir(path)
+        elif kind == 'unlink':
+            path = _check_path(op['path'], roots)
+            if os.path.lexists(path):
+                os.unlink(path)
+        elif kind == 'mkdir':
+            path = _check_path(op['path'], roots)
+            os.makedirs(path, exist_ok=True)
+            _require_real_dir(path)
+            if 'uid' in op:
+                os.lchown(path, op['uid'], op.get('gid', op['uid']))
+        elif kind == 'chown':
+            path = _check_path(op['path'], roots)
+            if os.path.lexists(path):
+                if op.get('recursive', True):
+                    _chown_recursive(path, op['uid'], op['gid'])
+                else:
+                    os.lchown(path, op['uid'], op['gid'])
+        elif kind == 'symlink':
+            link = _check_path(op['link'], roots)
+            target = _check_link_target(link, op['target'], roots)
+            if os.path.lexists(link):
+                if os.path.isdir(link) and not os.path.islink(link):
+                    shutil.rmtree(link)
+                else:
+                    os.unlink(link)
+            os.symlink(target, link)
+        elif kind == 'mount_tmpfs':
+            target = _check_path(op['path'], roots)
+            if read_mounts(target):
+                raise OSError(f"refusing to mount over {target}: already mounted")
+            os.makedirs(target, exist_ok=True)
+            _require_real_dir(target)
+            _mount_tmpfs(target, int(op['size']), op.get('mode', '0755'))
+        elif kind == 'unmount':
+            target = _check_path(op['path'], roots)
+            err = _umount2(target)
+            if err not in (0, 22) and _umount2(target, MNT_DETACH) != 0:
+                raise OSError(err, os.strerror(err), target)
+        elif kind == 'reap':
+            root = _check_path(op['path'], roots)
+            report = reap(root, grace=op.get('grace', 2.0), verbose=False)
+            return {'ok': report.clean, 'report': asdict(report)}
+        else:
+            raise ValueError(f"unknown op: {kind!r}")
+    except Exception as e:
+        return {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+    return {'ok': True}
+
+
+def serve(roots: List[str], infile, outfile) -> None:
+    """Serve batched requests until EOF on infile."""
+    roots = [os.path.realpath(r) for r in roots]
+    for line in infile:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+            results = [_execute(op, roots) for op in request.get('ops', [])]
+            response = {'id': request.get('id'), 'results': results}
+        except (ValueError, AttributeError) as e:
+            response = {'id': None, 'error': f"bad request: {e}"}
+        outfile.write(json.dumps(response) + '\n')
+        outfile.flush()
+
+
+def _describe(op: Dict) -> str:
+    return ' '.join(f"{k}={v}" for k, v in op.items())
+
+
+class PrivilegedHelper:
+    """Client side of the privileged helper."""
+
+    def __init__(self, roots: Optional[List[str]] = None):
+        self.roots = list(roots or build_roots())
+        self.proc: Optional[subprocess.Popen] = None
+        self.reader = None
+        self.writer = None
+        self.inprocess = False
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def start(self) -> 'PrivilegedHelper':
+        """Start the root helper (prompts for sudo once) or attach to an inherited one."""
+        inherited = os.environ.get(FDS_ENV)
+        if inherited:
+            read_fd, write_fd = (int(fd) for fd in inherited.split(','))
+            self.reader = os.fdopen(read_fd, 'r')
+            self.writer = os.fdopen(write_fd, 'w')
+            self.roots = os.environ.get(ROOTS_ENV, ':'.join(self.roots)).split(':')
+            return self
+
+        if os.geteuid() == 0:
+            self.inprocess = True
+            return self
+
+        cmd = ['sudo', sys.executable, '-m', 'lib.controller.privhelper']
+        for root in self.roots:
+            cmd.extend(['--allow', root])
+        self.proc = subprocess.Popen(
+            cmd, cwd=str(REPO_ROOT), stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+        self.reader = self.proc.stdout
+        self.writer = self.proc.stdin
+        return self
+
+    def child_env(self) -> Dict[str, str]:
+        """Environment for a child process that should reuse this helper."""
+        if self.inprocess or not self.writer:
+            return {}
+        return {
+            FDS_ENV: f"{self.reader.fileno()},{self.writer.fileno()}",
+            ROOTS_ENV: ':'.join(self.roots),
+        }
+
+    def child_fds(self) -> tuple:
+        """File descriptors to pass to a child process along with child_env()."""
+        if self.inprocess or not self.writer:
+            return ()
+        return (self.reader.fileno(), self.writer.fileno())
+
+    def batch(self, ops: List[Dict], check: bool = True) -> List[Dict]:
+        """
+        Execute a batch of operations with one round-trip.
+
+        Args:
+            ops: Operation dicts (see module docstring)
+            check: Whether to exit on the first failed operation
+
+        Returns:
+            List of result dicts, one per operation
+        """
+        if not ops:
+            return []
+        if self.inprocess:
+            roots = [os.path.realpath(r) for r in self.roots]
+            results = [_execute(op, roots) for op in ops]
+        else:
+            # One request in flight at a time (phases, assembly steps and matrix variants run in threads)
+            with self._lock:
+                self._next_id += 1
+                request_id = self._next_id
+                self.writer.write(json.dumps({'id': request_id, 'ops': ops}) + '\n')
+                self.writer.flush()
+                line = self.reader.readline()
+            if not line:
+                print("ERROR: Privileged helper exited unexpectedly", file=sys.stderr)
+                sys.exit(1)
+            response = json.loads(line)
+            if 'error' in response:
+                print(f"ERROR: Privileged helper: {response['error']}", file=sys.stderr)
+                sys.exit(1)
+            if response.get('id') != request_id or len(response.get('results', [])) != len(ops):
+                # Another writer on the same pipe (an unlocked caller, a second process): the
+                # results may belong to someone else's operations
+                print(f"ERROR: Privileged helper answered request {response.get('id')} "
+                      f"while waiting for {request_id}; responses are out of step", file=sys.stderr)
+                sys.exit(1)
+            results = response['results']
+
+        if check:
+            for op, result in zip(ops, results):
+                if not result.get('ok') and 'report' not in result:
+                    print(f"ERROR: Privileged operation failed: {_describe(op)}", file=sys.stderr)
+                    print(f"Error output: {result.get('error')}", file=sys.stderr)
+                    sys.exit(1)
+        return results
+
+    def rename(self, src, dst, check: bool = True, missing_ok: bool = False) -> Dict:
+        return self.batch([{'op': 'rename', 'src': str(src), 'dst': str(dst),
+                            'missing_ok': missing_ok}], check)[0]
+
+    def rmtree(self, path, check: bool = True) -> Dict:
+        return self.batch([{'op': 'rmtree', 'path': str(path)}], check)[0]
+
+    def rmdir(self, path, check: bool = False) -> Dict:
+        return self.batch([{'op': 'rmdir', 'path': str(path)}], check)[0]
+
+    def unlink(self, path, check: bool = True) -> Dict:
+        return self.batch([{'op': 'unlink', 'path': str(path)}], check)[0]
+
+    def mkdir(self, path, uid: Optional[int] = None, gid: Optional[int] = None,
+              check: bool = True) -> Dict:
+        op = {'op': 'mkdir', 'path': str(path)}
+        if uid is not None:
+            op.update(uid=uid, gid=gid if gid is not None else uid)
+        return self.batch([op], check)[0]
+
+    def chown(self, path, uid: Optional[int] = None, gid: Optional[int] = None,
+              recursive: bool = True, check: bool = True) -> Dict:
+        uid = os.getuid() if uid is None else uid
+        gid = os.getgid() if gid is None else gid
+        return self.batch([{'op': 'chown', 'path': str(path), 'uid': uid, 'gid': gid,
+                            'recursive': recursive}], check)[0]
+
+    def symlink(self, target, link, check: bool = True) -> Dict:
+        return self.batch([{'op': 'symlink', 'target': str(target), 'link': str(link)}], check)[0]
+
+    def mount_tmpfs(self, path, size: int, check: bool = False) -> Dict:
+        return self.batch([{'op': 'mount_tmpfs', 'path': str(path), 'size': size}], check)[0]
+
+    def unmount(self, path, check: bool = False) -> Dict:
+        return self.batch([{'op': 'unmount', 'path': str(path)}], check)[0]
+
+    def reap(self, path, grace: float = 2.0) -> Dict:
+        return self.batch([{'op': 'reap', 'path': str(path), 'grace': grace}], check=False)[0]
+
+    def close(self) -> None:
+        """Stop the helper (only the process that started it owns its lifetime)."""
+        if self.writer and self.proc:
+            try:
+                self.writer.close()
+            except OSError:
+                pass
+            self.proc.wait()
+        self.proc = None
+        self.reader = None
+        self.writer = None
+
+
+_helper: Optional[PrivilegedHelper] = None
+
+
+def get_helper(roots: Optional[List[str]] = None) -> PrivilegedHelper:
+    """
+    Return the process-wide helper, starting it on first use.
+
+    A helper started by a parent process (HOMERCHY_PRIVHELPER_FDS) is reused,
+    so a whole build shares one root process.
+    """
+    global _helper
+    if _helper is None:
+        _helper = PrivilegedHelper(roots).start()
+        atexit.register(_helper.close)
+    return _helper
+
+
+def active_helper() -> Optional[PrivilegedHelper]:
+    """Return the running helper without starting one."""
+    if _helper is None and os.environ.get(FDS_ENV):
+        return get_helper()
+    return _helper
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Homerchy privileged helper (run as root)')
+    parser.add_argument('--allow', action='append', default=[], metavar='ROOT',
+                        help='Allowed path root (repeatable)')
+    args = parser.parse_args()
+
+    if os.geteuid() != 0:
+        print("privhelper must run as root", file=sys.stderr)
+        sys.exit(1)
+    if not args.allow:
+        print("privhelper needs at least one --allow root", file=sys.stderr)
+        sys.exit(1)
+
+    serve(args.allow, sys.stdin, sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
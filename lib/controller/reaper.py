@@ -0,0 +1,416 @@
+"""
+Native mount and process reaper for work directory cleanup.
+
+Reads /proc/self/mountinfo and /proc/<pid>/{cwd,root,exe,fd,maps} once to build
+an index of the mounts and open handles under a directory, instead of walking
+the tree with lsof +D, findmnt and find -mountpoint. Mounts are unmounted
+deepest-first after their holders have been signalled.
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import List
+
+MNT_DETACH = 2
+
+REPO_ROOT = Path(__file__).parent.parent.parent.resolve()
+
+
+@dataclass
+class MountEntry:
+    """A mount point below the reaped directory."""
+    mount_id: int
+    parent_id: int
+    target: str
+    fstype: str
+    source: str
+
+    @property
+    def depth(self) -> int:
+        return self.target.rstrip('/').count('/')
+
+
+@dataclass
+class Holder:
+    """A process holding files, a cwd or a root inside the reaped directory."""
+    pid: int
+    comm: str
+    paths: List[str] = field(default_factory=list)
+
+
+@dataclass
+class ReapReport:
+    """Structured result of a reap pass."""
+    root: str
+    mounts: List[str] = field(default_factory=list)
+    holders: List[Holder] = field(default_factory=list)
+    terminated: List[int] = field(default_factory=list)
+    killed: List[int] = field(default_factory=list)
+    unmounted: List[str] = field(default_factory=list)
+    detached: List[str] = field(default_factory=list)
+    failed: List[str] = field(default_factory=list)
+    unreadable_pids: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def clean(self) -> bool:
+        """True if nothing is left mounted under the root."""
+        return not self.failed
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'ReapReport':
+        holders = [Holder(**h) for h in data.pop('holders', [])]
+        return cls(holders=holders, **data)
+
+
+def _unescape(value: str) -> str:
+    """Decode the octal escapes (\\040 etc.) used in /proc/self/mountinfo."""
+    if '\\' not in value:
+        return value
+    out = []
+    i = 0
+    while i < len(value):
+        octal = value[i + 1:i + 4]
+        if value[i] == '\\' and len(octal) == 3 and octal.isdigit():
+            out.append(chr(int(octal, 8)))
+            i += 4
+        else:
+            out.append(value[i])
+            i += 1
+    return ''.join(out)
+
+
+def _is_under(path: str, root: str) -> bool:
+    return path == root or path.startswith(root + '/')
+
+
+def read_mounts(root: str, mountinfo: str = '/proc/self/mountinfo',
+                include_root: bool = True) -> List[MountEntry]:
+    """
+    Return every mount at or below root, deepest first.
+
+    Args:
+        root: Directory to scan (absolute, no trailing slash)
+        mountinfo: mountinfo file to parse
+        include_root: Also return mounts on root itself (False: strictly below it)
+
+    Returns:
+        List of MountEntry sorted so children come before their parents
+    """
+    root = root.rstrip('/') or '/'
+    mounts = []
+    try:
+        with open(mountinfo, 'r') as f:
+            lines = f.readlines()
+    except OSError:
+        return mounts
+
+    for line in lines:
+        # <id> <parent> <maj:min> <root> <target> <opts> [optional...] - <fstype> <source> <super opts>
+        left, _, right = line.partition(' - ')
+        fields = left.split()
+        if len(fields) < 5:
+            continue
+        target = _unescape(fields[4])
+        if not _is_under(target, root) or (target == root and not include_root):
+            continue
+        right_fields = right.split()
+        mounts.append(MountEntry(
+            mount_id=int(fields[0]),
+            parent_id=int(fields[1]),
+            target=target,
+            fstype=right_fields[0] if right_fields else '',
+            source=_unescape(right_fields[1]) if len(right_fields) > 1 else '',
+        ))
+
+    # Deepest path first; for stacked mounts on one path, the newest (highest id) first
+    mounts.sort(key=lambda m: (m.depth, m.mount_id), reverse=True)
+    return mounts
+
+
+def _excluded_pids() -> set:
+    """Our own PID and its ancestors; never signal the process tree doing the reaping."""
+    pids = set()
+    pid = os.getpid()
+    while pid > 1 and pid not in pids:
+        pids.add(pid)
+        try:
+            with open(f'/proc/{pid}/stat', 'r') as f:
+                stat = f.read()
+            pid = int(stat.rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            break
+    return pids
+
+
+def find_holders(root: str, proc: str = '/proc') -> tuple:
+    """
+    Scan /proc once for processes referencing anything under root.
+
+    Args:
+        root: Directory to scan (absolute, no trailing slash)
+        proc: procfs mount point
+
+    Returns:
+        Tuple of (list of Holder, number of processes we could not inspect)
+    """
+    root = root.rstrip('/') or '/'
+    excluded = _excluded_pids()
+    holders = []
+    unreadable = 0
+
+    try:
+        entries = os.listdir(proc)
+    except OSError:
+        return holders, unreadable
+
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        pid = int(entry)
+        if pid in excluded:
+            continue
+        base = f'{proc}/{entry}'
+        paths = set()
+        denied = False
+
+        for link in ('cwd', 'root', 'exe'):
+            try:
+                target = os.readlink(f'{base}/{link}')
+            except PermissionError:
+                denied = True
+                continue
+            except OSError:
+                continue
+            if _is_under(target, root):
+                paths.add(target)
+
+        try:
+            fds = os.listdir(f'{base}/fd')
+        except PermissionError:
+            denied = True
+            fds = []
+        except OSError:
+            fds = []
+        for fd in fds:
+            try:
+                target = os.readlink(f'{base}/fd/{fd}')
+            except OSError:
+                continue
+            if _is_under(target, root):
+                paths.add(target)
+
+        # Memory-mapped files (shared libraries, executables run from the tree)
+        try:
+            with open(f'{base}/maps', 'r') as f:
+                for line in f:
+                    parts = line.split(None, 5)
+                    if len(parts) == 6:
+                        target = parts[5].strip()
+                        if target.endswith(' (deleted)'):
+                            target = target[:-10]
+                        if _is_under(target, root):
+                            paths.add(target)
+        except PermissionError:
+            denied = True
+        except OSError:
+            pass
+
+        if denied:
+            unreadable += 1
+        if paths:
+            try:
+                with open(f'{base}/comm', 'r') as f:
+                    comm = f.read().strip()
+            except OSError:
+                comm = '?'
+            holders.append(Holder(pid=pid, comm=comm, paths=sorted(paths)))
+
+    return holders, unreadable
+
+
+def _alive(pid: int) -> bool:
+    """True if pid still exists and is not a zombie waiting to be reaped."""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            state = f.read().rsplit(')', 1)[1].split()[0]
+    except (OSError, IndexError):
+        return False
+    return state != 'Z'
+
+
+def _signal_holders(pids: List[int], grace: float, report: ReapReport, verbose: bool) -> None:
+    """SIGTERM every holder, wait up to grace seconds, then SIGKILL the survivors."""
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGTERM)
+            report.terminated.append(pid)
+            if verbose:
+                print(f"  Terminating PID {pid}")
+        except OSError:
+            pass
+
+    deadline = time.monotonic() + grace
+    remaining = [pid for pid in report.terminated]
+    while remaining and time.monotonic() < deadline:
+        time.sleep(0.1)
+        remaining = [pid for pid in remaining if _alive(pid)]
+
+    for pid in remaining:
+        try:
+            os.kill(pid, signal.SIGKILL)
+            report.killed.append(pid)
+            if verbose:
+                print(f"  Force killing PID {pid}")
+        except OSError:
+            pass
+
+
+def _umount2(target: str, flags: int = 0) -> int:
+    """Call umount2(2) directly; returns 0 or an errno."""
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.umount2(os.fsencode(target), flags) == 0:
+        return 0
+    return ctypes.get_errno()
+
+
+def _unmount_all(mounts: List[MountEntry], report: ReapReport, verbose: bool) -> None:
+    """Unmount deepest-first, falling back to a lazy detach for busy mounts."""
+    for mount in mounts:
+        if verbose:
+            print(f"Unmounting: {mount.target}")
+        err = _umount2(mount.target)
+        if err == 0:
+            report.unmounted.append(mount.target)
+            continue
+        if err == 22:  # EINVAL: already gone (parent detached it)
+            continue
+        if _umount2(mount.target, MNT_DETACH) == 0:
+            report.detached.append(mount.target)
+            if verbose:
+                print(f"  Busy, lazily detached: {mount.target}")
+        else:
+            report.failed.append(mount.target)
+
+
+def reap(root: str, grace: float = 2.0, dry_run: bool = False, verbose: bool = True) -> ReapReport:
+    """
+    Signal every process holding files under root and unmount everything below it.
+
+    A mount on root itself (a dedicated work disk, the scratch tmpfs) is left
+    in place; only mounts strictly below root are released.
+
+    Unprivileged callers hand the pass to the running privileged helper, or
+    re-run the reaper once under sudo, since the holders and mounts left
+    behind by mkarchiso belong to root.
+
+    Args:
+        root: Directory to reap
+        grace: Seconds to wait between SIGTERM and SIGKILL
+        dry_run: Only index mounts and holders; do not signal or unmount
+        verbose: Print progress lines
+
+    Returns:
+        ReapReport describing what was found and done
+    """
+    root = os.path.abspath(root).rstrip('/') or '/'
+    if os.geteuid() != 0 and not dry_run:
+        return _reap_via_sudo(root, grace, verbose)
+
+    start = time.monotonic()
+    report = ReapReport(root=root)
+    mounts = read_mounts(root, include_root=False)
+    holders, report.unreadable_pids = find_holders(root)
+    report.mounts = [m.target for m in mounts]
+    report.holders = holders
+
+    if not dry_run:
+        if holders:
+            if verbose:
+                print(f"Found {len(holders)} processes using {root}, terminating...")
+            _signal_holders([h.pid for h in holders], grace, report, verbose)
+        _unmount_all(mounts, report, verbose)
+
+        # Anything still listed (e.g. remounted by a dying process) gets a lazy detach
+        for mount in read_mounts(root, include_root=False):
+            if _umount2(mount.target, MNT_DETACH) == 0:
+                report.detached.append(mount.target)
+            elif mount.target not in report.failed:
+                report.failed.append(mount.target)
+
+    report.elapsed = time.monotonic() - start
+    return report
+
+
+def _reap_via_sudo(root: str, grace: float, verbose: bool) -> ReapReport:
+    """Run one privileged reap pass and relay its report."""
+    from .privhelper import active_helper
+
+    helper = active_helper()
+    if helper is not None:
+        result = helper.reap(root, grace=grace)
+        if 'report' not in result:
+            print(f"Reaper failed: {result.get('error')}", file=sys.stderr)
+            return ReapReport(root=root, failed=[root])
+        report = ReapReport.from_dict(result['report'])
+    else:
+        cmd = ['sudo', sys.executable, '-m', 'lib.controller.reaper', root,
+               '--grace', str(grace), '--json']
+        result = subprocess.run(cmd, cwd=str(REPO_ROOT), capture_output=True, text=True)
+        if result.returncode not in (0, 1) or not result.stdout.strip():
+            if result.stderr:
+                print(f"Reaper failed: {result.stderr.strip()}", file=sys.stderr)
+            return ReapReport(root=root, failed=[root])
+        report = ReapReport.from_dict(json.loads(result.stdout))
+
+    if verbose:
+        print_report(report)
+    return report
+
+
+def print_report(report: ReapReport) -> None:
+    """Print a short human-readable summary of a reap pass."""
+    for holder in report.holders:
+        print(f"  Holder PID {holder.pid} ({holder.comm}): {holder.paths[0]}"
+              f"{' ...' if len(holder.paths) > 1 else ''}")
+    for target in report.unmounted:
+        print(f"Unmounted: {target}")
+    for target in report.detached:
+        print(f"Lazily detached: {target}")
+    for target in report.failed:
+        print(f"WARNING: Could not unmount: {target}")
+    print(f"✓ Reaped {report.root}: {len(report.holders)} holders "
+          f"({len(report.killed)} force killed), {len(report.unmounted) + len(report.detached)} "
+          f"mounts released in {report.elapsed:.1f}s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Reap mounts and processes under a directory')
+    parser.add_argument('root', help='Directory to reap')
+    parser.add_argument('--grace', type=float, default=2.0,
+                        help='Seconds between SIGTERM and SIGKILL')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only list mounts and holders')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON')
+    args = parser.parse_args()
+
+    report = reap(args.root, grace=args.grace, dry_run=args.dry_run, verbose=not args.json)
+    if args.json:
+        print(json.dumps(asdict(report)))
+    else:
+        print_report(report)
+    sys.exit(0 if report.clean else 1)
+
+
+if __name__ == '__main__':
+    main()
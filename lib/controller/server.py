@@ -0,0 +1,566 @@
+"""
+Long-running build service (controller --serve).
+
+One server process imports the isoprep tree once, watches the source tree
+with inotify and keeps the warm indexes of isoprep's utils.warm (phase-cache
+tree digests, the injected-source records and the package-name index) in
+memory. Build, eject and deploy jobs are queued, each run in a child forked
+from the server, so every job starts with everything the previous one
+learned; a build hands its indexes back when it exits and the server drops
+whatever the watcher saw change in the meantime. Jobs that do not contend for
+the work directory locks (lib/controller/locks.py) run side by side - a deploy
+of the last ISO while the next one builds - and the rest wait their turn in
+queue order.
+
+Clients talk to the server over a Unix socket
+(${HOMERCHY_SOCKET:-${XDG_RUNTIME_DIR:-/tmp}/homerchy-controller.sock}),
+one JSON document per line:
+
+    request:  {"op": "submit", "job": "build", "args": {"profile": true}}
+    replies:  {"job": 3, "queued": 0}, then {"log": "..."} lines, then {"job": 3, "exit": 0}
+    request:  {"op": "status"}   reply: {"running": ..., "queued": [...], "indexes": {...}}
+    request:  {"op": "stop"}     reply: {"ok": true}
+
+The controller forwards -b/-r/-e/-E/-d to a running server automatically
+(set HOMERCHY_NO_SERVER=1 to bypass it).
+"""
+
+import codecs
+import importlib
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import tempfile
+import time
+import traceback
+from collections import deque
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Deque, Dict, List, Optional
+
+from .watch import TreeWatcher, WatchUnavailable
+
+REPO_ROOT = Path(__file__).parent.parent.parent.resolve()
+ISOPREP_INDEX = REPO_ROOT / 'deployment' / 'iso-builder' / 'isoprep' / 'index'
+
+SOCKET_ENV = 'HOMERCHY_SOCKET'
+BYPASS_ENV = 'HOMERCHY_NO_SERVER'
+JOB_KINDS = ('build', 'eject', 'deploy')
+KEEP_FINISHED = 20      # finished jobs kept for status
+PARALLEL_KINDS = {frozenset({'build', 'deploy'}), frozenset({'deploy'})}
+POLL_INTERVAL = 0.5     # seconds between checks for a finished job
+
+
+def socket_path() -> Path:
+    """Location of the server socket."""
+    override = os.environ.get(SOCKET_ENV)
+    if override:
+        return Path(override)
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return Path(runtime) / 'homerchy-controller.sock'
+    return Path(tempfile.gettempdir()) / f'homerchy-controller-{os.getuid()}.sock'
+
+
+@dataclass
+class Job:
+    """One queued or running controller job."""
+    id: int
+    kind: str
+    args: dict
+    state: str = 'queued'
+    pid: Optional[int] = None
+    exit: Optional[int] = None
+    pipe: Optional[int] = None
+    warm_file: Optional[Path] = None
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    subscribers: List[socket.socket] = field(default_factory=list)
+    decoder: object = field(default_factory=lambda: codecs.getincrementaldecoder('utf-8')(errors='replace'))
+
+    def compatible(self, other: 'Job') -> bool:
+        """True if the two jobs may run at once (see locks.py)."""
+        if frozenset({self.kind, other.kind}) not in PARALLEL_KINDS:
+            return False
+        if self.kind == other.kind == 'deploy':
+            return not set(self.args.get('devices', [])) & set(other.args.get('devices', []))
+        return True
+
+    def describe(self) -> dict:
+        return {'job': self.id, 'kind': self.kind, 'args': self.args, 'state': self.state,
+                'exit': self.exit, 'submitted': self.submitted, 'started': self.started,
+                'finished': self.finished}
+
+
+def run_job(kind: str, args: dict) -> int:
+    """
+    Execute a job in the current (forked) process.
+
+    Returns:
+        Exit code
+    """
+    from . import build, deploy, eject
+    try:
+        if kind == 'build':
+            return build.do_build(full_clean=args.get('full_clean', False),
+                                  cache_db_only=args.get('cache_db_only', False),
+                                  resume=args.get('resume', False),
+                                  profile=args.get('profile', False))
+        if kind == 'eject':
+            eject.do_eject(full_cleanup=args.get('full', False))
+            return 0
+        if kind == 'deploy':
+            deploy.do_deploy(args.get('devices', []), assume_yes=True)
+            return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    print(f"Unknown job: {kind}", file=sys.stderr)
+    return 2
+
+
+def warm_up():
+    """
+    Import the isoprep orchestrator, its utils and its phase packages once.
+
+    Returns:
+        isoprep's utils.warm module (the indexes forked jobs inherit)
+    """
+    from .build import load_isoprep
+    load_isoprep()
+    warm = importlib.import_module('utils.warm')
+    with open(ISOPREP_INDEX / 'index.json', 'r') as f:
+        phases = json.load(f).get('children', [])
+    for phase in phases:
+        try:
+            importlib.import_module(phase)
+        except ImportError:
+            pass
+    return warm
+
+
+class BuildServer:
+    """Single-threaded event loop: socket clients, the source watcher and one job at a time."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.selector = selectors.DefaultSelector()
+        self.sock: Optional[socket.socket] = None
+        self.watcher: Optional[TreeWatcher] = None
+        self.warm = None
+        self.jobs: Dict[int, Job] = {}
+        self.queue: Deque[Job] = deque()
+        self.active: Dict[int, Job] = {}
+        self.buffers: Dict[socket.socket, bytes] = {}
+        self.next_id = 1
+        self.running = True
+        self.state_dir = Path(tempfile.mkdtemp(prefix='homerchy-serve-'))
+
+    # --- setup -------------------------------------------------------------
+
+    def start(self) -> None:
+        """Bind the socket, load the isoprep tree and start watching the sources."""
+        if ping(self.path):
+            raise RuntimeError(f"a build server is already listening on {self.path}")
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        print(">>> Loading isoprep...")
+        self.warm = warm_up()
+        repo_root = REPO_ROOT / 'deployment'
+        try:
+            self.watcher = TreeWatcher([str(repo_root)], excludes=('.git', 'isoprep-work'))
+            self.warm.set_watched([str(repo_root)])
+            self.selector.register(self.watcher, selectors.EVENT_READ, 'watch')
+            print(f"✓ Watching {repo_root} ({len(self.watcher.paths)} directories)")
+        except WatchUnavailable as e:
+            print(f"WARNING: {e}; source trees will be rescanned every build")
+
+        # One privileged helper for every job (single sudo prompt, here)
+        from .eject import WORK_DIR_OLD
+        from .privhelper import build_roots, get_helper
+        get_helper(build_roots() + [WORK_DIR_OLD])
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.sock.bind(str(self.path))
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(16)
+        self.selector.register(self.sock, selectors.EVENT_READ, 'accept')
+        print(f"✓ Build server listening on {self.path}")
+
+    def close(self) -> None:
+        for job in self.active.values():
+            try:
+                os.kill(job.pid, signal.SIGTERM)
+                os.waitpid(job.pid, 0)
+            except OSError:
+                pass
+        for conn in list(self.buffers):
+            self._drop(conn)
+        if self.sock:
+            self.sock.close()
+            try:
+                self.path.unlink()
+            except FileNotFoundError:
+                pass
+        if self.watcher:
+            self.watcher.close()
+        for leftover in self.state_dir.glob('*'):
+            leftover.unlink()
+        self.state_dir.rmdir()
+
+    # --- event loop --------------------------------------------------------
+
+    def serve_forever(self) -> None:
+        while self.running:
+            for key, _ in self.selector.select(timeout=POLL_INTERVAL):
+                if key.data == 'accept':
+                    conn, _ = self.sock.accept()
+                    conn.settimeout(5)
+                    self.buffers[conn] = b''
+                    self.selector.register(conn, selectors.EVENT_READ, 'client')
+                elif key.data == 'client':
+                    self._read_client(key.fileobj)
+                elif key.data == 'watch':
+                    self.watcher.read()
+                elif isinstance(key.data, Job):
+                    self._read_job_output(key.data)
+            self._reap()
+            for job in self._startable():
+                self.queue.remove(job)
+                self._start(job)
+
+    def _startable(self) -> List[Job]:
+        """Queued jobs compatible with every running job and every job queued before them."""
+        ready = []
+        ahead = list(self.active.values())
+        for job in self.queue:
+            if all(job.compatible(other) for other in ahead):
+                ready.append(job)
+            ahead.append(job)
+        return ready
+
+    def _read_client(self, conn: socket.socket) -> None:
+        try:
+            data = conn.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(conn)
+            return
+        buffer = self.buffers[conn] + data
+        *lines, self.buffers[conn] = buffer.split(b'\n')
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                self._handle(conn, json.loads(line))
+            except ValueError:
+                self._send(conn, {'error': 'invalid request'})
+
+    def _handle(self, conn: socket.socket, request: dict) -> None:
+        op = request.get('op')
+        if op == 'submit':
+            kind = request.get('job')
+            if kind not in JOB_KINDS:
+                self._send(conn, {'error': f"unknown job {kind!r}"})
+                return
+            job = Job(id=self.next_id, kind=kind, args=request.get('args') or {})
+            self.next_id += 1
+            job.subscribers.append(conn)
+            self.jobs[job.id] = job
+            self.queue.append(job)
+            ahead = len(self.queue) - 1 + len(self.active)
+            self._send(conn, {'job': job.id, 'queued': ahead})
+            print(f"Job {job.id}: {kind} queued ({ahead} ahead)")
+        elif op == 'status':
+            self._send(conn, self.status())
+        elif op == 'stop':
+            self._send(conn, {'ok': True})
+            self.running = False
+        else:
+            self._send(conn, {'error': f"unknown op {op!r}"})
+
+    def status(self) -> dict:
+        indexes = {name: len(self.warm.index(name)) for name in ('trees', 'source')}
+        # One package index per directory; count the packages they hold
+        indexes['packages'] = sum(len(getattr(index, 'entries', ())) for index in self.warm.index('packages').values())
+        return {
+            'pid': os.getpid(),
+            'running': [job.describe() for job in self.active.values()],
+            'queued': [job.describe() for job in self.queue],
+            'finished': [job.describe() for job in self.jobs.values() if job.state == 'finished'],
+            'watching': [str(r) for r in self.watcher.roots] if self.watcher else [],
+            'indexes': indexes,
+        }
+
+    def _send(self, conn: socket.socket, message: dict) -> bool:
+        try:
+            conn.sendall((json.dumps(message) + '\n').encode())
+            return True
+        except OSError:
+            self._drop(conn)
+            return False
+
+    def _drop(self, conn: socket.socket) -> None:
+        if conn in self.buffers:
+            del self.buffers[conn]
+            try:
+                self.selector.unregister(conn)
+            except (KeyError, ValueError):
+                pass
+            conn.close()
+        for job in self.jobs.values():
+            if conn in job.subscribers:
+                job.subscribers.remove(conn)
+
+    def _broadcast(self, job: Job, message: dict) -> None:
+        for conn in list(job.subscribers):
+            self._send(conn, message)
+
+    # --- jobs --------------------------------------------------------------
+
+    def _start(self, job: Job) -> None:
+        # Builds never overlap: forget what changed since the last one refreshed the indexes
+        if job.kind == 'build':
+            if self.watcher:
+                self.warm.invalidate(self.watcher.drain())
+            job.warm_file = self.state_dir / f'job-{job.id}.warm'
+        read_fd, write_fd = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(read_fd)
+                for conn in list(self.buffers) + ([self.sock] if self.sock else []):
+                    conn.close()
+                if self.watcher:
+                    os.close(self.watcher.fd)
+                devnull = os.open(os.devnull, os.O_RDONLY)
+                os.dup2(devnull, 0)
+                os.dup2(write_fd, 1)
+                os.dup2(write_fd, 2)
+                os.close(write_fd)
+                sys.stdout.reconfigure(line_buffering=True)
+                sys.stderr.reconfigure(line_buffering=True)
+                if job.warm_file:
+                    os.environ[self.warm.STATE_ENV] = str(job.warm_file)
+                else:
+                    os.environ.pop(self.warm.STATE_ENV, None)
+                code = run_job(job.kind, job.args)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                try:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                finally:
+                    os._exit(code if isinstance(code, int) else 1)
+
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        job.pid, job.pipe, job.state, job.started = pid, read_fd, 'running', time.time()
+        self.active[job.id] = job
+        self.selector.register(read_fd, selectors.EVENT_READ, job)
+        print(f"Job {job.id}: {job.kind} started (pid {pid})")
+
+    def _read_job_output(self, job: Optional[Job]) -> bool:
+        """Forward what the job wrote; False once its output is closed."""
+        if job is None or job.pipe is None:
+            return False
+        while True:
+            try:
+                data = os.read(job.pipe, 65536)
+            except BlockingIOError:
+                return True
+            if not data:
+                self.selector.unregister(job.pipe)
+                os.close(job.pipe)
+                job.pipe = None
+                return False
+            text = job.decoder.decode(data)
+            if text:
+                self._broadcast(job, {'log': text})
+
+    def _reap(self) -> None:
+        for job in list(self.active.values()):
+            pid, status = os.waitpid(job.pid, os.WNOHANG)
+            if pid != 0:
+                self._finish(job, status)
+
+    def _finish(self, job: Job, status: int) -> None:
+        # Grandchildren (e.g. a gpg-agent) may hold the pipe open: take what is there and stop
+        self._read_job_output(job)
+        if job.pipe is not None:
+            self.selector.unregister(job.pipe)
+            os.close(job.pipe)
+            job.pipe = None
+        job.exit = os.waitstatus_to_exitcode(status)
+        job.state, job.finished = 'finished', time.time()
+        if job.warm_file and self.warm.load(job.warm_file):
+            job.warm_file.unlink()
+        self._broadcast(job, {'job': job.id, 'exit': job.exit})
+        job.subscribers.clear()
+        del self.active[job.id]
+        print(f"Job {job.id}: {job.kind} finished with exit code {job.exit} "
+              f"({job.finished - job.started:.1f}s)")
+        finished = [j for j in self.jobs.values() if j.state == 'finished']
+        for old in finished[:-KEEP_FINISHED]:
+            del self.jobs[old.id]
+
+
+def serve(path: Optional[Path] = None) -> int:
+    """Run the build server in the foreground until stopped."""
+    server = BuildServer(path or socket_path())
+    try:
+        server.start()
+    except (RuntimeError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    signal.signal(signal.SIGTERM, lambda *_: setattr(server, 'running', False))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("\n>>> Stopping build server...")
+        server.close()
+    return 0
+
+
+# --- client ------------------------------------------------------------------
+
+def connect(path: Optional[Path] = None) -> Optional[socket.socket]:
+    """Connect to the running server, or return None if there is none."""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(str(path or socket_path()))
+    except OSError:
+        conn.close()
+        return None
+    return conn
+
+
+def ping(path: Optional[Path] = None) -> bool:
+    """True if a server is listening."""
+    conn = connect(path)
+    if conn is None:
+        return False
+    conn.close()
+    return True
+
+
+def available() -> bool:
+    """True if controller commands should be forwarded to a running server."""
+    return not os.environ.get(BYPASS_ENV) and ping()
+
+
+def _messages(conn: socket.socket):
+    buffer = b''
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            return
+        buffer += data
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+
+
+def request(op: str) -> Optional[dict]:
+    """Send a one-shot request (status, stop); None if no server is running."""
+    conn = connect()
+    if conn is None:
+        return None
+    with conn:
+        conn.sendall((json.dumps({'op': op}) + '\n').encode())
+        return next(_messages(conn), None)
+
+
+def submit(kind: str, args: dict) -> int:
+    """
+    Queue a job on the server and stream its output until it finishes.
+
+    Interrupting the client detaches from the job; it keeps running.
+
+    Returns:
+        Exit code of the job
+    """
+    conn = connect()
+    if conn is None:
+        print("Error: No build server running.", file=sys.stderr)
+        return 1
+    job_id = None
+    with conn:
+        conn.sendall((json.dumps({'op': 'submit', 'job': kind, 'args': args}) + '\n').encode())
+        try:
+            for message in _messages(conn):
+                if 'error' in message:
+                    print(f"Error: {message['error']}", file=sys.stderr)
+                    return 1
+                if 'log' in message:
+                    sys.stdout.write(message['log'])
+                    sys.stdout.flush()
+                elif 'exit' in message:
+                    return message['exit']
+                elif 'queued' in message:
+                    job_id = message['job']
+                    ahead = message['queued']
+                    print(f">>> Job {job_id} submitted to build server"
+                          + (f" ({ahead} job(s) ahead)" if ahead else ''))
+        except KeyboardInterrupt:
+            print(f"\nDetached; job {job_id} keeps running on the build server.")
+            return 130
+    print("Error: Lost connection to the build server.", file=sys.stderr)
+    return 1
+
+
+def print_status(status: dict) -> None:
+    """Print a status reply."""
+    print(f"Build server (pid {status['pid']}) on {socket_path()}")
+    running = status.get('running') or []
+    if not running:
+        print("  Running: nothing")
+    for job in running:
+        print(f"  Running: job {job['job']} ({job['kind']})")
+    for job in status.get('queued', []):
+        print(f"  Queued:  job {job['job']} ({job['kind']})")
+    for job in status.get('finished', [])[-5:]:
+        print(f"  Done:    job {job['job']} ({job['kind']}) exit {job['exit']}")
+    if status.get('watching'):
+        print(f"  Watching: {', '.join(status['watching'])}")
+    indexes = status.get('indexes', {})
+    print("  Warm indexes: " + ', '.join(f"{name} {count}" for name, count in indexes.items()))
+
+
+def do_serve(action: str = 'start') -> int:
+    """controller --serve [start|status|stop]"""
+    if action == 'start':
+        return serve()
+    if action == 'status':
+        status = request('status')
+        if status is None:
+            print("No build server running.")
+            return 1
+        print_status(status)
+        return 0
+    if action == 'stop':
+        if request('stop') is None:
+            print("No build server running.")
+            return 1
+        print("Build server stopping.")
+        return 0
+    print(f"Unknown --serve action: {action}", file=sys.stderr)
+    return 2
@@ -0,0 +1,261 @@
+"""
+Build ledger and statistics.
+
+Every build appends one JSON line to the ledger
+(${HOMERCHY_LEDGER:-${XDG_STATE_HOME:-~/.local/state}/homerchy/builds.jsonl})
+holding the per-phase and per-step profile written by the isoprep orchestrator.
+`--stats` compares the most recent builds and flags regressions.
+"""
+
+import json
+import os
+import socket
+import statistics
+import subprocess
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+REPO_ROOT = Path(__file__).parent.parent.parent.resolve()
+
+# A step regressed if it got this much slower/bigger than its median AND by at least the floor
+REGRESSION_RATIO = 1.25
+REGRESSION_FLOORS = {
+    'wall': 10.0,            # seconds
+    'cpu_total': 10.0,       # seconds
+    'max_rss_kb': 256 * 1024,
+}
+ISO_SIZE_FLOOR = 64 * 1024 * 1024    # bytes
+
+
+def ledger_path() -> Path:
+    """Location of the build ledger."""
+    override = os.environ.get('HOMERCHY_LEDGER')
+    if override:
+        return Path(override)
+    state_home = os.environ.get('XDG_STATE_HOME') or str(Path.home() / '.local' / 'state')
+    return Path(state_home) / 'homerchy' / 'builds.jsonl'
+
+
+def git_revision() -> Optional[str]:
+    """Short commit hash of the tree being built, if available."""
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(REPO_ROOT),
+                                capture_output=True, text=True)
+    except OSError:
+        return None
+    return result.stdout.strip() or None
+
+
+def load_profile(profile_file: Path) -> List[Dict]:
+    """Read the step records written by the orchestrator (empty if none)."""
+    try:
+        with open(profile_file, 'r') as f:
+            return json.load(f).get('steps', [])
+    except (OSError, ValueError):
+        return []
+
+
+def load_counters(profile_file: Path) -> Dict[str, float]:
+    """Read the counters written by the orchestrator (bytes copied, packages downloaded, ...)."""
+    try:
+        with open(profile_file, 'r') as f:
+            return json.load(f).get('counters', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def make_record(exit_code: int, wall: float, steps: List[Dict], artifacts: Optional[Dict] = None,
+                counters: Optional[Dict] = None, **flags) -> Dict:
+    """
+    Build a ledger record for one build.
+
+    Args:
+        exit_code: Build exit code
+        wall: Total wall time of the build in seconds
+        steps: Step records from the orchestrator profile
+        artifacts: Sizes of what the build produced (iso_size), used by
+            the isoprep preflight to estimate the next build's space needs
+        counters: Counters from the orchestrator profile
+        **flags: Build options (full_clean, cache_db_only, resume)
+
+    Returns:
+        Ledger record dict
+    """
+    return {
+        'timestamp': time.time(),
+        'host': socket.gethostname(),
+        'commit': git_revision(),
+        'exit_code': exit_code,
+        'wall': wall,
+        'flags': flags,
+        'steps': steps,
+        'artifacts': artifacts or {},
+        'counters': counters or {},
+    }
+
+
+def append_record(record: Dict) -> None:
+    """Append a record to the ledger (a failure to write never fails the build)."""
+    path = ledger_path()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as e:
+        print(f"WARNING: Could not write build ledger {path}: {e}")
+
+
+def load_records(limit: Optional[int] = None) -> List[Dict]:
+    """Return the last `limit` ledger records, oldest first."""
+    path = ledger_path()
+    records = []
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        return []
+    return records[-limit:] if limit else records
+
+
+def _fmt_secs(seconds: float) -> str:
+    if seconds >= 60:
+        return f"{int(seconds // 60)}m{int(seconds % 60):02d}s"
+    return f"{seconds:.1f}s"
+
+
+def _fmt_bytes(count: float) -> str:
+    for unit in ('B', 'K', 'M', 'G'):
+        if abs(count) < 1024 or unit == 'G':
+            return f"{count:.0f}{unit}" if unit == 'B' else f"{count:.1f}{unit}"
+        count /= 1024
+    return f"{count:.1f}G"
+
+
+def _metric(step: Dict, name: str) -> float:
+    if name == 'cpu_total':
+        return step.get('cpu', 0.0) + step.get('child_cpu', 0.0)
+    return step.get(name, 0)
+
+
+def print_profile(record: Dict) -> None:
+    """Print the per-phase and per-step breakdown of one build."""
+    print(f"\n>>> Build profile ({_fmt_secs(record['wall'])} total, exit {record['exit_code']})")
+    print(f"  {'Step':<52} {'Wall':>8} {'CPU':>8} {'Child CPU':>9} {'Peak RSS':>9} "
+          f"{'Read':>8} {'Write':>8}")
+    for step in record.get('steps', []):
+        name = step['name']
+        label = ('  ' + name.split('/', 1)[1]) if '/' in name else name
+        if step.get('cached'):
+            label += ' (cached)'
+        if not step.get('ok', True):
+            label += ' (FAILED)'
+        print(f"  {label:<52} {_fmt_secs(step['wall']):>8} {_fmt_secs(step['cpu']):>8} "
+              f"{_fmt_secs(step['child_cpu']):>9} "
+              f"{_fmt_bytes(max(step['max_rss_kb'], step['child_max_rss_kb']) * 1024):>9} "
+              f"{_fmt_bytes(step['rchar']):>8} {_fmt_bytes(step['wchar']):>8}")
+
+
+def find_regressions(latest: Dict, previous: List[Dict]) -> List[str]:
+    """
+    Compare the latest build with the median of previous successful builds.
+
+    Cached phases and failed steps are left out of the comparison; the ISO
+    size is compared too.
+
+    Args:
+        latest: Ledger record to check
+        previous: Earlier ledger records
+
+    Returns:
+        List of human-readable regression lines
+    """
+    history: Dict[str, List[Dict]] = {}
+    for record in previous:
+        if record.get('exit_code') != 0:
+            continue
+        for step in record.get('steps', []):
+            if step.get('ok', True) and not step.get('cached'):
+                history.setdefault(step['name'], []).append(step)
+
+    regressions = []
+    candidates = [{'name': 'total', 'wall': latest['wall']}] + latest.get('steps', [])
+    history['total'] = [{'wall': r['wall']} for r in previous if r.get('exit_code') == 0]
+    for step in candidates:
+        if step.get('cached') or not step.get('ok', True) or not history.get(step['name']):
+            continue
+        metrics = ['wall'] if step['name'] == 'total' else list(REGRESSION_FLOORS)
+        for metric in metrics:
+            floor = REGRESSION_FLOORS[metric]
+            baseline = statistics.median(_metric(s, metric) for s in history[step['name']])
+            value = _metric(step, metric)
+            if value > baseline * REGRESSION_RATIO and value - baseline >= floor:
+                fmt = _fmt_bytes if metric == 'max_rss_kb' else _fmt_secs
+                scale = 1024 if metric == 'max_rss_kb' else 1
+                regressions.append(f"{step['name']}: {metric} {fmt(value * scale)} "
+                                   f"vs median {fmt(baseline * scale)} "
+                                   f"(+{(value / baseline - 1) * 100 if baseline else 100:.0f}%)")
+
+    sizes = [r['artifacts']['iso_size'] for r in previous
+             if r.get('exit_code') == 0 and r.get('artifacts', {}).get('iso_size')]
+    size = latest.get('artifacts', {}).get('iso_size')
+    if size and sizes:
+        baseline = statistics.median(sizes)
+        if size > baseline * REGRESSION_RATIO and size - baseline >= ISO_SIZE_FLOOR:
+            regressions.append(f"iso_size: {_fmt_bytes(size)} vs median {_fmt_bytes(baseline)} "
+                               f"(+{(size / baseline - 1) * 100:.0f}%)")
+    return regressions
+
+
+def do_stats(count: int = 5) -> int:
+    """
+    Compare the last `count` builds and flag regressions in the newest one.
+
+    Returns:
+        Exit code (0 if no regressions were found)
+    """
+    records = load_records(count)
+    if not records:
+        print(f"No builds recorded yet in {ledger_path()}")
+        return 0
+
+    phases = []
+    for record in records:
+        for step in record.get('steps', []):
+            if '/' not in step['name'] and step['name'] not in phases:
+                phases.append(step['name'])
+
+    print(f">>> Last {len(records)} builds ({ledger_path()})")
+    header = f"  {'Date':<16} {'Commit':<9} {'Exit':>4} {'Total':>8}"
+    for phase in phases:
+        header += f" {phase[:18]:>18}"
+    print(header)
+    for record in records:
+        walls = {s['name']: s for s in record.get('steps', []) if '/' not in s['name']}
+        line = (f"  {time.strftime('%Y-%m-%d %H:%M', time.localtime(record['timestamp'])):<16} "
+                f"{(record.get('commit') or '-'):<9} {record['exit_code']:>4} "
+                f"{_fmt_secs(record['wall']):>8}")
+        for phase in phases:
+            step = walls.get(phase)
+            cell = '-' if step is None else _fmt_secs(step['wall']) + ('*' if step.get('cached') else '')
+            line += f" {cell:>18}"
+        print(line)
+    print("  (* = replayed from the phase cache)")
+
+    if len(records) < 2:
+        return 0
+    regressions = find_regressions(records[-1], records[:-1])
+    if not regressions:
+        print("✓ No regressions in the latest build")
+        return 0
+    print(f"WARNING: {len(regressions)} regression(s) in the latest build:")
+    for line in regressions:
+        print(f"  {line}")
+    return 1
@@ -6,6 +6,7 @@ import os
 import sys
 from pathlib import Path
 
+from . import locks
 from .utils import run_command
 
 
@@ -34,4 +35,6 @@ def do_launch_iso() -> None:
         print(f"Error: Launch ISO script not found or executable at {launch_iso_script}")
         sys.exit(1)
     
-    run_command(['bash', str(launch_iso_script)], check=False)
+    # The VM boots from a published ISO: keep eject from removing it meanwhile
+    with locks.hold(locks.ISOOUT, exclusive=False, purpose='launch-iso'):
+        run_command(['bash', str(launch_iso_script)], check=False)
@@ -0,0 +1,148 @@
+"""
+Recursive change watcher for source trees (inotify).
+
+Reports which paths changed since the last drain(), without rescanning the
+trees. It has no thread of its own: the caller polls fileno() (select) and
+calls read() when it is readable, so it can live inside a single-threaded
+event loop such as the build server's.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+from typing import Dict, Iterable, List, Set
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    return _libc
+
+
+class WatchUnavailable(Exception):
+    """Raised when inotify cannot be used (not Linux, or out of watches)."""
+
+
+class TreeWatcher:
+    """Watches directory trees and collects the paths changed below them."""
+
+    def __init__(self, roots: Iterable[str], excludes: Iterable[str] = ('.git',)):
+        """
+        Args:
+            roots: Directories to watch recursively
+            excludes: Directory names never descended into
+
+        Raises:
+            WatchUnavailable: If inotify cannot be set up
+        """
+        self.roots = [os.path.realpath(r) for r in roots]
+        self.excludes = set(excludes)
+        self.paths: Dict[int, str] = {}
+        self.changed: Set[str] = set()
+        try:
+            libc = _load_libc()
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError) as e:
+            raise WatchUnavailable(f"inotify unavailable: {e}")
+        if self.fd < 0:
+            raise WatchUnavailable(f"inotify_init1: {os.strerror(ctypes.get_errno())}")
+        try:
+            for root in self.roots:
+                self._add_tree(root)
+        except WatchUnavailable:
+            self.close()
+            raise
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def _add(self, path: str) -> None:
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise WatchUnavailable("out of inotify watches (raise fs.inotify.max_user_watches)")
+            return
+        self.paths[wd] = path
+
+    def _add_tree(self, root: str) -> None:
+        for dirpath, dirnames, _ in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d not in self.excludes
+                           and not os.path.islink(os.path.join(dirpath, d))]
+            self._add(dirpath)
+
+    def read(self) -> None:
+        """Consume pending events (call when fileno() is readable)."""
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return
+            if not data:
+                return
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                self._event(wd, mask, name)
+
+    def _event(self, wd: int, mask: int, name: str) -> None:
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost: everything may have changed
+            self.changed.update(self.roots)
+            return
+        base = self.paths.get(wd)
+        if base is None:
+            return
+        if mask & IN_IGNORED:
+            self.paths.pop(wd, None)
+            return
+        path = os.path.join(base, name) if name else base
+        if name in self.excludes:
+            return
+        self.changed.add(path)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            try:
+                self._add_tree(path)
+            except WatchUnavailable:
+                self.changed.update(self.roots)
+
+    def drain(self) -> List[str]:
+        """Return (and forget) the paths changed since the last drain()."""
+        self.read()
+        changed = sorted(self.changed)
+        self.changed.clear()
+        return changed
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
@@ -3,14 +3,25 @@ Work directory management for ISO build process.
 """
 
 import os
-import subprocess
 from pathlib import Path
 from typing import Optional
 
-from .utils import run_command, run_shell_command
+from .cache import disk_usage, parse_size, store_root
+from .privhelper import get_helper
+from .reaper import read_mounts, reap
+from .stats import _fmt_bytes, load_records
 
 
 WORK_DIR_BASE = "/mnt/work/homerchy-deployment/deployment/isoprep-work"
+ISO_TEMP_DIR = "/mnt/work/.homerchy-iso-temp"
+
+# archiso-tmp placement: auto (tmpfs when the last build's footprint fits in RAM) or disk
+SCRATCH_ENV = 'HOMERCHY_ARCHISO_TMPFS'
+# Memory left to the rest of the system when sizing the tmpfs
+RESERVE_ENV = 'HOMERCHY_TMPFS_RESERVE'
+DEFAULT_RESERVE = '8G'
+SCRATCH_HEADROOM = 1.5      # tmpfs cap relative to the last footprint
+SPILL_THRESHOLD = 0.02      # free fraction below which a failed build counts as out of space
 
 
 def setup_build_workdir() -> str:
@@ -24,11 +35,8 @@ def setup_build_workdir() -> str:
     
     if not Path(work_dir).exists():
         print(f"Creating build work directory at {work_dir}...")
-        run_command(['mkdir', '-p', work_dir], sudo=True)
-        # Set ownership to current user
-        uid = os.getuid()
-        gid = os.getgid()
-        run_command(['chown', '-R', f'{uid}:{gid}', work_dir], sudo=True)
+        # Create and hand ownership to the current user in one privileged round-trip
+        get_helper().mkdir(work_dir, uid=os.getuid(), gid=os.getgid())
         print("✓ Build work directory created")
     else:
         print(f"Build work directory already exists at {work_dir}")
@@ -39,6 +47,111 @@ def setup_build_workdir() -> str:
     return work_dir
 
 
+def mem_available() -> int:
+    """MemAvailable from /proc/meminfo, in bytes (0 if unknown)."""
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def archiso_tmp_footprint() -> Optional[int]:
+    """Peak size of archiso-tmp in the last successful build, from the build ledger."""
+    for record in reversed(load_records(20)):
+        size = record.get('artifacts', {}).get('archiso_tmp_size')
+        if record.get('exit_code') == 0 and size:
+            return size
+    return None
+
+
+def archiso_tmp_usage(work_dir: str) -> int:
+    """Bytes archiso-tmp currently occupies (tmpfs or disk)."""
+    archiso_tmp = Path(work_dir) / "archiso-tmp"
+    if is_scratch_tmpfs(work_dir):
+        st = os.statvfs(archiso_tmp)
+        return (st.f_blocks - st.f_bfree) * st.f_frsize
+    return disk_usage(archiso_tmp)
+
+
+def is_scratch_tmpfs(work_dir: str) -> bool:
+    """True if archiso-tmp is mounted on its own tmpfs."""
+    target = str(Path(work_dir) / "archiso-tmp")
+    return any(m.target == target and m.fstype == 'tmpfs' for m in read_mounts(target))
+
+
+def place_archiso_tmp(work_dir: str, resume: bool = False) -> bool:
+    """
+    Mount archiso-tmp on a sized tmpfs if the last build's footprint fits in RAM.
+    
+    The airootfs population and the mksquashfs inputs are then written to
+    memory. Anything else (no ledger yet, not enough memory, a resumed build
+    whose mkarchiso state is on disk, HOMERCHY_ARCHISO_TMPFS=disk) keeps
+    archiso-tmp on disk.
+    
+    Args:
+        work_dir: Build work directory
+        resume: Whether the build resumes a previous one
+    
+    Returns:
+        True if archiso-tmp is on tmpfs
+    """
+    if os.environ.get(SCRATCH_ENV, 'auto').lower() in ('disk', 'off', 'false'):
+        return False
+    if is_scratch_tmpfs(work_dir):
+        return True
+    if resume:
+        print("archiso-tmp stays on disk (resumed build)")
+        return False
+    
+    footprint = archiso_tmp_footprint()
+    if not footprint:
+        print("archiso-tmp on disk (no previous build to size a tmpfs from)")
+        return False
+    available = mem_available()
+    reserve = parse_size(os.environ.get(RESERVE_ENV) or DEFAULT_RESERVE)
+    size = min(int(footprint * SCRATCH_HEADROOM), available - reserve)
+    if size < footprint:
+        print(f"archiso-tmp on disk ({_fmt_bytes(footprint)} needed, "
+              f"{_fmt_bytes(max(available - reserve, 0))} of RAM to spare)")
+        return False
+    
+    archiso_tmp = Path(work_dir) / "archiso-tmp"
+    if archiso_tmp.exists() and any(archiso_tmp.iterdir()):
+        # Stale mkarchiso state would only be hidden under the mount
+        get_helper().rmtree(str(archiso_tmp), check=False)
+    result = get_helper().mount_tmpfs(str(archiso_tmp), size)
+    if not result.get('ok'):
+        print(f"WARNING: Could not mount tmpfs on archiso-tmp ({result.get('error')}), using disk")
+        return False
+    print(f"✓ archiso-tmp on a {_fmt_bytes(size)} tmpfs (last build used {_fmt_bytes(footprint)})")
+    return True
+
+
+def spill_archiso_tmp(work_dir: str) -> bool:
+    """
+    Move archiso-tmp back to disk if its tmpfs ran out of space.
+    
+    Returns:
+        True if the tmpfs was full and has been unmounted (the build should be retried)
+    """
+    if not is_scratch_tmpfs(work_dir):
+        return False
+    archiso_tmp = Path(work_dir) / "archiso-tmp"
+    st = os.statvfs(archiso_tmp)
+    if st.f_bavail > st.f_blocks * SPILL_THRESHOLD:
+        return False
+    print("archiso-tmp tmpfs is full, spilling over to disk...")
+    report = reap(str(archiso_tmp))
+    if not report.clean:
+        return False
+    # reap leaves the mount on archiso-tmp itself; release the tmpfs explicitly
+    return bool(get_helper().unmount(str(archiso_tmp)).get('ok'))
+
+
 def cleanup_build_workdir(full_clean: bool = False, cache_db_only: bool = False) -> None:
     """
     Clean up work directory, preserving cacheable parts unless full clean.
@@ -59,58 +172,14 @@ def cleanup_build_workdir(full_clean: bool = False, cache_db_only: bool = False)
     else:
         print("Cleaning up build work directory (preserving caches)...")
     
-    # Kill any processes using the directory
-    try:
-        result = run_shell_command(
-            f'lsof +D "{work_dir}" 2>/dev/null | awk \'NR>1 {{print $2}}\' | sort -u',
-            check=False,
-            capture_output=True
-        )
-        if result.stdout.strip():
-            pids = result.stdout.strip().split('\n')
-            print("Terminating processes using work directory...")
-            for pid in pids:
-                if pid.strip():
-                    try:
-                        run_command(['kill', '-TERM', pid.strip()], check=False, sudo=True)
-                    except:
-                        pass
-            # Wait a bit, then force kill
-            import time
-            time.sleep(2)
-            result = run_shell_command(
-                f'lsof +D "{work_dir}" 2>/dev/null | awk \'NR>1 {{print $2}}\' | sort -u',
-                check=False,
-                capture_output=True
-            )
-            if result.stdout.strip():
-                pids = result.stdout.strip().split('\n')
-                for pid in pids:
-                    if pid.strip():
-                        try:
-                            run_command(['kill', '-KILL', pid.strip()], check=False, sudo=True)
-                        except:
-                            pass
-    except:
-        pass
+    helper = get_helper()
     
-    # Unmount any mounts in the directory
-    try:
-        result = run_shell_command(
-            f'findmnt -rn -o TARGET -T "{work_dir}" 2>/dev/null | grep "^{work_dir}" | sort -r',
-            check=False,
-            capture_output=True
-        )
-        if result.stdout.strip():
-            mounts = result.stdout.strip().split('\n')
-            for mountpoint in mounts:
-                if mountpoint.strip():
-                    try:
-                        run_command(['umount', '-l', mountpoint.strip()], check=False, sudo=True)
-                    except:
-                        pass
-    except:
-        pass
+    # Signal processes using the directory and unmount anything below it
+    # (including an archiso-tmp tmpfs)
+    report = reap(work_dir)
+    if not report.clean:
+        print("WARNING: Mounts remain under the work directory, skipping cleanup.")
+        return
     
     work_path = Path(work_dir)
     
@@ -120,139 +189,62 @@ def cleanup_build_workdir(full_clean: bool = False, cache_db_only: bool = False)
         iso_out_dir = work_path / "isoout"
         
         # Preserve ISO output if it exists
-        temp_iso_dir = "/mnt/work/.homerchy-iso-temp"
+        temp_iso_dir = ISO_TEMP_DIR
         if iso_out_dir.exists() and any(iso_out_dir.glob("*.iso")):
             print("  Preserving ISO output directory...")
             temp_iso_path = Path(temp_iso_dir)
             if temp_iso_path.exists():
-                run_command(['rm', '-rf', temp_iso_dir], sudo=True)
-            run_command(['mv', str(iso_out_dir), temp_iso_dir], sudo=True)
+                helper.rmtree(temp_iso_dir)
+            helper.rename(str(iso_out_dir), temp_iso_dir)
         
-        # Remove work directory
-        run_command(['rm', '-rf', work_dir], sudo=True)
+        # Remove work directory and the cache store
+        helper.rmtree(work_dir)
+        helper.rmtree(str(store_root()), check=False)
         
         # Restore ISO output
         if Path(temp_iso_dir).exists():
-            run_command(['mkdir', '-p', work_dir], sudo=True)
-            run_command(['mv', temp_iso_dir, str(iso_out_dir)], sudo=True)
+            helper.mkdir(work_dir)
+            helper.rename(temp_iso_dir, str(iso_out_dir))
         
         print("✓ Work directory fully cleaned (all caches removed, ISO output preserved)")
+        return
     
-    elif cache_db_only:
-        # Cache DB only: preserve database files and package files, remove everything else
+    # The offline mirror lives in the cache store, outside the work directory:
+    # nothing has to be moved aside to keep it
+    profile_dir = work_path / "profile"
+    archiso_tmp = work_path / "archiso-tmp"
+    preserve_profile = os.environ.get('HOMERCHY_PRESERVE_PROFILE', 'false').lower() == 'true'
+    ops = []
+    
+    if cache_db_only:
+        # Cache DB only: keep only the database and package files (in the store)
         print("Preserving repository database and package files (removing everything else)...")
-        
-        profile_dir = work_path / "profile"
-        archiso_tmp = work_path / "archiso-tmp"
-        cache_dir = profile_dir / "airootfs/var/cache/omarchy/mirror/offline"
-        prepare_temp_cache = work_path / "offline-mirror-cache-temp"
-        
-        temp_cache_dir = "/mnt/work/.homerchy-cache-temp"
-        cache_found = False
-        
-        # Check final cache location - only preserve if it has package files
-        if cache_dir.exists() and any(cache_dir.glob('*.pkg.tar.*')):
-            pkg_count = len(list(cache_dir.glob('*.pkg.tar.*')))
-            print(f"  Preserving repository database and package files from cache directory ({pkg_count} packages)...")
-            cache_found = True
-            if Path(temp_cache_dir).exists():
-                run_command(['rm', '-rf', temp_cache_dir], sudo=True)
-            run_command(['mv', str(cache_dir), temp_cache_dir], sudo=True)
-        # Check prepare phase temp location - only preserve if it has package files
-        elif prepare_temp_cache.exists() and any(prepare_temp_cache.glob('*.pkg.tar.*')):
-            pkg_count = len(list(prepare_temp_cache.glob('*.pkg.tar.*')))
-            print(f"  Preserving repository database and package files from prepare temp location ({pkg_count} packages)...")
-            cache_found = True
-            if Path(temp_cache_dir).exists():
-                run_command(['rm', '-rf', temp_cache_dir], sudo=True)
-            run_command(['mv', str(prepare_temp_cache), temp_cache_dir], sudo=True)
-        
-        # Remove archiso-tmp completely
         if archiso_tmp.exists():
             print("  Removing archiso-tmp...")
-            run_command(['rm', '-rf', str(archiso_tmp)], sudo=True)
-        
-        # Remove profile directory completely (unless preservation requested)
-        preserve_profile = os.environ.get('HOMERCHY_PRESERVE_PROFILE', 'false').lower() == 'true'
-        if profile_dir.exists():
-            if preserve_profile:
-                print("  Preserving profile directory (HOMERCHY_PRESERVE_PROFILE=true)...")
-            else:
-                print("  Removing profile directory...")
-                run_command(['rm', '-rf', str(profile_dir)], sudo=True)
-        
-        # Don't restore cache here - leave it in temp location for prepare/download phase to restore
-        # This avoids the prepare phase removing a cache that was just restored
-        if Path(temp_cache_dir).exists():
-            if any(Path(temp_cache_dir).glob('*.pkg.tar.*')):
-                pkg_count = len(list(Path(temp_cache_dir).glob('*.pkg.tar.*')))
-                print(f"  Cache preserved in temp location ({pkg_count} packages, will be restored by prepare phase)...")
-            else:
-                # Temp cache exists but is empty, remove it
-                print("  Cache directory exists but is empty, removing...")
-                run_command(['rm', '-rf', temp_cache_dir], sudo=True)
-        
-        print("✓ Work directory cleaned (database and package files preserved in temp location)")
+            ops.append({'op': 'rmtree', 'path': str(archiso_tmp)})
+    elif archiso_tmp.exists():
+        print("Preserving archiso-tmp for package cache...")
+        # Remove only the x86_64 build directory, keep package cache
+        ops.append({'op': 'rmtree', 'path': str(archiso_tmp / "x86_64")})
+        ops.append({'op': 'rmtree', 'path': str(archiso_tmp / "iso")})
+        # Remove state files
+        for state_file in list(archiso_tmp.glob("*.state")) + list(archiso_tmp.glob("base.*")):
+            ops.append({'op': 'unlink', 'path': str(state_file)})
     
-    else:
-        # Preserve cacheable directories
-        profile_dir = work_path / "profile"
-        archiso_tmp = work_path / "archiso-tmp"
-        
-        # Remove only the parts that need to be rebuilt
-        if archiso_tmp.exists():
-            print("Preserving archiso-tmp for package cache...")
-            # Remove only the x86_64 build directory, keep package cache
-            x86_64_dir = archiso_tmp / "x86_64"
-            iso_dir = archiso_tmp / "iso"
-            if x86_64_dir.exists():
-                run_command(['rm', '-rf', str(x86_64_dir)], sudo=True)
-            if iso_dir.exists():
-                run_command(['rm', '-rf', str(iso_dir)], sudo=True)
-            # Remove state files
-            for state_file in archiso_tmp.glob("*.state"):
-                run_command(['rm', '-f', str(state_file)], sudo=True)
-            for base_file in archiso_tmp.glob("base.*"):
-                run_command(['rm', '-f', str(base_file)], sudo=True)
-        
-        preserve_profile = os.environ.get('HOMERCHY_PRESERVE_PROFILE', 'false').lower() == 'true'
-        if profile_dir.exists():
-            if preserve_profile:
-                print("Preserving profile directory (HOMERCHY_PRESERVE_PROFILE=true)...")
-                print("  (Skipping profile cleanup to allow inspection)")
-            else:
-                print("Cleaning up profile directory (preserving only caches)...")
-            
-            cache_dir = profile_dir / "airootfs/var/cache/omarchy/mirror/offline"
-            temp_cache = work_path / "offline-mirror-cache-temp"
-            
-            # Clean up any stale temp directories
-            if temp_cache.exists():
-                run_command(['rm', '-rf', str(temp_cache)], sudo=True)
-            
-            # Preserve package cache if it exists and has packages
-            if cache_dir.exists():
-                pkg_files = list(cache_dir.glob("*.pkg.tar.*"))
-                if pkg_files:
-                    print("  Preserving package cache...")
-                    run_command(['mkdir', '-p', str(temp_cache.parent)], sudo=True)
-                    run_command(['mv', str(cache_dir), str(temp_cache)], sudo=True)
-            
-            # Remove entire profile directory (unless preservation requested)
-            if preserve_profile:
-                print("  Skipping profile directory removal (preserved for inspection)")
-            else:
-                print("  Removing profile directory...")
-                run_command(['rm', '-rf', str(profile_dir)], sudo=True)
-            
-            # Restore preserved cache
-            if temp_cache.exists():
-                print("  Restoring package cache...")
-                run_command(['mkdir', '-p', str(cache_dir.parent)], sudo=True)
-                run_command(['mv', str(temp_cache), str(cache_dir)], sudo=True)
-        
-        # Only remove work directory if it's completely empty
-        if work_path.exists() and not any(work_path.iterdir()):
-            run_command(['rmdir', work_dir], check=False, sudo=True)
+    if profile_dir.exists():
+        if preserve_profile:
+            print("  Preserving profile directory (HOMERCHY_PRESERVE_PROFILE=true)...")
         else:
-            print("✓ Preserved cacheable directories for faster rebuild")
+            print("  Removing profile directory (package cache is kept in the cache store)...")
+            ops.append({'op': 'rmtree', 'path': str(profile_dir)})
+    
+    if ops:
+        helper.batch(ops, check=False)
+    
+    if cache_db_only:
+        print("✓ Work directory cleaned (database and package files preserved in the cache store)")
+    # Only remove work directory if it's completely empty
+    elif work_path.exists() and not any(work_path.iterdir()):
+        helper.rmdir(work_dir)
+    else:
+        print("✓ Preserved cacheable directories for faster rebuild")